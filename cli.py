@@ -0,0 +1,180 @@
+"""
+Command line entry point of DeepQA.
+
+    python cli.py train [--tasks 1 2]
+    python cli.py eval results/<run> test.txt
+    python cli.py predict results/<run> questions.jsonl -o predictions.jsonl
+    python cli.py export results/<run> -o qa_model.pt
+    python cli.py benchmark [--budget 0.5]
+
+Every subcommand imports its modules only when it runs, so the help and the inference subcommands do not pay for
+the training stack: torch is only imported by the subcommands that use a model, matplotlib and pandas only by train
+(see main.py). eval and predict also accept a model file written by export.
+
+benchmark measures the import time of every subcommand in a fresh interpreter and checks which of the heavy modules
+it loads. It exits with status 1 if a subcommand loads a module it should not load or if the CLI itself takes longer
+than the budget to import. tests/test_cli_imports.py runs the same checks.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from inference.arguments import add_export_arguments, add_prediction_arguments
+
+HEAVY_MODULES = ["torch", "numpy", "matplotlib", "pandas"]
+
+# Modules a subcommand imports and the heavy modules it must not load. train only needs matplotlib and pandas once a
+# param set is finished (see main.py).
+SUBCOMMAND_IMPORTS = {
+    "cli": (["cli"], HEAVY_MODULES),
+    "train": (["main"], ["matplotlib", "pandas"]),
+    "eval": (["inference.predict"], ["matplotlib", "pandas"]),
+    "predict": (["inference.predict"], ["matplotlib", "pandas"]),
+    "export": (["inference.export"], ["matplotlib", "pandas"])
+}
+
+# Longest allowed import time of the CLI itself in s
+IMPORT_BUDGET = 0.5
+
+# The modules are imported from the repository root, wherever the CLI is started from
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter by measure_imports: imports the given modules and reports the time and the watched modules
+_IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for module in sys.argv[2:]:
+    __import__(module)
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "loaded": [m for m in json.loads(sys.argv[1]) if m in sys.modules]}))
+"""
+
+
+def measure_imports(modules, repeats=3, watched=None):
+    """
+    :param watched: Modules whose loading is reported (default: HEAVY_MODULES)
+    :return: Fastest import time of the modules in a fresh interpreter (in s) and the watched modules they load
+    """
+    best = None
+    loaded = []
+
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, "-c", _IMPORT_PROBE, json.dumps(watched or HEAVY_MODULES)]
+                                         + modules, cwd=_ROOT)
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+        best = result["seconds"] if best is None else min(best, result["seconds"])
+        loaded = result["loaded"]
+
+    return best, loaded
+
+
+def benchmark(args):
+    failures = []
+
+    print("%-10s %10s  %s" % ("command", "import", "heavy modules"))
+    for name in ["cli", "eval", "predict", "export", "train"]:
+        modules, forbidden = SUBCOMMAND_IMPORTS[name]
+        seconds, loaded = measure_imports(modules, args.repeats)
+
+        print("%-10s %9.3fs  %s" % (name, seconds, ", ".join(loaded) or "-"))
+
+        for module in loaded:
+            if module in forbidden:
+                failures.append("%s imports %s" % (name, module))
+        if name == "cli" and seconds > args.budget:
+            failures.append("importing the CLI takes %.3fs (budget: %.3fs)" % (seconds, args.budget))
+
+    if args.run_dir is not None and args.input is not None:
+        # A short lived scoring job from start to end
+        start = time.time()
+        subprocess.check_call([sys.executable, __file__, "eval", args.run_dir, args.input])
+        print("eval of %s in a new process: %.2fs" % (args.input, time.time() - start))
+
+    for failure in failures:
+        print("FAILED: " + failure)
+
+    return 1 if failures else 0
+
+
+def train(args):
+    import main
+
+    for task in args.tasks:
+        main.main(task)
+
+    return 0
+
+
+def evaluate(args):
+    from inference import predict
+
+    predict.run(args, output=False)
+    return 0
+
+
+def predict(args):
+    from inference import predict
+
+    predict.run(args)
+    return 0
+
+
+def export(args):
+    from inference import export
+
+    export.run(args)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Trains, evaluates and serves the DeepQA bAbI models.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    train_parser = subparsers.add_parser("train", help="Runs the grid search of main.py for the given bAbI tasks "
+                                                       "(the parameters are set in main())")
+    train_parser.add_argument("--tasks", type=int, nargs="+", default=[1, 2, 3, 6])
+    train_parser.set_defaults(handler=train)
+
+    eval_parser = subparsers.add_parser("eval", help="Accuracy of a saved run or exported model on a bAbI or JSONL "
+                                                     "file")
+    add_prediction_arguments(eval_parser, output=False)
+    eval_parser.set_defaults(handler=evaluate)
+
+    predict_parser = subparsers.add_parser("predict", help="Writes the predictions for a bAbI or JSONL file as JSONL")
+    add_prediction_arguments(predict_parser)
+    predict_parser.set_defaults(handler=predict)
+
+    export_parser = subparsers.add_parser("export", help="Exports a saved run as a self-contained TorchScript file")
+    add_export_arguments(export_parser)
+    export_parser.set_defaults(handler=export)
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Measures the start-up time of the subcommands")
+    benchmark_parser.add_argument("--repeats", type=int, default=3)
+    benchmark_parser.add_argument("--budget", type=float, default=IMPORT_BUDGET,
+                                  help="Longest allowed import time of the CLI in s (default: %(default)s)")
+    benchmark_parser.add_argument("--run-dir", help="Also time a complete eval of --input with this run or model")
+    benchmark_parser.add_argument("--input", help="Test file for the eval")
+    benchmark_parser.set_defaults(handler=benchmark)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 0
+
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+"""
+Command line arguments of the inference commands. They are kept apart from the commands, so cli.py can build its help
+without importing torch.
+"""
+
+
+def add_prediction_arguments(parser, output=True):
+    # Arguments of inference.predict (and of the eval subcommand of cli.py, which has no output)
+    parser.add_argument("run_dir", help="Result directory of a training run or a model exported by inference.export")
+    parser.add_argument("input", help="JSONL file of {\"story\": ..., \"question\": ...} objects or a bAbI file")
+    if output:
+        parser.add_argument("-o", "--output", help="Output JSONL file (default: stdout)")
+    parser.add_argument("--format", choices=["jsonl", "babi"],
+                        help="Input format (default: babi for .txt files, jsonl otherwise)")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=4096,
+                        help="Number of questions read, sorted by length and predicted at once")
+    parser.add_argument("--log-probs", type=int, default=0, metavar="K",
+                        help="Also write the K most probable answers with their log-probabilities")
+    parser.add_argument("--query-cache", type=int, default=4096,
+                        help="Number of encoded questions to cache (0 disables the cache)")
+    parser.add_argument("--quantized", action="store_true",
+                        help="Use the int8 model exported by inference.quantize")
+
+
+def add_export_arguments(parser):
+    parser.add_argument("run_dir", help="Result directory of a training run")
+    parser.add_argument("-o", "--output", help="Output file (default: model_scripted.pt in the run directory)")
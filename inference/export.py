@@ -0,0 +1,224 @@
+"""
+Exports the model of a saved run as one self-contained TorchScript file.
+
+    python -m inference.export results/<run> -o qa_model.pt
+
+The file holds the scripted, frozen and optimised forward graph together with the vocabulary, the hyperparameters and
+run info of the run and, for runs with fact retrieval, the retriever (as extra files of the archive). load_exported
+neither imports main.py nor the model classes (model.QAModel, model.QAModelLSTM) and does not rebuild the model from
+params.txt.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import preprocessing.bAbIData as bd
+from inference.arguments import add_export_arguments
+from inference.predictor import Predictor, load_run, read_settings
+from preprocessing.bAbIRetrieval import FactRetriever
+
+# Extra files of the archive
+VOCABULARY_FILE = "vocabulary.json"
+RUN_INFO_FILE = "run_info.json"
+RETRIEVAL_FILE = "retrieval.npz"
+
+
+class ScriptableGRUModel(nn.Module):
+    """
+    The inference path of a trained QAModel (forward, encode_query and encode_story) in a form TorchScript can compile.
+    It uses the modules of the trained model, the training code stays as it is.
+    """
+
+    def __init__(self, model):
+        super(ScriptableGRUModel, self).__init__()
+
+        self.story_embedding = model.story_embedding
+        self.query_embedding = model.query_embedding
+        self.story_rnn = model.story_rnn
+        self.query_rnn = model.query_rnn
+        self.fc = model.fc
+        self.softmax = model.softmax
+
+        self.n_states = model.n_layers * model.n_directions
+        self.story_hidden_size = model.story_hidden_size
+        self.query_hidden_size = model.query_hidden_size
+        self.question_independent = model.question_independent
+
+    def forward(self, story, query, story_lengths, query_lengths):
+        return self.encode_story(story, story_lengths, self.encode_query(query))
+
+    @torch.jit.export
+    def encode_query(self, query):
+        hidden = torch.zeros(self.n_states, query.size(0), self.query_hidden_size, device=query.device)
+        _, hidden = self.query_rnn(self.query_embedding(query), hidden)
+
+        return hidden[0]
+
+    @torch.jit.export
+    def encode_story(self, story, story_lengths, question_code):
+        hidden = torch.zeros(self.n_states, story.size(0), self.story_hidden_size, device=story.device)
+
+        if self.question_independent:
+            packed = nn.utils.rnn.pack_padded_sequence(self.story_embedding(story), story_lengths.cpu(),
+                                                       batch_first=True)
+            _, hidden = self.story_rnn(packed, hidden)
+
+            return self.softmax(self.fc(torch.cat([hidden[0], question_code], 1)))
+
+        combined = self.story_embedding(story) + question_code.unsqueeze(1)
+        packed = nn.utils.rnn.pack_padded_sequence(combined, story_lengths.cpu(), batch_first=True)
+        _, hidden = self.story_rnn(packed, hidden)
+
+        return self.softmax(self.fc(hidden[0]))
+
+
+class ScriptableLSTMModel(nn.Module):
+    """
+    Same as ScriptableGRUModel for QAModelLSTM (like QAModelLSTM.classify, the answer is read from the cell state).
+    """
+
+    def __init__(self, model):
+        super(ScriptableLSTMModel, self).__init__()
+
+        self.story_embedding = model.story_embedding
+        self.query_embedding = model.query_embedding
+        self.story_rnn = model.story_rnn
+        self.query_rnn = model.query_rnn
+        self.fc = model.fc
+        self.softmax = model.softmax
+
+        self.n_states = model.n_layers * model.n_directions
+        self.story_hidden_size = model.story_hidden_size
+        self.query_hidden_size = model.query_hidden_size
+
+    def forward(self, story, query, story_lengths, query_lengths):
+        return self.encode_story(story, story_lengths, self.encode_query(query))
+
+    @torch.jit.export
+    def encode_query(self, query):
+        zeros = torch.zeros(self.n_states, query.size(0), self.query_hidden_size, device=query.device)
+        _, (hidden, cell) = self.query_rnn(self.query_embedding(query), (zeros, zeros))
+
+        return hidden[0]
+
+    @torch.jit.export
+    def encode_story(self, story, story_lengths, question_code):
+        zeros = torch.zeros(self.n_states, story.size(0), self.story_hidden_size, device=story.device)
+
+        combined = self.story_embedding(story) + question_code.unsqueeze(1)
+        packed = nn.utils.rnn.pack_padded_sequence(combined, story_lengths.cpu(), batch_first=True)
+        _, (hidden, cell) = self.story_rnn(packed, (zeros, zeros))
+
+        return self.softmax(self.fc(cell.view(story.size(0), self.story_hidden_size)))
+
+
+def script_model(model):
+    """
+    :return: The scripted, frozen and optimised inference graph of a QAModel or QAModelLSTM
+    """
+    scriptable = ScriptableLSTMModel(model) if isinstance(model.story_rnn, nn.LSTM) else ScriptableGRUModel(model)
+    scripted = torch.jit.script(scriptable.eval())
+
+    methods = ["encode_query", "encode_story"]
+    return torch.jit.optimize_for_inference(torch.jit.freeze(scripted, preserved_attrs=methods), methods)
+
+
+def check_scripted(model, scripted, voc_size, query_width, batch_size=16, story_length=40, seed=0):
+    """
+    Compares the scripted graph with the model on a random batch.
+
+    :return: Largest absolute difference of the log-probabilities
+    """
+    rng = np.random.RandomState(seed)
+    story_lengths = np.sort(rng.randint(1, story_length + 1, batch_size))[::-1].copy()
+    stories = rng.randint(1, voc_size, (batch_size, story_length)) * (np.arange(story_length) < story_lengths[:, None])
+    queries = rng.randint(1, voc_size, (batch_size, query_width))
+
+    inputs = [torch.from_numpy(array).long() for array in (stories, queries, story_lengths)]
+    inputs.append(torch.full((batch_size,), query_width, dtype=torch.long))
+
+    with torch.inference_mode():
+        return float((model(*inputs) - scripted(*inputs)).abs().max())
+
+
+def export_run(run_dir, path):
+    """
+    Writes the scripted model of a saved run with its vocabulary, hyperparameters, run info and retriever to path.
+
+    :return: Largest difference of the log-probabilities of model and scripted graph on a random batch
+    """
+    predictor = load_run(run_dir)
+    model = predictor.model.cpu().eval()
+    scripted = script_model(model)
+
+    query_width = predictor.query_width or 1
+    difference = check_scripted(model, scripted, len(predictor.voc), query_width)
+    if difference > 1e-4:
+        raise ValueError("The scripted model differs from the model of the run by %g" % difference)
+
+    run_info = {"settings": read_settings(os.path.join(run_dir, "params.txt")), "query_width": predictor.query_width,
+                "answer_ids": predictor.answer_ids.tolist() if predictor.answer_ids is not None else None}
+
+    extra_files = {VOCABULARY_FILE: json.dumps(predictor.voc.voc_dict), RUN_INFO_FILE: json.dumps(run_info)}
+
+    retrieval_path = os.path.join(run_dir, "retrieval.npz")
+    if os.path.isfile(retrieval_path):
+        with open(retrieval_path, "rb") as f:
+            extra_files[RETRIEVAL_FILE] = f.read()
+
+    torch.jit.save(scripted, path, _extra_files=extra_files)
+
+    return difference
+
+
+def load_exported(path, query_cache_size=0):
+    """
+    Loads a model written by export_run.
+
+    :param query_cache_size: Number of question codes to cache, 0 disables the cache
+    :return: A Predictor for the exported model (story sessions need the model classes and do not work with it)
+    """
+    extra_files = {VOCABULARY_FILE: "", RUN_INFO_FILE: "", RETRIEVAL_FILE: ""}
+    model = torch.jit.load(path, map_location="cuda" if torch.cuda.is_available() else "cpu",
+                           _extra_files=extra_files)
+
+    voc = bd.Vocabulary(vocabulary_dict=json.loads(extra_files[VOCABULARY_FILE]))
+    run_info = json.loads(extra_files[RUN_INFO_FILE])
+
+    retriever = None
+    if len(extra_files[RETRIEVAL_FILE]) > 0:
+        retriever = FactRetriever.load(io.BytesIO(extra_files[RETRIEVAL_FILE]))
+
+    return Predictor(model, voc, run_info["query_width"], query_cache_size, retriever, run_info["answer_ids"])
+
+
+def run(args):
+    path = args.output or os.path.join(args.run_dir, "model_scripted.pt")
+
+    start = time.time()
+    difference = export_run(args.run_dir, path)
+    print("Exported %s to %s in %.1fs (max. difference to the model: %.2g)" % (args.run_dir, path,
+                                                                              time.time() - start, difference))
+
+    start = time.time()
+    load_exported(path)
+    print("Loading the exported model takes %.3fs" % (time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the model of a saved run as a self-contained TorchScript "
+                                                 "file.")
+    add_export_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
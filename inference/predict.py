@@ -0,0 +1,187 @@
+"""
+Batch prediction over large files with the model of a saved run.
+
+    python -m inference.predict results/<run> questions.jsonl -o predictions.jsonl
+
+The input is either JSONL (one {"story": ..., "question": ...} object per line, an optional "id" is copied to the
+output) or a bAbI task file. It is streamed: only chunk_size questions (and, for bAbI files, the current story) are
+held in memory. Every chunk is sorted by story length and cut into batches, so batches need little padding. The
+predictions are written as JSONL in input order while the file is read.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import preprocessing.bAbIData as bd
+from inference.arguments import add_prediction_arguments
+from inference.predictor import load_run
+
+
+def iter_jsonl_questions(path, predictor):
+    """
+    :return: Generator of (record, story ids, question ids), the record holds the fields copied to the output
+    """
+    with open(path, 'r') as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+
+            instance = json.loads(line)
+            story, question = predictor.vectorize(instance["story"], instance["question"])
+            record = {"id": instance.get("id", number)}
+
+            if "answer" in instance:
+                record["truth"] = instance["answer"]
+
+            yield record, story, question
+
+
+def iter_babi_questions(path, predictor):
+    # Like iter_jsonl_questions for a bAbI file, only the facts of the current story are kept
+    facts = []
+    index = 0
+
+    with open(path, 'r') as f:
+        for text in f:
+            if not text.strip():
+                continue
+
+            number, words, answer, hints = bd.parse_line(text)
+
+            if number == 1:
+                facts = []
+
+            if answer is None:
+                facts.append(predictor.words_to_ids(words))
+            else:
+                query = predictor.words_to_ids(words)
+                yield {"id": index, "truth": answer}, predictor.story_ids(facts, query), query
+                index += 1
+
+
+def predict_chunk(predictor, chunk, batch_size, top_k=0):
+    # Predicts a chunk in length sorted batches and adds the answers (and the top_k log-probabilities) to its records
+    lengths = np.array([len(story) for _, story, _ in chunk], dtype=np.int64)
+
+    for indices in bd.LengthBucketBatchSampler(lengths, batch_size, shuffle=False):
+        stories = [chunk[i][1] for i in indices]
+        queries = [chunk[i][2] for i in indices]
+
+        if top_k > 0:
+            answers, log_probabilities = predictor.predict(stories, queries, log_probabilities=True)
+        else:
+            answers = predictor.predict(stories, queries)
+
+        words = predictor.answer_words(answers)
+
+        for j, i in enumerate(indices):
+            record = chunk[i][0]
+            record["answer"] = words[j]
+
+            if top_k > 0:
+                best = np.argsort(-log_probabilities[j])[:top_k]
+                record["log_probabilities"] = [[predictor.voc.id_to_word(int(predictor.output_ids(k))),
+                                                float(log_probabilities[j, k])] for k in best]
+
+    return [record for record, _, _ in chunk]
+
+
+def write_chunk(predictor, chunk, out, batch_size, top_k=0):
+    # Predicts and writes a chunk (out None: only counts), returns the number of questions with a known answer and how
+    # many are correct
+    known = 0
+    correct = 0
+
+    for record in predict_chunk(predictor, chunk, batch_size, top_k):
+        if out is not None:
+            out.write(json.dumps(record) + "\n")
+
+        if "truth" in record:
+            known += 1
+            correct += int(record["truth"] == record["answer"])
+
+    return known, correct
+
+
+def predict_file(predictor, path, out, file_format="jsonl", chunk_size=4096, batch_size=256, top_k=0):
+    """
+    Streams the questions of path through the predictor and writes one JSON line per question to out (None only
+    counts the correct answers).
+
+    :param file_format: "jsonl" or "babi"
+    :param top_k: Number of most probable answers written with their log-probabilities (0: only the answer)
+    :return: Number of questions, number of questions with a known answer and number of correct answers
+    """
+    if file_format == "babi":
+        questions = iter_babi_questions(path, predictor)
+    else:
+        questions = iter_jsonl_questions(path, predictor)
+
+    total = 0
+    known = 0
+    correct = 0
+    chunk = []
+
+    for question in questions:
+        chunk.append(question)
+
+        if len(chunk) >= chunk_size:
+            chunk_known, chunk_correct = write_chunk(predictor, chunk, out, batch_size, top_k)
+            total, known, correct = total + len(chunk), known + chunk_known, correct + chunk_correct
+            chunk = []
+
+    if len(chunk) > 0:
+        chunk_known, chunk_correct = write_chunk(predictor, chunk, out, batch_size, top_k)
+        total, known, correct = total + len(chunk), known + chunk_known, correct + chunk_correct
+
+    return total, known, correct
+
+
+def load_predictor(path, query_cache_size=0, quantized=False):
+    # A run directory (see load_run) or a model file written by inference.export
+    if os.path.isfile(path):
+        from inference.export import load_exported
+        return load_exported(path, query_cache_size)
+
+    return load_run(path, query_cache_size, quantized)
+
+
+def run(args, output=True):
+    # Predicts args.input with the options of add_prediction_arguments, without output only the accuracy is reported
+    file_format = args.format or ("babi" if args.input.endswith(".txt") else "jsonl")
+    predictor = load_predictor(args.run_dir, args.query_cache, args.quantized)
+    out = None
+    if output:
+        out = open(args.output, "w") if args.output else sys.stdout
+
+    start = time.time()
+    try:
+        total, known, correct = predict_file(predictor, args.input, out, file_format, args.chunk_size,
+                                             args.batch_size, args.log_probs)
+    finally:
+        if out is not None and out is not sys.stdout:
+            out.close()
+
+    seconds = time.time() - start
+    print("Predicted %d questions in %.1fs (%.0f questions/s)" % (total, seconds, total / max(seconds, 1e-9)),
+          file=sys.stderr)
+    if known > 0:
+        print("Accuracy: %d/%d (%.1f%%)" % (correct, known, 100. * correct / known), file=sys.stderr)
+    if predictor.query_cache is not None:
+        print("Query cache hit rate: %.1f%%" % (100. * predictor.query_cache.hit_rate()), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Predicts the answers of a JSONL or bAbI file with a saved run.")
+    add_prediction_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Loads a run saved by main.py's save_results (trained_model.pth, vocabulary.pkl, params.txt and, for newer runs,
+run_info.json and retrieval.npz) and answers questions with it in length sorted batches.
+"""
+from __future__ import print_function
+
+import importlib
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import preprocessing.bAbIData as bd
+from preprocessing.bAbIRetrieval import FactRetriever
+from utils.utils import create_var, cuda_model
+
+# Module of every model class. The model classes are only imported by load_run, an exported model (see
+# inference.export) is used without them.
+MODELS = {"QAModel": "model.QAModel", "QAModelLSTM": "model.QAModelLSTM"}
+
+# State dict of the dynamically quantized model, written by inference.quantize
+QUANTIZED_MODEL = "trained_model_int8.pth"
+
+
+def read_settings(path):
+    # Parses the "NAME: value" lines of the params.txt written by save_results
+    settings = {}
+
+    with open(path) as f:
+        for line in f:
+            name, separator, value = line.partition(":")
+            if separator:
+                settings[name.strip()] = value.strip()
+
+    return settings
+
+
+def quantize_model(model):
+    """
+    Dynamic int8 quantization for CPU inference: the weights of the RNNs and of the output layer are stored as int8,
+    their inputs are quantized on the fly. The embeddings are stored as uint8 with a float scale per row.
+
+    :return: A quantized copy of the model
+    """
+    from torch.ao.quantization import default_dynamic_qconfig, float_qparams_weight_only_qconfig, quantize_dynamic
+
+    return quantize_dynamic(model, {nn.Linear: default_dynamic_qconfig, nn.GRU: default_dynamic_qconfig,
+                                    nn.LSTM: default_dynamic_qconfig,
+                                    nn.Embedding: float_qparams_weight_only_qconfig}, dtype=torch.qint8)
+
+
+def pad_rows(rows, width):
+    # Zero padded matrix with one id sequence per row
+    matrix = np.zeros((len(rows), width), dtype=np.int64)
+
+    for i, row in enumerate(rows):
+        matrix[i, :len(row)] = row
+
+    return matrix
+
+
+def split_facts(words):
+    # Splits the words of a story text after every sentence mark
+    facts = [[]]
+
+    for word in words:
+        facts[-1].append(word)
+        if word in (".", "?", "!"):
+            facts.append([])
+
+    return [fact for fact in facts if len(fact) > 0]
+
+
+class Predictor:
+    """
+    Answers vectorized story/question pairs with a trained model.
+
+    Every batch is sorted by descending story length for pack_padded_sequence, the stories are padded to the longest
+    story of the batch and the queries to query_width (the padding used in training, the query RNN runs over it).
+    The answers are returned in the order of the input.
+
+    With query_cache_size > 0 the question codes are cached (see QueryCache), so the query RNN only runs for
+    questions that have not been seen recently.
+
+    Runs trained on retrieved facts have a FactRetriever, the stories are then shortened like in training. Models with
+    an output layer over a closed set of answers have answer_ids, the vocabulary id of every output.
+    """
+
+    def __init__(self, model, voc, query_width=None, query_cache_size=0, retriever=None, answer_ids=None):
+        self.model = model
+        self.voc = voc
+        self.query_width = query_width
+        self.query_cache = None
+        if query_cache_size > 0:
+            from model.QueryCache import QueryCache
+            self.query_cache = QueryCache(model, query_cache_size)
+        self.retriever = retriever
+        self.answer_ids = np.asarray(answer_ids, dtype=np.int64) if answer_ids is not None else None
+
+        self.model.eval()
+
+    def vectorize(self, story, question):
+        """
+        :param story: The story as one text or as a list of sentences
+        :param question: The question text
+        :return: id arrays of story and question. Unknown words get the <pad> id, the model has no embedding for them.
+        """
+        query = self.words_to_ids(bd.tokenize(question))
+
+        if self.retriever is None:
+            if not isinstance(story, str):
+                story = " ".join(story)
+
+            return self.words_to_ids(bd.tokenize(story)), query
+
+        if isinstance(story, str):
+            facts = split_facts(bd.tokenize(story))
+        else:
+            facts = [bd.tokenize(sentence) for sentence in story]
+
+        return self.story_ids([self.words_to_ids(fact) for fact in facts], query), query
+
+    def story_ids(self, facts, query):
+        """
+        :param facts: List of the fact id arrays of a story
+        :param query: Question ids
+        :return: The story ids, only the selected facts if the run uses fact retrieval
+        """
+        if self.retriever is not None:
+            facts = self.retriever.select(facts, query)
+
+        return np.concatenate(facts) if len(facts) > 0 else np.zeros(0, dtype=np.int64)
+
+    def words_to_ids(self, words):
+        voc_dict = self.voc.voc_dict
+        return np.fromiter((voc_dict.get(word, 0) for word in words), dtype=np.int64, count=len(words))
+
+    def predict(self, stories, queries, log_probabilities=False):
+        """
+        :param stories: List of story id arrays
+        :param queries: List of question id arrays
+        :param log_probabilities: Also return the log-probabilities of all answers
+        :return: Array of answer ids (and the log-probability matrix, one column per model output, see output_ids),
+                 in input order
+        """
+        n = len(stories)
+
+        # Empty stories are fed as a single <pad> token, packing needs at least one step
+        story_lengths = np.array([max(len(story), 1) for story in stories], dtype=np.int64)
+        query_lengths = np.array([max(len(query), 1) for query in queries], dtype=np.int64)
+
+        order = np.argsort(-story_lengths, kind='stable')
+        query_width = max(int(query_lengths.max()), self.query_width or 0)
+
+        story_matrix = pad_rows([stories[i] for i in order], int(story_lengths[order[0]]))
+        query_matrix = pad_rows([queries[i] for i in order], query_width)
+
+        forward = self.query_cache if self.query_cache is not None else self.model
+
+        with torch.inference_mode():
+            output = forward(create_var(torch.from_numpy(story_matrix)), create_var(torch.from_numpy(query_matrix)),
+                             create_var(torch.from_numpy(story_lengths[order])),
+                             create_var(torch.from_numpy(query_lengths[order])))
+            output = output.cpu().numpy()
+
+        answers = np.empty(n, dtype=np.int64)
+        answers[order] = self.output_ids(output.argmax(1))
+
+        if not log_probabilities:
+            return answers
+
+        unsorted = np.empty_like(output)
+        unsorted[order] = output
+
+        return answers, unsorted
+
+    def output_ids(self, outputs):
+        # Vocabulary ids of model outputs (columns of the log-probability matrix)
+        if self.answer_ids is None:
+            return outputs
+
+        return self.answer_ids[outputs]
+
+    def answer_words(self, answers):
+        return [self.voc.id_to_word(int(answer)) for answer in answers]
+
+
+def load_run(run_dir, query_cache_size=0, quantized=False):
+    """
+    Restores model and vocabulary of a saved run.
+
+    :param run_dir: Result directory of save_results
+    :param query_cache_size: Number of question codes to cache, 0 disables the cache
+    :param quantized: Load the int8 model exported by inference.quantize instead (CPU only)
+    :return: A Predictor for the run
+    """
+    settings = read_settings(os.path.join(run_dir, "params.txt"))
+
+    with open(os.path.join(run_dir, "vocabulary.pkl"), "rb") as f:
+        voc = bd.Vocabulary(vocabulary_dict=pickle.load(f))
+
+    # Runs saved before run_info.json existed used QAModel and queries are padded per batch for them
+    info = {}
+    info_path = os.path.join(run_dir, "run_info.json")
+    if os.path.isfile(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+
+    voc_len = int(settings["VOC_SIZE"])
+    answer_ids = info.get("answer_ids")
+    options = {"question_independent": True} if info.get("question_independent") else {}
+    model_name = info.get("model", "QAModel")
+    model_class = getattr(importlib.import_module(MODELS[model_name]), model_name)
+    model = model_class(voc_len, int(settings["EMBED_HIDDEN_SIZE"]), int(settings["STORY_HIDDEN_SIZE"]),
+                        len(answer_ids) if answer_ids is not None else voc_len, int(settings["N_LAYERS"]), **options)
+    if quantized:
+        # The quantized modules have to exist before their state can be loaded. They only have CPU kernels.
+        # The packed weights are stored as script objects, which a weights only load does not accept.
+        model = quantize_model(model)
+        model.load_state_dict(torch.load(os.path.join(run_dir, QUANTIZED_MODEL), weights_only=False))
+    else:
+        model.load_state_dict(torch.load(os.path.join(run_dir, "trained_model.pth"),
+                                         map_location=lambda storage, location: storage))
+        model = cuda_model(model)
+
+    retriever = None
+    retrieval_path = os.path.join(run_dir, "retrieval.npz")
+    if os.path.isfile(retrieval_path):
+        retriever = FactRetriever.load(retrieval_path)
+
+    return Predictor(model, voc, info.get("query_width"), query_cache_size, retriever, answer_ids)
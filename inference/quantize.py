@@ -0,0 +1,136 @@
+"""
+Exports the dynamically quantized (int8) model of a saved run for CPU inference.
+
+    python -m inference.quantize results/<run> data/tasks_1-20_v1-2/shuffled/qa1_single-supporting-fact_test.txt
+
+The quantized state dict is written to the run directory as trained_model_int8.pth, load_run(run_dir, quantized=True)
+(and the --quantized option of the predict CLI and of the server) restores it. Float and quantized model are compared on
+the test file (a bAbI or JSONL file, see inference.predict): their sizes, accuracies, the share of questions both answer
+the same way and the latencies for every batch size are written to quantization.json in the run directory.
+
+The quantized kernels only exist for the CPU, run the export on a host like the ones that serve the model.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from inference.predict import iter_babi_questions, iter_jsonl_questions
+from inference.predictor import QUANTIZED_MODEL, load_run, quantize_model
+
+
+def state_size(model):
+    # Size of the serialized state dict in bytes
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def predict_all(predictor, stories, queries, batch_size=256):
+    return np.concatenate([predictor.predict(stories[i:i + batch_size], queries[i:i + batch_size])
+                           for i in range(0, len(stories), batch_size)])
+
+
+def measure_latency(predictor, stories, queries, batch_size, max_batches=200):
+    """
+    Runs up to max_batches consecutive batches of the test questions one after another.
+
+    :return: Median and 99th percentile of the batch latency in ms and the throughput in questions per second
+    """
+    starts = list(range(0, len(stories), batch_size))[:max_batches]
+    latencies = []
+
+    # One batch to warm up
+    predictor.predict(stories[:batch_size], queries[:batch_size])
+
+    for start in starts:
+        began = time.time()
+        predictor.predict(stories[start:start + batch_size], queries[start:start + batch_size])
+        latencies.append(time.time() - began)
+
+    latencies = np.array(latencies) * 1000.
+    questions = sum(min(batch_size, len(stories) - start) for start in starts)
+
+    return {"p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99)),
+            "questions_per_s": questions / (latencies.sum() / 1000.)}
+
+
+def compare(float_predictor, quantized_predictor, path, file_format="babi", batch_sizes=(1, 64)):
+    """
+    :return: Dict with size, accuracy and latencies of both models and the agreement of their answers
+    """
+    if file_format == "babi":
+        questions = list(iter_babi_questions(path, float_predictor))
+    else:
+        questions = list(iter_jsonl_questions(path, float_predictor))
+
+    stories = [story for _, story, _ in questions]
+    queries = [query for _, _, query in questions]
+    truth = [record.get("truth") for record, _, _ in questions]
+    known = [i for i, answer in enumerate(truth) if answer is not None]
+
+    report = {"questions": len(questions)}
+    answers = {}
+
+    for name, predictor in (("float", float_predictor), ("int8", quantized_predictor)):
+        answers[name] = predict_all(predictor, stories, queries)
+        words = predictor.answer_words(answers[name])
+
+        report[name] = {
+            "size_bytes": state_size(predictor.model),
+            "accuracy": float(np.mean([words[i] == truth[i] for i in known])) if len(known) > 0 else None,
+            "latency": dict(("batch_%d" % batch_size, measure_latency(predictor, stories, queries, batch_size))
+                            for batch_size in batch_sizes)
+        }
+
+    report["agreement"] = float(np.mean(answers["float"] == answers["int8"])) if len(questions) > 0 else None
+    report["size_ratio"] = float(report["int8"]["size_bytes"]) / report["float"]["size_bytes"]
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantizes the model of a saved run and compares it to the float "
+                                                 "model.")
+    parser.add_argument("run_dir", help="Result directory of a training run")
+    parser.add_argument("test_file", help="bAbI or JSONL test file")
+    parser.add_argument("--format", choices=["jsonl", "babi"],
+                        help="Input format (default: babi for .txt files, jsonl otherwise)")
+    parser.add_argument("--batch-sizes", default="1,64", help="Comma separated batch sizes to measure the latency of")
+    args = parser.parse_args()
+
+    float_predictor = load_run(args.run_dir)
+
+    quantized_model = quantize_model(float_predictor.model)
+    torch.save(quantized_model.state_dict(), os.path.join(args.run_dir, QUANTIZED_MODEL))
+
+    # Loaded back like a serving process would
+    quantized_predictor = load_run(args.run_dir, quantized=True)
+
+    file_format = args.format or ("babi" if args.test_file.endswith(".txt") else "jsonl")
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    report = compare(float_predictor, quantized_predictor, args.test_file, file_format, batch_sizes)
+
+    with open(os.path.join(args.run_dir, "quantization.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    print("Size: %d -> %d bytes (%.0f%%)" % (report["float"]["size_bytes"], report["int8"]["size_bytes"],
+                                            100. * report["size_ratio"]))
+    if report["float"]["accuracy"] is not None:
+        print("Accuracy: %.1f%% -> %.1f%%, %.1f%% of the answers agree" % (
+            100. * report["float"]["accuracy"], 100. * report["int8"]["accuracy"], 100. * report["agreement"]))
+    for batch_size in batch_sizes:
+        key = "batch_%d" % batch_size
+        print("Batch size %d: p50 %.2f -> %.2f ms, %.0f -> %.0f questions/s" % (
+            batch_size, report["float"]["latency"][key]["p50_ms"], report["int8"]["latency"][key]["p50_ms"],
+            report["float"]["latency"][key]["questions_per_s"], report["int8"]["latency"][key]["questions_per_s"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+HTTP inference service for a saved run.
+
+    python -m inference.server results/<run> --port 8000
+
+POST /predict with {"story": "...", "question": "..."} (the story may also be a list of sentences) answers
+{"answer": "..."}, {"instances": [{"story": ..., "question": ...}, ...]} answers {"answers": [...]}.
+GET /stats returns the latency percentiles, throughput and batch sizes (and the hit rate of the query cache).
+
+Stories whose facts arrive one at a time are kept in sessions (see inference.session), which are created on first use:
+POST /sessions/<id>/facts with {"fact": "..."} or {"facts": [...]} extends the story, POST /sessions/<id>/questions
+with {"question": "..."} answers {"answer": "..."} and DELETE /sessions/<id> ends the session.
+
+Requests of concurrent clients are collected by a MicroBatcher into batches of up to max_batch_size, a batch is run at
+the latest max_latency after its first request arrived.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from inference.predictor import load_run
+from inference.session import StorySession
+
+
+class LatencyStats:
+    """
+    Thread safe request counters. The percentiles are computed over the latencies of the last window requests.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.started = time.time()
+        self.requests = 0
+        self.batches = 0
+
+    def record_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.batches += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000.
+            requests, batches = self.requests, self.batches
+
+        uptime = time.time() - self.started
+
+        return {
+            "requests": requests,
+            "batches": batches,
+            "mean_batch_size": float(requests) / batches if batches > 0 else 0.,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) > 0 else None,
+            "throughput_per_s": requests / uptime if uptime > 0 else 0.,
+            "uptime_s": uptime
+        }
+
+
+class _Request:
+    def __init__(self, story, query):
+        self.story = story
+        self.query = query
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.answer = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Runs the model in a background thread on batches of the submitted requests. A batch is closed when it has
+    max_batch_size requests or max_latency seconds after its first request arrived, whichever comes first.
+    """
+
+    def __init__(self, predictor, max_batch_size=64, max_latency=0.005, stats=None):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = stats if stats is not None else LatencyStats()
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, story, query):
+        """
+        Queues a vectorized story/question pair, wait for the answer with result().
+        """
+        request = _Request(story, query)
+        self.queue.put(request)
+        return request
+
+    @staticmethod
+    def result(request):
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.answer
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_latency
+
+        while len(batch) < self.max_batch_size:
+            # Requests that are already waiting always join the batch, only for new ones the deadline applies
+            timeout = deadline - time.time()
+
+            try:
+                if timeout <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+
+            try:
+                answers = self.predictor.predict([request.story for request in batch],
+                                                 [request.query for request in batch])
+                words = self.predictor.answer_words(answers)
+
+                for request, word in zip(batch, words):
+                    request.answer = word
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            finished = time.time()
+            for request in batch:
+                request.done.set()
+
+            self.stats.record_batch([finished - request.arrival for request in batch])
+
+
+class SessionStore:
+    """
+    Story sessions by id, the least recently used session is dropped once there are max_sessions. Every session has a
+    lock, requests to the same session are handled one after another.
+    """
+
+    def __init__(self, predictor, max_sessions=1024, max_questions=16):
+        self.predictor = predictor
+        self.max_sessions = max_sessions
+        self.max_questions = max_questions
+        self.lock = threading.Lock()
+        self.sessions = collections.OrderedDict()
+
+    def get(self, session_id):
+        # Returns the session and its lock, creating the session if needed
+        with self.lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = (StorySession(self.predictor, self.max_questions), threading.Lock())
+
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+
+    def delete(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    # The MicroBatcher and the SessionStore are set on the server by serve()
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            stats = self.server.batcher.stats.snapshot()
+
+            query_cache = self.server.batcher.predictor.query_cache
+            if query_cache is not None:
+                stats["query_cache"] = query_cache.stats()
+            stats["sessions"] = len(self.server.sessions)
+
+            self._send_json(200, stats)
+        else:
+            self._send_json(404, {"error": "unknown path %s" % self.path})
+
+    def _session_path(self):
+        # (session id, action) of /sessions/<id>[/<action>] paths, None otherwise
+        parts = self.path.strip("/").split("/")
+
+        if len(parts) in (2, 3) and parts[0] == "sessions" and parts[1]:
+            return parts[1], parts[2] if len(parts) == 3 else None
+
+        return None
+
+    def do_DELETE(self):
+        session_path = self._session_path()
+
+        if session_path is None or session_path[1] is not None:
+            self._send_json(404, {"error": "unknown path %s" % self.path})
+        elif self.server.sessions.delete(session_path[0]):
+            self._send_json(200, {"deleted": session_path[0]})
+        else:
+            self._send_json(404, {"error": "unknown session %s" % session_path[0]})
+
+    def _post_session(self, session_id, action):
+        try:
+            content = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+
+            if action == "facts":
+                facts = content["facts"] if "facts" in content else [content["fact"]]
+                if not isinstance(facts, list) or not all(isinstance(fact, str) for fact in facts):
+                    raise TypeError("the facts have to be a list of strings")
+            elif action == "questions":
+                question = content["question"]
+                if not isinstance(question, str):
+                    raise TypeError("the question has to be a string")
+            else:
+                self._send_json(404, {"error": "unknown path %s" % self.path})
+                return
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": "bad request: %r" % e})
+            return
+
+        try:
+            session, lock = self.server.sessions.get(session_id)
+        except ValueError as e:
+            # The model of the run does not support sessions
+            self._send_json(400, {"error": str(e)})
+            return
+
+        try:
+            with lock:
+                if action == "facts":
+                    words = session.n_words
+                    for fact in facts:
+                        words = session.add_fact(fact)
+
+                    result = {"words": words}
+                else:
+                    result = {"answer": session.ask(question)}
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+
+        self._send_json(200, result)
+
+    def do_POST(self):
+        session_path = self._session_path()
+        if session_path is not None and session_path[1] is not None:
+            self._post_session(*session_path)
+            return
+
+        if self.path != "/predict":
+            self._send_json(404, {"error": "unknown path %s" % self.path})
+            return
+
+        batcher = self.server.batcher
+
+        try:
+            content = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            instances = content["instances"] if "instances" in content else [content]
+            requests = [batcher.submit(*batcher.predictor.vectorize(instance["story"], instance["question"]))
+                        for instance in instances]
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": "bad request: %r" % e})
+            return
+
+        try:
+            answers = [batcher.result(request) for request in requests]
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+
+        if "instances" in content:
+            self._send_json(200, {"answers": answers})
+        else:
+            self._send_json(200, {"answer": answers[0]})
+
+    def log_message(self, format, *args):
+        # Per-request logging would dominate the latency, /stats has the numbers
+        pass
+
+
+def serve(run_dir, host="127.0.0.1", port=8000, max_batch_size=64, max_latency=0.005, query_cache_size=4096,
+          quantized=False):
+    predictor = load_run(run_dir, query_cache_size, quantized)
+
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(predictor, max_batch_size, max_latency)
+    server.sessions = SessionStore(predictor)
+
+    print("Serving %s on http://%s:%d" % (run_dir, host, server.server_address[1]))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a trained model of a saved run over HTTP.")
+    parser.add_argument("run_dir", help="Result directory of a training run")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-latency-ms", type=float, default=5.,
+                        help="Longest time a request waits for further requests to batch with")
+    parser.add_argument("--query-cache", type=int, default=4096,
+                        help="Number of encoded questions to cache (0 disables the cache)")
+    parser.add_argument("--quantized", action="store_true",
+                        help="Use the int8 model exported by inference.quantize")
+    args = parser.parse_args()
+
+    server = serve(args.run_dir, args.host, args.port, args.max_batch_size, args.max_latency_ms / 1000.,
+                   args.query_cache, args.quantized)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Stateful story sessions for facts that arrive one at a time.
+
+The story RNN reads the story words together with the question code, so its state depends on the question. A
+StorySession keeps one story RNN state per active question (the questions asked recently) and advances all of them by
+the words of every new fact in a single batch. Answering an active question only runs the classifier on its state, so
+the cost of a fact and of an answer does not grow with the length of the story. A question that is not active yet is
+encoded over the story so far once and is kept up to date from then on.
+
+Only unidirectional models work this way, a backward RNN would have to read the whole story again.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+import preprocessing.bAbIData as bd
+from inference.predictor import pad_rows
+from utils.utils import create_var
+
+
+def _cat_hidden(states):
+    # Concatenates RNN states (tensors for GRUs, (h, c) tuples for LSTMs) along the batch dimension
+    if isinstance(states[0], tuple):
+        return tuple(torch.cat(parts, 1) for parts in zip(*states))
+
+    return torch.cat(states, 1)
+
+
+def _split_hidden(state):
+    # Inverse of _cat_hidden for states of batch size 1
+    if isinstance(state, tuple):
+        return list(zip(*[torch.split(part, 1, 1) for part in state]))
+
+    return list(torch.split(state, 1, 1))
+
+
+class StorySession:
+    """
+    One story that grows fact by fact, with the questions asked about it.
+
+    :param predictor: Predictor of a saved run (see inference.predictor.load_run). Its query cache is not used, it
+                      is not thread safe and sessions may be used next to a MicroBatcher.
+    :param max_questions: Number of questions whose story state is kept up to date, the least recently asked question
+                          is dropped first
+    """
+
+    def __init__(self, predictor, max_questions=16):
+        if not hasattr(predictor.model, "advance_story"):
+            raise ValueError("Story sessions need the model classes, they do not work with exported models")
+        if predictor.model.n_directions != 1:
+            raise ValueError("Story sessions need a unidirectional model")
+        if getattr(predictor.model, "question_independent", False):
+            raise ValueError("Story sessions are not supported for question independent models")
+        if predictor.retriever is not None:
+            raise ValueError("Story sessions are not supported for runs with fact retrieval")
+
+        self.predictor = predictor
+        self.model = predictor.model
+        self.max_questions = max_questions
+
+        self.facts = []
+        self.n_words = 0
+        # Question key -> [question code, story RNN state (None while the story is empty)]
+        self.questions = OrderedDict()
+
+    def add_fact(self, fact):
+        """
+        Appends a fact (text) to the story and advances the states of all active questions by its words.
+
+        :return: Number of words of the story
+        """
+        ids = self.predictor.words_to_ids(bd.tokenize(fact))
+        if len(ids) == 0:
+            return self.n_words
+
+        self.facts.append(ids)
+        self.n_words += len(ids)
+
+        if len(self.questions) > 0:
+            entries = list(self.questions.values())
+            codes = torch.stack([code for code, _ in entries])
+            words = create_var(torch.from_numpy(np.tile(ids, (len(entries), 1))))
+
+            with torch.inference_mode():
+                if entries[0][1] is None:
+                    # All states are None while the story is empty
+                    states = _split_hidden(self.model.advance_story(words, codes))
+                else:
+                    states = _split_hidden(self.model.advance_story(words, codes,
+                                                                    _cat_hidden([state for _, state in entries])))
+
+            for entry, state in zip(entries, states):
+                entry[1] = state
+
+        return self.n_words
+
+    def ask(self, question, log_probabilities=False):
+        """
+        Answers a question (text) about the story so far.
+
+        :return: The answer word (and the log-probabilities of all answers)
+        """
+        ids = self.predictor.words_to_ids(bd.tokenize(question))
+        key = ids.tobytes()
+
+        with torch.inference_mode():
+            if key not in self.questions:
+                self._activate(key, ids)
+
+            self.questions.move_to_end(key)
+            code, state = self.questions[key]
+
+            if state is None:
+                # Like the Predictor, an empty story is read as a single <pad> word
+                state = self.model.advance_story(create_var(torch.zeros(1, 1).long()), code.view(1, -1))
+
+            output = self.model.classify(state)[0].cpu().numpy()
+
+        answer = self.predictor.voc.id_to_word(int(self.predictor.output_ids(output.argmax())))
+
+        if log_probabilities:
+            return answer, output
+
+        return answer
+
+    def _activate(self, key, ids):
+        # Encodes a new question and reads the story so far with its code
+        query = pad_rows([ids], max(len(ids), 1, self.predictor.query_width or 0))
+        code = self.model.encode_query(create_var(torch.from_numpy(query)))[0]
+
+        state = None
+        if self.n_words > 0:
+            story = create_var(torch.from_numpy(np.concatenate(self.facts)).view(1, -1))
+            state = self.model.advance_story(story, code.view(1, -1))
+
+        self.questions[key] = [code, state]
+
+        while len(self.questions) > self.max_questions:
+            self.questions.popitem(last=False)
+
+    def reset(self):
+        # Starts a new story, the questions stay active
+        self.facts = []
+        self.n_words = 0
+
+        for entry in self.questions.values():
+            entry[1] = None
@@ -1,24 +1,32 @@
 from __future__ import print_function
 
+import json
+import math
 import os
 import pickle
 import sys
 import time
 from functools import reduce
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.multiprocessing as multiprocessing
 import torch.nn as nn
-from torch.autograd import Variable
 from torch.utils.data import DataLoader
 
 import preprocessing.bAbIData as bd
+import preprocessing.bAbICache as cache
+import preprocessing.bAbIMemmap as bm
+import preprocessing.bAbIRetrieval as br
+import model.Word2VecEmbedding as w2v
 from model.QAModel import QAModel
 from model.QAModelLSTM import  QAModelLSTM
+from utils.checkpoint import GridManifest, load_checkpoint, run_directory, save_checkpoint
+from utils.schedule import EvaluationSchedule
 from utils.utils import create_var, time_since, cuda_model
-import pandas as pd
 
+# matplotlib and pandas are imported where they are used: they are slow to import and only needed for the result
+# files and plots, not to evaluate or to predict (see cli.py)
 
 
 def main(task_i):
@@ -60,6 +68,28 @@ def main(task_i):
     PREVIOUSLY_TRAINED_MODEL = None
     ONLY_EVALUATE = False
 
+    # Parsed and vectorized data is cached here, set to None to always parse the text files
+    DATA_CACHE_DIR = "data/cache"
+    # For corpora that do not fit into memory: converted once into this directory and read through memory maps
+    MEMMAP_DATA_DIR = None
+    LOADER_WORKERS = 0
+
+    # Number of processes that train param sets in parallel (1 trains them one after another in this process) and
+    # torch threads per process (None splits the cores evenly)
+    GRID_WORKERS = 1
+    GRID_WORKER_THREADS = None
+
+    # "grid" trains every param set for its full epochs. "halving" trains all of them for HALVING_MIN_EPOCHS and
+    # continues only the best 1/HALVING_ETA, with HALVING_ETA times the epochs, until the rest is trained to the end.
+    SEARCH_MODE = "grid"
+    HALVING_MIN_EPOCHS = 5
+    HALVING_ETA = 2
+
+    # The training state is checkpointed every CHECKPOINT_EVERY epochs (None: only where needed for halving) into a run
+    # directory under results/, next to a manifest of the finished param sets. Starting the same run again skips the
+    # finished param sets and resumes the interrupted one. Delete the run directory to start over.
+    CHECKPOINT_EVERY = 1
+
     ## GridSearch Parameters
     EPOCHS = [40]  # Mostly you only want one epoch param, unless you want equal models with different training times.
     EMBED_HIDDEN_SIZES = [50]
@@ -68,6 +98,33 @@ def main(task_i):
     BATCH_SIZE = [16]
     LEARNING_RATE = [0.001]  # 0.0001
 
+    # Batch size for evaluating on the test set
+    EVAL_BATCH_SIZE = 512
+
+    # Trains the question independent encoder (QAModel.old_forward) on whole stories: the story RNN reads every story
+    # once for all of its questions. The batch sizes then count stories instead of questions.
+    MULTI_QUESTION = False
+    # Shortens every story to the RETRIEVE_FACTS facts most relevant to its question (see bAbIRetrieval), None keeps
+    # the whole stories. With RETRIEVAL_TRAINED the relevance weights are learned from the supporting facts of the
+    # training set, otherwise hand set weights are used.
+    RETRIEVE_FACTS = None
+    RETRIEVAL_TRAINED = True
+    # The output layer only covers the answers of the training set instead of the whole vocabulary. Set to False to
+    # continue the training of models with an output over the vocabulary (PREVIOUSLY_TRAINED_MODEL).
+    RESTRICT_ANSWERS = True
+    # Initialises the (shared) story and query embedding of QAModel with word2vec (see Word2VecEmbedding): "corpus"
+    # trains it on the training corpus of the task, a directory loads the embedding.tensor and vocabulary.pickle that
+    # Word2VecEmbedding.main wrote there (its size has to be in EMBED_HIDDEN_SIZES). None: random embeddings.
+    WORD2VEC_EMBEDDING = None
+    # The full test set is evaluated every EVAL_EVERY epochs and after the last one, in between on a stratified
+    # subsample of EVAL_SUBSAMPLE test instances (None: no evaluation in between).
+    EVAL_EVERY = 1
+    EVAL_SUBSAMPLE = None
+    # Stop early once the test accuracy reaches TARGET_ACCURACY (in %) or the test loss did not improve for PATIENCE
+    # full evaluations. None disables the criterion.
+    TARGET_ACCURACY = None
+    PATIENCE = None
+
     ## Output parameters
     # Makes the training halt between every param set until you close the plot windows. Plots are saved either way.
     PLOT_LOSS_INTERACTIVE = False
@@ -76,68 +133,302 @@ def main(task_i):
     grid_search_params = GridSearchParamDict(EMBED_HIDDEN_SIZES, STORY_HIDDEN_SIZE, N_LAYERS, BATCH_SIZE, LEARNING_RATE,
                                              EPOCHS)
 
-    voc, train_instances, test_instances = load_data(babi_voc_path[BABI_TASK], babi_train_path[BABI_TASK],
-                                                     babi_test_path[BABI_TASK])
+    # Loads the data and converts the words of the corpora from string representation to integer representation
+    # using the vocabulary. Repeated runs load the vectorized corpora from DATA_CACHE_DIR.
+    if MEMMAP_DATA_DIR is not None:
+        voc, train_dir, test_dir = bm.load_or_convert(babi_voc_path[BABI_TASK], babi_train_path[BABI_TASK],
+                                                      babi_test_path[BABI_TASK], MEMMAP_DATA_DIR)
+        train_corpus, test_corpus = bm.BAbiMemmapDataset(train_dir), bm.BAbiMemmapDataset(test_dir)
+    else:
+        voc, train_corpus, test_corpus = load_vectorized_data(babi_voc_path[BABI_TASK], babi_train_path[BABI_TASK],
+                                                              babi_test_path[BABI_TASK], cache_dir=DATA_CACHE_DIR)
+
+    embedding_weights = None
+    if WORD2VEC_EMBEDDING is not None:
+        embedding_weights = prepare_embeddings(WORD2VEC_EMBEDDING, train_corpus, voc, EMBED_HIDDEN_SIZES)
+
+    retriever = None
+    if RETRIEVE_FACTS is not None:
+        retriever, train_corpus, test_corpus = prepare_retrieval(train_corpus, test_corpus, len(voc), RETRIEVE_FACTS,
+                                                                 RETRIEVAL_TRAINED)
+
+    answer_index = None
+    if RESTRICT_ANSWERS:
+        answer_index = prepare_answer_index(train_corpus, test_corpus, len(voc))
+
+    # The datasets are built once and shared by all param sets (and by the grid workers)
+    train_data, test_data = prepare_datasets(train_corpus, test_corpus, multi_question=MULTI_QUESTION)
+    voc_len = len(voc)
+
+    training_options = {
+        "previously_trained_model": PREVIOUSLY_TRAINED_MODEL,
+        "only_evaluate": ONLY_EVALUATE,
+        "print_loss": PRINT_BATCHWISE_LOSS,
+        "num_workers": LOADER_WORKERS,
+        "eval_batch_size": EVAL_BATCH_SIZE,
+        "schedule": EvaluationSchedule(EVAL_EVERY, EVAL_SUBSAMPLE, TARGET_ACCURACY, PATIENCE),
+        "output_size": len(answer_index) if answer_index is not None else voc_len,
+        "embedding_weights": embedding_weights,
+        "checkpoint_every": CHECKPOINT_EVERY
+    }
 
-    # Converts the words of the instances from string representation to integer representation using the vocabulary.
-    vectorize_data(voc, train_instances, test_instances)
+    # Options that change the data or the model go into the name or into the hashed run options, so their checkpoints
+    # are never mixed up. The data files are identified by their paths, sizes and modification times.
+    run_name = SEARCH_MODE + "_task_" + str(BABI_TASK)
+    run_options = {"data": cache.cache_key([babi_voc_path[BABI_TASK], babi_train_path[BABI_TASK],
+                                            babi_test_path[BABI_TASK]])}
+    if MEMMAP_DATA_DIR is not None:
+        # The vocabulary of a memory mapped corpus has different ids
+        run_name += "_memmap"
+    if retriever is not None:
+        run_name += "_facts_" + str(RETRIEVE_FACTS) + ("_trained" if RETRIEVAL_TRAINED else "")
+    if MULTI_QUESTION:
+        run_name += "_stories"
+    if answer_index is not None:
+        run_name += "_answers_" + str(len(answer_index))
+    if embedding_weights is not None:
+        run_name += "_word2vec"
+        run_options["word2vec"] = WORD2VEC_EMBEDDING
+        if WORD2VEC_EMBEDDING != "corpus":
+            run_options["word2vec"] = cache.cache_key([os.path.join(WORD2VEC_EMBEDDING, "embedding.tensor"),
+                                                       os.path.join(WORD2VEC_EMBEDDING, "vocabulary.pickle")])
+    run_dir = run_directory("results", run_name, grid_search_params.params, run_options)
+    manifest = GridManifest(os.path.join(run_dir, "manifest.json"))
+
+    pending = [(i, param_dict) for i, param_dict in enumerate(grid_search_params) if not manifest.is_done(param_dict)]
+    if len(pending) < len(grid_search_params):
+        print('Skipping %d finished param sets of %s' % (len(grid_search_params) - len(pending), run_dir))
+
+    if SEARCH_MODE == "halving":
+        # The halving rounds are always run for all param sets (finished ones are restored from their checkpoints)
+        results = successive_halving(grid_search_params, voc_len, train_data, test_data, run_dir,
+                                     min_epochs=HALVING_MIN_EPOCHS, eta=HALVING_ETA, **training_options)
+    elif GRID_WORKERS > 1:
+        # Loader workers can not be started from the (daemonic) grid workers
+        training_options["num_workers"] = 0
+        results = run_grid_parallel(pending, voc_len, train_data, test_data, training_options, run_dir,
+                                    workers=GRID_WORKERS, threads_per_worker=GRID_WORKER_THREADS)
+    else:
+        results = ((i, param_dict, run_config(param_dict, voc_len, train_data, test_data,
+                                              checkpoint_path=checkpoint_file(run_dir, i, CHECKPOINT_EVERY),
+                                              **training_options))
+                   for i, param_dict in pending)
+
+    # Results are saved as soon as a param set is finished
+    for i, param_dict, (model, readable_params, train_loss, test_loss, train_acc, test_acc, eval_lists) in results:
+        if manifest.is_done(param_dict):
+            continue
+
+        print('\nXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX\nFinished Param-Set: %d of %d' % (
+            i + 1, len(grid_search_params)))
 
-    for i, param_dict in enumerate(grid_search_params):
-        print('\nXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX\nParam-Set: %d of %d' % (i + 1, len(grid_search_params)))
+        evaluated_out = evaluate_outputs(eval_lists, voc)
+        params = [param_dict["embedding_size"], param_dict["story_hidden_size"], param_dict["layers"],
+                  param_dict["batch_size"], param_dict["epochs"], voc_len, param_dict["learning_rate"],
+                  param_dict["epochs"]]
+        result_dir = save_results(BABI_TASK, train_loss, test_loss, params, train_acc, test_acc, readable_params,
+                                  model, voc, evaluated_out,
+                                  run_info={"model": type(model).__name__, "query_width": train_data.maxlen_question,
+                                            "question_independent": getattr(model, "question_independent", False),
+                                            "answer_ids": answer_index.answer_ids.tolist()
+                                            if answer_index is not None else None})
+        # The predictor of the run selects the facts of its stories the same way
+        if retriever is not None:
+            retriever.save(os.path.join(result_dir, "retrieval.npz"))
+        manifest.mark_done(param_dict, result_dir)
 
-        embedding_size = param_dict["embedding_size"]
-        story_hidden_size = param_dict["story_hidden_size"]
-        n_layers = param_dict["layers"]
-        learning_rate = param_dict["learning_rate"]
-        batch_size = param_dict["batch_size"]
-        epochs = param_dict["epochs"]
-        voc_len = len(voc)
+        # Plot Loss
+        if PLOT_LOSS_INTERACTIVE:
+            plot_data_in_window(train_loss, test_loss, train_acc, test_acc)
 
-        ## Print setting
-        readable_params = '\nSettings:\nEMBED_HIDDEN_SIZE: %d\nSTORY_HIDDEN_SIZE: %d\nN_LAYERS: %d\nBATCH_SIZE: ' \
-                          '%d\nEPOCHS: %d\nVOC_SIZE: %d\nLEARNING_RATE: %f\n' % (
-                              embedding_size, story_hidden_size, n_layers, batch_size, epochs, voc_len, learning_rate)
 
-        print(readable_params)
+def checkpoint_file(run_dir, index, checkpoint_every):
+    # Checkpoint of the param set with the given index, None if checkpoints are disabled
+    if checkpoint_every is None:
+        return None
+
+    return os.path.join(run_dir, "config_%d.pth" % index)
+
+
+def run_config(param_dict, voc_len, train_data, test_data, previously_trained_model=None, only_evaluate=False,
+               print_loss=False, num_workers=0, eval_batch_size=None, schedule=None, checkpoint_path=None,
+               checkpoint_every=None, output_size=None, embedding_weights=None, epochs=None):
+    """
+    Trains and evaluates the model for one param set of the grid. If there is a checkpoint at checkpoint_path, the
+    training is resumed from it.
+
+    :param embedding_weights: Dict of initial embedding weights by embedding size (see prepare_embeddings)
+    :param epochs: Train only up to this epoch instead of param_dict["epochs"] (used by successive_halving, which
+                   resumes the param set from its checkpoint in the next round)
+
+    :return: The model, the readable settings and the histories and evaluation lists of conduct_training
+    """
+    readable_params = readable_settings(param_dict, voc_len)
+    print(readable_params)
+
+    train_loader, test_loader = prepare_dataloaders(train_data, test_data, param_dict["batch_size"],
+                                                    num_workers=num_workers, eval_batch_size=eval_batch_size)
+    subsample_loader = prepare_subsample_loader(test_loader, schedule, eval_batch_size or param_dict["batch_size"])
 
-        train_loader, test_loader = prepare_dataloaders(train_instances, test_instances, batch_size)
+    # Story level datasets are trained with the question independent model
+    model, optimizer = build_model(param_dict, voc_len, previously_trained_model,
+                                   isinstance(train_data, bd.BAbiStoryDataset), output_size, embedding_weights)
+    criterion = nn.NLLLoss()
 
-        ## Initialize Model and Optimizer
-        model = QAModel(voc_len, embedding_size, story_hidden_size, voc_len, n_layers)
-        model = cuda_model(model)
-        # If a path to a state dict of a previously trained model is given, the state will be loaded here.
-        if PREVIOUSLY_TRAINED_MODEL is not None:
-            model.load_state_dict(torch.load(PREVIOUSLY_TRAINED_MODEL))
+    train_loss, test_loss, train_acc, test_acc, eval_lists = conduct_training(model, train_loader, test_loader,
+                                                                              optimizer, criterion,
+                                                                              only_evaluate=only_evaluate,
+                                                                              print_loss=print_loss,
+                                                                              epochs=epochs or param_dict["epochs"],
+                                                                              subsample_loader=subsample_loader,
+                                                                              schedule=schedule,
+                                                                              checkpoint_path=checkpoint_path,
+                                                                              checkpoint_every=checkpoint_every)
 
-        optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-        criterion = nn.NLLLoss()
+    return model, readable_params, train_loss, test_loss, train_acc, test_acc, eval_lists
 
-        train_loss, test_loss, train_acc, test_acc, eval_lists = conduct_training(model, train_loader, test_loader, optimizer,
-                                                                      criterion, only_evaluate=ONLY_EVALUATE,
-                                                                      print_loss=PRINT_BATCHWISE_LOSS, epochs=epochs)
 
-        evaluated_out = evaluate_outputs(eval_lists, voc)
-        params = [embedding_size, story_hidden_size, n_layers, batch_size, epochs, voc_len, learning_rate, epochs]
-        save_results(BABI_TASK, train_loss, test_loss, params, train_acc, test_acc, readable_params, model, voc, evaluated_out)
+def readable_settings(param_dict, voc_len):
+    return '\nSettings:\nEMBED_HIDDEN_SIZE: %d\nSTORY_HIDDEN_SIZE: %d\nN_LAYERS: %d\nBATCH_SIZE: ' \
+           '%d\nEPOCHS: %d\nVOC_SIZE: %d\nLEARNING_RATE: %f\n' % (
+               param_dict["embedding_size"], param_dict["story_hidden_size"], param_dict["layers"],
+               param_dict["batch_size"], param_dict["epochs"], voc_len, param_dict["learning_rate"])
 
-        # Plot Loss
-        if PLOT_LOSS_INTERACTIVE:
-            plot_data_in_window(train_loss, test_loss, train_acc, test_acc)
+
+def build_model(param_dict, voc_len, previously_trained_model=None, question_independent=False, output_size=None,
+                embedding_weights=None):
+    ## Initialize Model and Optimizer
+    # output_size is the number of answer candidates (default: the vocabulary, see bAbIData.AnswerIndex)
+    # embedding_weights maps embedding sizes to pretrained weights, every model trains its own copy of them
+    custom_embedding = None
+    if embedding_weights is not None:
+        custom_embedding = nn.Embedding.from_pretrained(embedding_weights[param_dict["embedding_size"]].clone(),
+                                                        freeze=False)
+
+    model = QAModel(voc_len, param_dict["embedding_size"], param_dict["story_hidden_size"], output_size or voc_len,
+                    param_dict["layers"], custom_embedding=custom_embedding,
+                    question_independent=question_independent)
+    model = cuda_model(model)
+    # If a path to a state dict of a previously trained model is given, the state will be loaded here.
+    if previously_trained_model is not None:
+        model.load_state_dict(torch.load(previously_trained_model))
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=param_dict["learning_rate"])
+
+    return model, optimizer
+
+
+def successive_halving(grid_search_params, voc_len, train_data, test_data, checkpoint_dir, min_epochs=5, eta=2,
+                       previously_trained_model=None, only_evaluate=False, print_loss=False, num_workers=0,
+                       eval_batch_size=None, schedule=None, checkpoint_every=None, output_size=None,
+                       embedding_weights=None):
+    """
+    Successive halving search over the grid. All param sets are trained for min_epochs, then only the best 1/eta of
+    them (by test accuracy) are trained further, for eta times as many epochs, and so on. The last remaining param
+    sets are trained for their full number of epochs. Every param set is checkpointed in checkpoint_dir after each
+    round, so the survivors continue where they stopped.
+
+    :return: Generator of (index, param_dict, result like run_config) for the param sets that were trained to the end
+    """
+    survivors = list(range(len(grid_search_params)))
+    max_epochs = max(param_dict["epochs"] for param_dict in grid_search_params)
+    budget = min_epochs
+
+    while True:
+        last_round = len(survivors) <= 1 or budget >= max_epochs
+        accuracies = {}
+
+        print('\nSuccessive halving: %d param sets, %s epochs' % (len(survivors),
+                                                                  "all" if last_round else str(budget)))
+
+        for i in survivors:
+            param_dict = grid_search_params[i]
+            epochs = param_dict["epochs"] if last_round else min(budget, param_dict["epochs"])
+
+            # The checkpoint is always written after the last epoch of the round, so the next round resumes from it
+            result = run_config(param_dict, voc_len, train_data, test_data, previously_trained_model, only_evaluate,
+                                print_loss, num_workers, eval_batch_size, schedule,
+                                os.path.join(checkpoint_dir, "config_%d.pth" % i), checkpoint_every, output_size,
+                                embedding_weights, epochs)
+            test_acc = result[5]
+            accuracies[i] = test_acc[-1] if len(test_acc) > 0 else 0.
+
+            if last_round:
+                yield i, param_dict, result
+
+        if last_round:
+            return
+
+        ranked = sorted(survivors, key=lambda i: accuracies[i], reverse=True)
+        survivors = ranked[:max(1, int(math.ceil(len(ranked) / float(eta))))]
+        print('Kept param sets %s, pruned %s' % ([i + 1 for i in survivors],
+                                                 [i + 1 for i in ranked[len(survivors):]]))
+        budget *= eta
+
+
+# State of a grid worker process, set once by _init_grid_worker
+_grid_worker_state = {}
+
+
+def _init_grid_worker(voc_len, train_data, test_data, training_options, run_dir, threads):
+    torch.set_num_threads(threads)
+    _grid_worker_state.update(voc_len=voc_len, train_data=train_data, test_data=test_data,
+                              training_options=training_options, run_dir=run_dir)
+
+
+def _run_grid_job(job):
+    i, param_dict = job
+    state = _grid_worker_state
+    checkpoint_path = checkpoint_file(state["run_dir"], i, state["training_options"].get("checkpoint_every"))
+
+    result = run_config(param_dict, state["voc_len"], state["train_data"], state["test_data"],
+                        checkpoint_path=checkpoint_path, **state["training_options"])
+
+    model = result[0].cpu()
+    return i, param_dict, (model,) + result[1:]
+
+
+def run_grid_parallel(param_sets, voc_len, train_data, test_data, training_options, run_dir, workers=2,
+                      threads_per_worker=None):
+    """
+    Runs param sets of the grid in a pool of worker processes.
+
+    :param param_sets: List of (index, param_dict) to run, the index names the checkpoint in run_dir
+
+    The tensors of the datasets are moved into shared memory once, so all workers read the same physical pages.
+    Every worker limits torch to threads_per_worker threads (by default the cores are split evenly between the
+    workers).
+
+    :return: Generator of (index, param_dict, result of run_config), in the order the param sets finish
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, multiprocessing.cpu_count() // workers)
+
+    for dataset in (train_data, test_data):
+        if isinstance(dataset, (bd.BAbiTensorDataset, bd.BAbiStoryDataset)):
+            dataset.share_memory_()
+
+    context = multiprocessing.get_context("spawn")
+    pool = context.Pool(workers, initializer=_init_grid_worker,
+                        initargs=(voc_len, train_data, test_data, training_options, run_dir, threads_per_worker))
+
+    try:
+        for result in pool.imap_unordered(_run_grid_job, list(param_sets)):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
 
 
 def replace_to_text_vec(ids_vector, voc):
-    st_list = []
-    for i in range(len(ids_vector)):
-        vec = ids_vector[i, :]
-        vec = vec.tolist()
-        vec = [voc.id_to_word(item)  for item in vec]
-        st = ' '.join(vec)
-        st_list.append(st)
-    return st_list
+    return voc.ids_to_text(ids_vector)
 
 def evaluate_outputs(eval_lists, voc):
-    # Merge Batches
-    stories = np.vstack([x[1] for x in eval_lists])
+    import pandas as pd
+
+    # Merge Batches (stories are only padded per batch, so pad them to a common width first)
+    story_width = max(x[1].shape[1] for x in eval_lists)
+    stories = np.vstack([np.pad(x[1], ((0, 0), (0, story_width - x[1].shape[1])), mode='constant') for x in eval_lists])
     GT = np.hstack([x[2] for x in eval_lists])
     story_l = np.hstack([x[3] for x in eval_lists])
     query_l = np.hstack([x[4] for x in eval_lists])
@@ -161,7 +452,8 @@ def train(model, train_loader, optimizer, criterion, start, epoch, print_loss=Fa
     correct = 0
     train_loss_history = []
 
-    train_data_size = len(train_loader.dataset)
+    train_data_size = number_of_questions(train_loader)
+    seen = 0
 
     # Set model in training mode
     model.train()
@@ -170,31 +462,19 @@ def train(model, train_loader, optimizer, criterion, start, epoch, print_loss=Fa
     # Batch size is 32 training samples and stories are padded to 66 words (each represented by an integer for the
     # vocabulary index)
     # The stories parameter will contain a tensor of size 32x66. Likewise for the other parameters
-    for i, (stories, queries, answers, sl, ql) in enumerate(train_loader, 1):
-
-        stories = create_var(stories.type(torch.LongTensor))
-        queries = create_var(queries.type(torch.LongTensor))
-        answers = create_var(answers.type(torch.LongTensor))
-        sl = create_var(sl.type(torch.LongTensor))
-        ql = create_var(ql.type(torch.LongTensor))
+    for i, batch in enumerate(train_loader, 1):
 
-        # Sort stories by their length (because of packing in the forward step!)
-        sl, perm_idx = sl.sort(0, descending=True)
-        stories = stories[perm_idx]
-        ql = ql[perm_idx]
-        queries = queries[perm_idx]
-        answers = answers[perm_idx]
-
-        output = model(stories, queries, sl, ql)
-
-        answers_flat = answers.view(-1)
+        # The batches already are sorted by story length (because of packing in the forward step!),
+        # see LengthBucketBatchSampler
+        output, answers, batch = forward_batch(model, batch)
+        seen += answers.size(0)
 
         loss = criterion(output, answers)
 
-        total_loss += loss.data[0]
+        total_loss += loss.item()
 
         # Calculating elementwise loss per batch
-        train_loss_history.append(loss.data[0])
+        train_loss_history.append(loss.item())
 
         model.zero_grad()
         loss.backward()
@@ -202,16 +482,14 @@ def train(model, train_loader, optimizer, criterion, start, epoch, print_loss=Fa
 
         if print_loss:
             if i % 1 == 0:
-                print('[{}] Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.2f}'.format(time_since(start), epoch,
-                                                                                    i * len(stories),
-                                                                                    len(train_loader.dataset),
-                                                                                    100. * i * len(stories) / len(
-                                                                                        train_loader.dataset),
-                                                                                    loss.data[0]))
+                print('[{}] Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.2f}'.format(time_since(start), epoch, seen,
+                                                                                    train_data_size,
+                                                                                    100. * seen / train_data_size,
+                                                                                    loss.item()))
 
         pred_answers = output.data.max(1)[1]
         correct += pred_answers.eq(
-            answers.data.view_as(pred_answers)).cpu().sum()  # calculate how many labels are correct
+            answers.data.view_as(pred_answers)).cpu().sum().item()  # calculate how many labels are correct
 
     accuracy = 100. * correct / train_data_size
 
@@ -220,64 +498,235 @@ def train(model, train_loader, optimizer, criterion, start, epoch, print_loss=Fa
     return train_loss_history, accuracy, total_loss  # loss per epoch
 
 
-def test(model, test_loader, criterion, PRINT_LOSS=False):
-    model.eval()
+def forward_batch(model, batch):
+    """
+    Moves a batch to the device and runs the model on it. Batches of a StoryBatchLoader (whole stories with all of their
+    questions, 7 tensors) go through multi_question_forward, the question batches of the other loaders through forward.
+
+    :return: Model output, answers and the batch on the device
+    """
+    # Batches already are int64 tensors (see BAbiTensorDataset), no cast needed
+    batch = [create_var(tensor) for tensor in batch]
+
+    if len(batch) == 7:
+        stories, story_lengths, queries, query_lengths, answers, question_story, question_positions = batch
+        return model.multi_question_forward(stories, story_lengths, queries, question_story,
+                                            question_positions), answers, batch
+
+    stories, queries, answers, sl, ql = batch
+    return model(stories, queries, sl, ql), answers, batch
+
+
+def question_view(batch):
+    # stories, queries, answers, story lengths and query lengths of every question of a batch. Story batches are
+    # expanded to the story prefix of every question (for the records of evaluate).
+    if len(batch) == 5:
+        return batch
 
+    stories, _, queries, query_lengths, answers, question_story, question_positions = batch
+    stories = stories[question_story]
+    columns = torch.arange(stories.size(1), device=stories.device)
+    stories = stories * (columns.unsqueeze(0) < question_positions.unsqueeze(1)).long()
+
+    return stories, queries, answers, question_positions, query_lengths
+
+
+def number_of_questions(loader):
+    # Story loaders count stories, not questions
+    if hasattr(loader, "number_of_questions"):
+        return loader.number_of_questions()
+
+    return len(loader.dataset)
+
+
+def test(model, test_loader, criterion, PRINT_LOSS=False):
     if PRINT_LOSS:
         print("evaluating trained model ...")
 
+    return evaluate(model, test_loader, criterion, collect_records=True)
+
+
+def evaluate(model, test_loader, criterion, collect_records=False, label="Test set"):
+    """
+    Evaluates the model without autograd (torch.inference_mode). Loss and number of correct answers are accumulated
+    on the device of the model and only read once at the end.
+
+    :param collect_records: Also return the per-example records (stories, answers, lengths, predictions, queries) of
+                            every batch, as needed by evaluate_outputs. They cost a copy to numpy per batch.
+    :param label: Printed in front of the accuracy
+    :return: Loss per batch, accuracy in percent and the list of records (empty unless collect_records is set)
+    """
+    model.eval()
+
     correct = 0
-    test_data_size = len(test_loader.dataset)
+    test_data_size = 0
 
-    test_loss_history = []
+    batch_losses = []
     stats_list = []
-    for stories, queries, answers, sl, ql in test_loader:
-        stories_np  = stories.numpy()
-        answers_np = answers.numpy()
-        storyl_np = sl.numpy()
-        queryl_np = ql.numpy()
-        queries_np = queries.numpy()
-        stories = Variable(stories.type(torch.LongTensor))
-        queries = Variable(queries.type(torch.LongTensor))
-        answers = Variable(answers.type(torch.LongTensor))
-        sl = Variable(sl.type(torch.LongTensor))
-        ql = Variable(ql.type(torch.LongTensor))
-
-        # Sort stories by their length
-        sl, perm_idx = sl.sort(0, descending=True)
-        stories = stories[perm_idx]
-        # ql, perm_idx = ql.sort(0, descending=True) # if we sort query also --> then they do not fit together!
-        ql = ql[perm_idx]
-        queries = queries[perm_idx]
-        answers = answers[perm_idx]
-
-        output = model(stories, queries, sl, ql)
-
-        loss = criterion(output, answers.view(-1))
-
-        # Calculating elementwise loss  per batch
-        test_loss_history.append(loss.data[0])
 
-        pred_answers = output.data.max(1)[1]
-        predicted_answers_np = pred_answers.numpy()
-        stats = [["stories", "Ground Truth", "story length", "Q lenght", "Predicted Answer", "Queries"], stories_np, answers_np, storyl_np, queryl_np, predicted_answers_np, queries_np]
-        stats_list.append(stats)
-        correct += pred_answers.eq(
-            answers.data.view_as(pred_answers)).cpu().sum()  # calculate how many labels are correct
+    with torch.inference_mode():
+        for batch in test_loader:
+            # Stories come sorted by their length from the LengthBucketBatchSampler
+            output, answers, batch = forward_batch(model, batch)
+
+            # Elementwise loss per batch
+            batch_losses.append(criterion(output, answers.view(-1)))
+
+            pred_answers = output.max(1)[1]
+            test_data_size += answers.size(0)
+            correct = correct + (pred_answers == answers).sum()  # calculate how many labels are correct
+
+            if collect_records:
+                stories, queries, _, sl, ql = question_view(batch)
+                stats = [["stories", "Ground Truth", "story length", "Q lenght", "Predicted Answer", "Queries"],
+                         stories.cpu().numpy(), answers.cpu().numpy(), sl.cpu().numpy(), ql.cpu().numpy(),
+                         pred_answers.cpu().numpy(), queries.cpu().numpy()]
+                stats_list.append(stats)
 
-    accuracy = 100. * correct / test_data_size
+    correct = int(correct)
+    test_loss_history = torch.stack(batch_losses).tolist() if len(batch_losses) > 0 else []
+    accuracy = 100. * correct / max(test_data_size, 1)
 
-    print('Test set: Accuracy: {}/{} ({:.0f}%)'.format(correct, test_data_size, accuracy))
+    print('{}: Accuracy: {}/{} ({:.0f}%)'.format(label, correct, test_data_size, accuracy))
 
     return test_loss_history, accuracy, stats_list
 
 
-def prepare_dataloaders(train_instances, test_instances, batch_size, shuffle=True):
-    train_dataset = bd.BAbiDataset(train_instances)
-    test_dataset = bd.BAbiDataset(test_instances)
+def prepare_retrieval(train_corpus, test_corpus, voc_len, k, trained=True):
+    # Replaces both corpora by derived corpora with the k most relevant facts per question (see bAbIRetrieval). The
+    # entities and, if trained, the weights come from the training corpus.
+    if isinstance(train_corpus, bm.BAbiMemmapDataset):
+        raise ValueError("Fact retrieval is not supported for memory mapped corpora")
 
-    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, shuffle=True)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size, shuffle=True)
+    start = time.time()
+    retriever = br.FactRetriever(k, br.entity_words(train_corpus, voc_len))
+    if trained:
+        retriever.fit(train_corpus)
+
+    train_retrieved = br.retrieve_corpus(train_corpus, retriever)
+    test_retrieved = br.retrieve_corpus(test_corpus, retriever)
+
+    print('Fact retrieval (%.1fs): mean story length %.1f -> %.1f words, supporting facts kept for %.1f%% of the '
+          'training and %.1f%% of the test questions' % (
+              time.time() - start, train_corpus.story_lengths().mean(), train_retrieved.story_lengths().mean(),
+              100. * br.hint_recall(train_retrieved), 100. * br.hint_recall(test_retrieved)))
+
+    return retriever, train_retrieved, test_retrieved
+
+
+def prepare_embeddings(source, train_corpus, voc, embedding_sizes):
+    """
+    Word2vec embeddings in the ids of voc for QAModel (see WORD2VEC_EMBEDDING in main).
+
+    :param source: "corpus" to train them on the facts and questions of the training corpus, otherwise the directory of
+                   the embedding written by Word2VecEmbedding.main
+    :return: Dict mapping every embedding size of the grid to its weight matrix
+    """
+    start = time.time()
+
+    if source == "corpus":
+        corpus = train_corpus.corpus if isinstance(train_corpus, bm.BAbiMemmapDataset) else train_corpus
+        pairs = w2v.SkipGramPairs.from_corpus(corpus, len(voc))
+        weights = dict((size, w2v.train_embedding(pairs, size).weight.data) for size in set(embedding_sizes))
+    else:
+        loaded = w2v.load_embedding(source, voc)
+        if set(embedding_sizes) != {loaded.size(1)}:
+            raise ValueError("The embedding in %s has size %d, EMBED_HIDDEN_SIZES is %s" % (
+                source, loaded.size(1), list(embedding_sizes)))
+        weights = {loaded.size(1): loaded}
+
+    print('Word2vec embeddings (%.1fs) of size %s from %s' % (time.time() - start, sorted(weights), source))
+
+    return weights
+
+
+def prepare_answer_index(train_corpus, test_corpus, voc_len):
+    # Maps the answers of both corpora to the indices of an AnswerIndex over the training answers. Test answers that
+    # never occur in training can not be predicted, they count as wrong and are ignored by the loss.
+    # Memory mapped corpora keep their answer column and map the answers of every batch.
+    answer_index = bd.AnswerIndex.from_answers(train_corpus.answers, voc_len)
+
+    if isinstance(train_corpus, bm.BAbiMemmapDataset):
+        train_corpus.answer_index = answer_index
+        test_corpus.answer_index = answer_index
+    else:
+        train_corpus.answers = answer_index.to_index(train_corpus.answers)
+        test_corpus.answers = answer_index.to_index(test_corpus.answers)
+
+    print('Answer candidates: %d of %d words (%d test questions with an unseen answer)' % (
+        len(answer_index), voc_len, int((test_corpus.answers == bd.AnswerIndex.UNKNOWN).sum())))
+
+    return answer_index
+
+
+def prepare_datasets(train_corpus, test_corpus, tensor_resident=True, multi_question=False):
+    # The tensor resident datasets materialise the corpus once, batches are then served by slicing. The per-item
+    # BAbiDataset is kept for comparison. Memory mapped datasets are used as they are.
+    # multi_question builds story level datasets for the question independent model (see BAbiStoryDataset).
+    if isinstance(train_corpus, bm.BAbiMemmapDataset):
+        if multi_question:
+            raise ValueError("Multi question training is not supported for memory mapped corpora")
+        return train_corpus, test_corpus
+
+    if multi_question:
+        return bd.BAbiStoryDataset(train_corpus), bd.BAbiStoryDataset(test_corpus)
+
+    if tensor_resident:
+        return bd.BAbiTensorDataset(train_corpus), bd.BAbiTensorDataset(test_corpus)
+
+    return bd.BAbiDataset(train_corpus), bd.BAbiDataset(test_corpus)
+
+
+def prepare_dataloaders(train_corpus, test_corpus, batch_size, shuffle=True, tensor_resident=True, num_workers=0,
+                        eval_batch_size=None):
+    # Accepts corpora or the datasets of prepare_datasets. The test loader uses eval_batch_size (default batch_size),
+    # evaluation needs no gradients, so it can use much larger batches. Its order is not shuffled.
+    # Either way the batches are bucketed by story length and come sorted in descending order, as needed for packing.
+    if isinstance(train_corpus, bd.BAbICorpus):
+        train_corpus, test_corpus = prepare_datasets(train_corpus, test_corpus, tensor_resident)
+
+    train_dataset, test_dataset = train_corpus, test_corpus
+    eval_batch_size = eval_batch_size or batch_size
+
+    # Story level datasets are batched by stories, batch_size is the number of stories per batch
+    if isinstance(train_dataset, bd.BAbiStoryDataset):
+        train_loader = bd.StoryBatchLoader(train_dataset, batch_size=batch_size, shuffle=shuffle)
+        test_loader = bd.StoryBatchLoader(test_dataset, batch_size=eval_batch_size, shuffle=False)
+
+        print('Story padding: %.1f%%, %.1f questions per story' % (
+            100. * train_loader.padding_ratio(), float(train_dataset.number_of_questions()) / len(train_dataset)))
+
+        return train_loader, test_loader
+
+    # Memory mapped corpora gather whole batches from the mapped files, also inside the loader workers
+    if isinstance(train_dataset, bm.BAbiMemmapDataset):
+        train_loader = DataLoader(dataset=train_dataset, batch_size=None, num_workers=num_workers,
+                                  sampler=bd.LengthBucketBatchSampler(train_dataset.story_lengths, batch_size,
+                                                                      shuffle))
+        test_loader = DataLoader(dataset=test_dataset, batch_size=None, num_workers=num_workers,
+                                 sampler=bd.LengthBucketBatchSampler(test_dataset.story_lengths, eval_batch_size,
+                                                                     False))
+
+        return train_loader, test_loader
+
+    if isinstance(train_dataset, bd.BAbiTensorDataset):
+        train_loader = bd.TensorBatchLoader(train_dataset, batch_size=batch_size, shuffle=shuffle,
+                                            bucket_by_length=True)
+        test_loader = bd.TensorBatchLoader(test_dataset, batch_size=eval_batch_size, shuffle=False,
+                                           bucket_by_length=True)
+
+        print('Story padding: %.1f%% (padding to the longest story: %.1f%%)' % (
+            100. * train_loader.padding_ratio(),
+            100. * bd.TensorBatchLoader(train_dataset, batch_size).padding_ratio()))
+
+        return train_loader, test_loader
+
+    train_loader = DataLoader(dataset=train_dataset,
+                              batch_sampler=bd.LengthBucketBatchSampler(train_dataset.story_lengths, batch_size,
+                                                                        shuffle))
+    test_loader = DataLoader(dataset=test_dataset,
+                             batch_sampler=bd.LengthBucketBatchSampler(test_dataset.story_lengths, eval_batch_size,
+                                                                       False))
 
     return train_loader, test_loader
 
@@ -320,67 +769,189 @@ class GridSearchParamDict():
         return self.params
 
 
+def prepare_subsample_loader(test_loader, schedule, batch_size):
+    # Loader over a fixed subsample of the test set, stratified by answer, for the evaluations between the full ones of
+    # the schedule. None if the schedule does not use a subsample.
+    if schedule is None or schedule.subsample_size is None:
+        return None
+
+    test_dataset = test_loader.dataset
+    answers = test_dataset.answers.numpy() if torch.is_tensor(test_dataset.answers) else test_dataset.answers
+
+    if isinstance(test_loader, bd.StoryBatchLoader):
+        # Whole stories are sampled, stratified by the answer of their first question, about as many as needed for
+        # subsample_size questions
+        offsets = test_dataset.question_offsets.numpy()
+        size = int(math.ceil(schedule.subsample_size * float(len(test_dataset)) / max(len(answers), 1)))
+        indices = bd.stratified_sample(answers[offsets[:-1]], size)
+
+        return bd.StoryBatchLoader(test_dataset, batch_size=batch_size, indices=indices)
+
+    indices = bd.stratified_sample(answers, schedule.subsample_size)
+
+    if isinstance(test_loader, bd.TensorBatchLoader):
+        return bd.TensorBatchLoader(test_dataset, batch_size=batch_size, bucket_by_length=True, indices=indices)
+
+    sampler = bd.LengthBucketBatchSampler(test_dataset.story_lengths, batch_size, False, indices)
+    if isinstance(test_dataset, bm.BAbiMemmapDataset):
+        return DataLoader(dataset=test_dataset, batch_size=None, sampler=sampler)
+
+    return DataLoader(dataset=test_dataset, batch_sampler=sampler)
+
+
 def load_data(voc_path, train_path, test_path):
     voc = bd.Vocabulary()
-    train_instances = []
-    test_instances = []
 
     voc.extend_with_file(voc_path)
-    train_instances = bd.BAbIInstance.instances_from_file(train_path)
-    test_instances = bd.BAbIInstance.instances_from_file(test_path)
+    # The corpora store the facts of each story once, shared by all of its questions
+    train_corpus = bd.BAbICorpus.from_file(train_path)
+    test_corpus = bd.BAbICorpus.from_file(test_path)
 
     voc.sort_ids()
 
-    return voc, train_instances, test_instances
+    return voc, train_corpus, test_corpus
+
+
+def parse_data(voc_path, train_path, test_path):
+    # Single pass version of load_data followed by vectorize_data: every file is tokenised and vectorized while it is
+    # read. If the vocabulary comes from the train file (the usual case), ids are assigned on the fly and renumbered
+    # in alphabetical order afterwards, as sort_ids does in load_data.
+    voc = bd.Vocabulary()
+    stats = bd.ParseStats()
+
+    if voc_path != train_path:
+        voc.extend_with_file(voc_path)
+
+    train_corpus = bd.BAbICorpus.from_file(train_path, voc, extend_vocabulary=(voc_path == train_path), stats=stats)
+    train_corpus.remap_ids(voc.sort_ids())
+    test_corpus = bd.BAbICorpus.from_file(test_path, voc, stats=stats)
+
+    print('Parsed %s' % stats)
+
+    return voc, train_corpus, test_corpus
+
+
+def load_vectorized_data(voc_path, train_path, test_path, cache_dir=None):
+    # Same as parse_data, but the result is cached in cache_dir.
+    if cache_dir is not None:
+        cache_path = cache.cache_file(cache_dir, [voc_path, train_path, test_path])
+
+        if os.path.isfile(cache_path):
+            voc, corpora = cache.load_corpora(cache_path)
+            return voc, corpora["train"], corpora["test"]
+
+    voc, train_corpus, test_corpus = parse_data(voc_path, train_path, test_path)
+
+    if cache_dir is not None:
+        cache.save_corpora(cache_path, voc, {"train": train_corpus, "test": test_corpus})
 
+    return voc, train_corpus, test_corpus
 
-def vectorize_data(voc, train_instances, test_instances):
+
+def vectorize_data(voc, train_corpus, test_corpus):
     # At this point, training instances have been loaded with real word sentences.
     # Using the vocabulary we convert the words into integer representations, so they can converted with an embedding
     # later on.
-    for inst in train_instances:
-        inst.vectorize(voc)
-
-    for inst in test_instances:
-        inst.vectorize(voc)
+    train_corpus.vectorize(voc)
+    test_corpus.vectorize(voc)
 
 
 def conduct_training(model, train_loader, test_loader, optimizer, criterion, only_evaluate=False, print_loss=False,
-                     epochs=1):
+                     epochs=1, start_epoch=1, subsample_loader=None, schedule=None, checkpoint_path=None,
+                     checkpoint_every=None):
+    # start_epoch > 1 continues the training of a restored model, the histories only cover the epochs run here.
+    # With a checkpoint_path the training state is saved there every checkpoint_every epochs and after the last epoch.
+    # If that checkpoint already exists, the training resumes from it and the histories cover all epochs.
+    # The schedule (an EvaluationSchedule, default: full evaluation after every epoch) decides which epochs are
+    # evaluated on the test_loader, which on the subsample_loader and when to stop early. The test histories only
+    # contain the results of the full evaluations, the subsample results are printed.
+    if schedule is None:
+        schedule = EvaluationSchedule()
+
     train_loss_history = []
     test_loss_history = []
 
     train_acc_history = []
     test_acc_history = []
     eval_list = []
+    stopping = schedule.initial_state()
+
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        trained_epochs, histories = load_checkpoint(checkpoint_path, model, optimizer)
+        print("Resuming from %s after epoch %d" % (checkpoint_path, trained_epochs))
+
+        start_epoch = trained_epochs + 1
+        train_loss_history = histories["train_loss"]
+        test_loss_history = histories["test_loss"]
+        train_acc_history = histories["train_acc"]
+        test_acc_history = histories["test_acc"]
+        stopping = histories.get("stopping", stopping)
+
+        if stopping["stopped"]:
+            print("Training was stopped early after epoch %d" % trained_epochs)
+            start_epoch = epochs + 1
+
     ## Start training
     start = time.time()
     if print_loss:
         print("Training for %d epochs..." % epochs)
 
-    for epoch in range(1, epochs + 1):
+    for epoch in range(start_epoch, epochs + 1):
         print("Epoche: %d" % epoch)
         # Train cycle
         if not only_evaluate:
             train_loss, train_accuracy, total_loss = train(model, train_loader, optimizer, criterion, start, epoch,
                                                            print_loss)
-
-        # Test cycle
-        test_loss, test_accuracy, eval_list = test(model, test_loader, criterion, PRINT_LOSS=False)
-
-        # Add Loss to history
-        if not only_evaluate:
             train_loss_history = train_loss_history + train_loss
-        test_loss_history = test_loss_history + test_loss
-        # Add Loss to history
-        if not only_evaluate:
             train_acc_history.append(train_accuracy)
-        test_acc_history.append(test_accuracy)
+
+        # Test cycle
+        test_loss = None
+        eval_list = []
+        full = schedule.is_full_evaluation(epoch, epochs)
+
+        if not full and subsample_loader is not None:
+            test_loss, test_accuracy, _ = evaluate(model, subsample_loader, criterion, label="Test subsample")
+            # A subsample reaching the target accuracy is confirmed on the full test set
+            full = schedule.reached_target(test_accuracy)
+
+        if full:
+            # The per-example records are only needed after the last epoch (or if the training may stop here)
+            test_loss, test_accuracy, eval_list = evaluate(model, test_loader, criterion,
+                                                           collect_records=(epoch == epochs or
+                                                                            schedule.stops_early()))
+
+        stop = False
+        if full:
+            test_loss_history = test_loss_history + test_loss
+            test_acc_history.append(test_accuracy)
+            stop = schedule.update(stopping, float(np.mean(test_loss)), test_accuracy, full)
+
+        if checkpoint_path is not None and (epoch == epochs or stop or
+                                            (checkpoint_every and epoch % checkpoint_every == 0)):
+            save_checkpoint(checkpoint_path, model, optimizer, epoch, {
+                "train_loss": train_loss_history,
+                "test_loss": test_loss_history,
+                "train_acc": train_acc_history,
+                "test_acc": test_acc_history,
+                "stopping": stopping
+            })
+
+        if stop:
+            print("Stopping early after epoch %d of %d" % (epoch, epochs))
+            break
+
+    if len(eval_list) == 0:
+        # Restored from a checkpoint with nothing left to train, the evaluation lists are still needed. Its histories
+        # already end with the full evaluation of the last epoch.
+        _, _, eval_list = test(model, test_loader, criterion)
 
     return train_loss_history, test_loss_history, train_acc_history, test_acc_history, eval_list
 
 
 def plot_data_in_window(train_loss, test_loss, train_acc, test_acc):
+    import matplotlib.pyplot as plt
+
     plt.figure()
     plt.plot(train_loss, label='train-loss', color='b')
     plt.plot(test_loss, label='test-loss', color='r')
@@ -406,7 +977,9 @@ def concatenated_params(params):
 
 
 def save_results(task, train_loss, test_loss, params, train_accuracy, test_accuracy, params_file, model, voc, eval_results,
-                 plots=True):
+                 plots=True, run_info=None):
+    # run_info (model class name and the query padding width) is saved as run_info.json, inference.predictor needs it
+    # to rebuild the model and to feed the queries like in training
     param_str = concatenated_params(params)
 
     date = str(time.strftime("%Y:%m:%d:%H:%M:%S"))
@@ -427,6 +1000,8 @@ def save_results(task, train_loss, test_loss, params, train_accuracy, test_accur
     eval_results[2].to_csv(fname + "Stories.csv", sep=";")
     eval_results[3].to_csv(fname + "Queries.csv", sep=";")
     if plots == True:
+        import matplotlib.pyplot as plt
+
         plt.figure()
         plt.plot(train_loss, label='train-loss', color='b')
         plt.plot(test_loss, label='test-loss', color='r')
@@ -448,6 +1023,12 @@ def save_results(task, train_loss, test_loss, params, train_accuracy, test_accur
     torch.save(model.state_dict(), fname + "trained_model.pth")
     pickle.dump(voc.voc_dict, open(fname + "vocabulary.pkl", "wb"))
 
+    if run_info is not None:
+        with open(fname + "run_info.json", "w") as f:
+            json.dump(run_info, f)
+
+    return fname
+
 
 if __name__ == "__main__":
     for i in(1,2,3,6):
@@ -0,0 +1,75 @@
+import torch
+import torch.nn.functional as functional
+
+from preprocessing import bAbIData as bd
+
+
+## Nearest neighbours of the words of a learned embedding
+# The weight matrix is L2-normalised once, so the cosine similarities of a batch of query words with the whole
+# vocabulary are a single matrix multiply and the neighbours are its topk. The padding id is never a neighbour.
+class EmbeddingIndex:
+    def __init__(self, weights, voc):
+        """
+        :param weights: Embedding weight matrix, row i is the vector of id i (rows from len(voc) on are ignored)
+        :param voc: Vocabulary of the embedding
+        """
+        self.voc = voc
+        self.vectors = functional.normalize(weights.detach()[:len(voc)].float(), dim=1)
+
+    @staticmethod
+    def from_embedding(embedding, voc):
+        return EmbeddingIndex(embedding.weight.data, voc)
+
+    def neighbour_ids(self, ids, k=10, batch_size=1024):
+        """
+        :param ids: Ids of the query words
+        :param k: Number of neighbours per word (the word itself is left out)
+        :param batch_size: Number of query words multiplied with the vocabulary at once
+        :return: Similarities and ids of the neighbours, both LEN(ids) x k and sorted by descending similarity
+        """
+        ids = torch.as_tensor(ids, dtype=torch.long).view(-1)
+        k = max(min(k, len(self.vectors) - 2), 0)
+
+        similarities = []
+        neighbours = []
+
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            scores = self.vectors[batch].mm(self.vectors.t())
+
+            # Neither the padding nor the query word itself
+            scores[:, 0] = -float("inf")
+            scores[torch.arange(len(batch)), batch] = -float("inf")
+
+            batch_similarities, batch_neighbours = scores.topk(k, dim=1)
+            similarities.append(batch_similarities)
+            neighbours.append(batch_neighbours)
+
+        if len(similarities) == 0:
+            return torch.zeros(0, k), torch.zeros(0, k, dtype=torch.long)
+
+        return torch.cat(similarities), torch.cat(neighbours)
+
+    def neighbours(self, words, k=10):
+        """
+        :param words: List of query words, unknown words are skipped
+        :return: Dict mapping every known query word to its k nearest words as (word, cosine similarity) tuples
+        """
+        words = [word for word in words if word in self.voc.voc_dict]
+        similarities, neighbours = self.neighbour_ids(self.voc.words_to_ids(words), k)
+
+        result = {}
+        for word, word_similarities, word_neighbours in zip(words, similarities.tolist(), neighbours.tolist()):
+            result[word] = [(self.voc.id_to_word(i), similarity)
+                            for i, similarity in zip(word_neighbours, word_similarities)]
+
+        return result
+
+    def save(self, path):
+        # The normalised vectors with the vocabulary they belong to
+        torch.save({"vectors": self.vectors, "voc_dict": self.voc.voc_dict}, path)
+
+    @staticmethod
+    def load(path):
+        state = torch.load(path)
+        return EmbeddingIndex(state["vectors"], bd.Vocabulary(vocabulary_dict=state["voc_dict"]))
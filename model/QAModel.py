@@ -13,16 +13,20 @@ from utils.utils import create_var
 # --> but there is still on-going work with parameter-tweaking!
 class QAModel(nn.Module):
     def __init__(self, input_size, embedding_size, story_hidden_size, output_size, n_layers=1, bidirectional=False,
-                 custom_embedding=None):
+                 custom_embedding=None, question_independent=False):
         super(QAModel, self).__init__()
 
         ## Definition of Input- & Output-Sizes
         self.voc_size = input_size
+        # Number of answer candidates, the vocabulary or a closed set of answers (see bAbIData.AnswerIndex)
+        self.output_size = output_size
         self.embedding_size = embedding_size
         self.story_hidden_size = story_hidden_size
         self.query_hidden_size = embedding_size
         self.n_layers = n_layers
         self.n_directions = int(bidirectional) + 1
+        # Encode the story without the question code, like old_forward (needed for multi_question_forward)
+        self.question_independent = question_independent
 
         ## Definition of Embeddings
 
@@ -42,10 +46,13 @@ class QAModel(nn.Module):
         self.query_rnn = nn.GRU(self.embedding_size, self.query_hidden_size, self.n_layers, bidirectional=bidirectional,
                                 batch_first=True, dropout=0.3)
 
-        ## Definition of Output-Layers --> here we do softmax on the vocabulary_size!
+        ## Definition of Output-Layers --> here we do softmax on the answer candidates (output_size)!
 
         # info: if we use the old-forward function fc-layer has input-length: "story_hidden_size+query_hidden_size"
-        self.fc = nn.Linear(self.story_hidden_size, self.voc_size)
+        if question_independent:
+            self.fc = nn.Linear(self.story_hidden_size + self.query_hidden_size, self.output_size)
+        else:
+            self.fc = nn.Linear(self.story_hidden_size, self.output_size)
         self.softmax = nn.LogSoftmax()
 
     # This is the old forward version that we used before!
@@ -103,12 +110,18 @@ class QAModel(nn.Module):
     # achieves 100% on Task 1, other Tasks also improved significantly!
     # --> question-code is like an attention-mechanism!
     def forward(self, story, query, story_lengths, query_lengths):
+        question_code = self.encode_query(query)
+
+        return self.encode_story(story, story_lengths, question_code)
+
+    ## Encoding of the Query-Sequence into the Question-Code
+    # it does not depend on the story, so the code of a question can be reused (see QueryCache)
+    def encode_query(self, query):
 
         # Determine Batch-Size
-        batch_size = story.size(0)
+        batch_size = query.size(0)
 
-        # Create hidden states for GRUs
-        story_hidden = self._init_hidden(batch_size, self.story_hidden_size)
+        # Create hidden state for the query GRU
         query_hidden = self._init_hidden(batch_size, self.query_hidden_size)
 
         # Embed Query-Words
@@ -117,11 +130,29 @@ class QAModel(nn.Module):
         # Generate an encoding for the Query-Sequence with RNN
         query_output, query_hidden = self.query_rnn(q_e, query_hidden)
 
-        # question_code contains the encoded question!
-        # --> we give this directly into the story_rnn,
+        # question_code contains the encoded question! --> BATCH_SIZE x QUERY_HIDDEN_SIZE
+        return query_hidden[0]
+
+    ## Encoding of the Story with the Question-Code and Classification of the Answer
+    def encode_story(self, story, story_lengths, question_code):
+
+        # Determine Batch-Size
+        batch_size = story.size(0)
+
+        # Create hidden state for the story GRU
+        story_hidden = self._init_hidden(batch_size, self.story_hidden_size)
+
+        if self.question_independent:
+            # Same as old_forward: the story is encoded on its own and combined with the question code afterwards
+            packed_story = torch.nn.utils.rnn.pack_padded_sequence(self.story_embedding(story),
+                                                                   story_lengths.data.cpu().numpy(), batch_first=True)
+            story_output, story_hidden = self.story_rnn(packed_story, story_hidden)
+
+            return self.softmax(self.fc(torch.cat([story_hidden[0], question_code], 1)))
+
+        # --> we give the question_code directly into the story_rnn,
         # so that the story_rnn can focus on the question already
         # and can forget unnecessary information!
-        question_code = query_hidden[0]
         question_code = question_code.view(batch_size, 1, self.query_hidden_size)
 
         ## Question-Code has to have the same size as the story-embeddings!
@@ -140,7 +171,63 @@ class QAModel(nn.Module):
         story_output, story_hidden = self.story_rnn(packed_story, story_hidden)
         # remember: because we use the hidden states of the RNN, we don't have to unpack the tensor!
 
-        # Do Softmax-Classification on the encoded Story-Tensor!
+        return self.classify(story_hidden)
+
+    ## Forward-function for whole stories with several questions (question_independent models only)
+    # Because the story encoding does not depend on the question, the story_rnn reads every story only once and the
+    # story code of each question is read out of the story_rnn output at the position of the question.
+    # --> the cost per story grows linearly with its length instead of quadratically (one prefix per question)
+    def multi_question_forward(self, story, story_lengths, query, question_story, question_positions):
+
+        #story: N_STORIES x STORY_MAX_LEN, whole stories sorted by length
+        #query: N_QUESTIONS x QUERY_MAX_LEN
+        #question_story: row in story of every question
+        #question_positions: number of story words before every question
+
+        # The output of the story_rnn is its hidden state only for one layer in one direction
+        if not self.question_independent or self.n_layers != 1 or self.n_directions != 1:
+            raise ValueError("multi_question_forward needs a question independent, single layer, unidirectional model")
+
+        batch_size = story.size(0)
+        story_hidden = self._init_hidden(batch_size, self.story_hidden_size)
+
+        s_e = self.story_embedding(story)
+        packed_story = torch.nn.utils.rnn.pack_padded_sequence(s_e, story_lengths.data.cpu().numpy(),
+                                                               batch_first=True)  # pack story
+        story_output, story_hidden = self.story_rnn(packed_story, story_hidden)
+
+        # Here the outputs of all positions are needed, so the story is unpacked
+        story_output, _ = torch.nn.utils.rnn.pad_packed_sequence(story_output, batch_first=True)
+
+        # Story code of every question: the hidden state after the last word before the question
+        story_code = story_output[question_story, (question_positions - 1).clamp(min=0)]
+        story_code = story_code * (question_positions > 0).unsqueeze(1).type_as(story_code)
+
+        merged_encoding = torch.cat([story_code, self.encode_query(query)], 1)
+
+        fc_output = self.fc(merged_encoding)
+        sm_output = self.softmax(fc_output)
+
+        return sm_output
+
+    ## Incremental Story-Encoding (see inference.session)
+    # Continues the story_rnn from story_hidden with further (unpadded) story words: BATCH_SIZE x NEW_WORDS.
+    # Running a story in pieces gives the same hidden state as running it at once (only for unidirectional GRUs).
+    def advance_story(self, story, question_code, story_hidden=None):
+        batch_size = story.size(0)
+
+        if story_hidden is None:
+            story_hidden = self._init_hidden(batch_size, self.story_hidden_size)
+
+        question_code = question_code.view(batch_size, 1, self.query_hidden_size)
+        combined = self.story_embedding(story) + question_code
+
+        story_output, story_hidden = self.story_rnn(combined, story_hidden)
+
+        return story_hidden
+
+    # Do Softmax-Classification on the encoded Story-Tensor!
+    def classify(self, story_hidden):
         fc_output = self.fc(story_hidden[0])
         sm_output = self.softmax(fc_output)
 
@@ -13,6 +13,8 @@ class QAModelLSTM(nn.Module):
 
         ## Definition of Input- & Output-Sizes
         self.voc_size = input_size
+        # Number of answer candidates, the vocabulary or a closed set of answers (see bAbIData.AnswerIndex)
+        self.output_size = output_size
         self.embedding_size = embedding_size
         self.story_hidden_size = story_hidden_size
         self.query_hidden_size = embedding_size
@@ -37,19 +39,24 @@ class QAModelLSTM(nn.Module):
         self.query_rnn = nn.LSTM(self.embedding_size, self.query_hidden_size, self.n_layers, bidirectional=bidirectional,
                                 batch_first=True, dropout=0.3)
 
-        ## Definition of Output-Layers --> here we do softmax on the vocabulary_size!
-        self.fc = nn.Linear(self.story_hidden_size, self.voc_size)
+        ## Definition of Output-Layers --> here we do softmax on the answer candidates (output_size)!
+        self.fc = nn.Linear(self.story_hidden_size, self.output_size)
         self.softmax = nn.LogSoftmax()
 
     # new forward-function with question-code
     # achieves 100% on Task 1!!
     # --> question-code is like an attention-mechanism!
     def forward(self, story, query, story_lengths, query_lengths):
+        question_code = self.encode_query(query)
+
+        return self.encode_story(story, story_lengths, question_code)
+
+    # encodes the query-sequence into the question-code, independent of the story (see QueryCache)
+    def encode_query(self, query):
         # Determine Batch-Size
-        batch_size = story.size(0)
+        batch_size = query.size(0)
 
-        # Make hidden for the LSTMs
-        story_hidden = self._init_hidden(batch_size, self.story_hidden_size)
+        # Make hidden for the query LSTM
         query_hidden = self._init_hidden(batch_size, self.query_hidden_size)
 
         # Embed Query-Words
@@ -57,11 +64,20 @@ class QAModelLSTM(nn.Module):
         # Encode query-sequence with RNN
         query_output, query_hidden = self.query_rnn(q_e, query_hidden)
 
-        # question_code contains the encoded question!
-        # --> we give this directly into the story_rnn,
+        # question_code contains the encoded question! --> BATCH_SIZE x QUERY_HIDDEN_SIZE
+        return query_hidden[0].view(batch_size, self.query_hidden_size)
+
+    # encodes the story together with the question-code and classifies the answer
+    def encode_story(self, story, story_lengths, question_code):
+        # Determine Batch-Size
+        batch_size = story.size(0)
+
+        # Make hidden for the story LSTM
+        story_hidden = self._init_hidden(batch_size, self.story_hidden_size)
+
+        # --> we give the question_code directly into the story_rnn,
         # so that the story_rnn can focus on the question already
         # and can forget unnecessary information!
-        question_code = query_hidden[0]
         question_code = question_code.view(batch_size, 1, self.query_hidden_size)
         question_code = question_code.repeat(1, story.size(1), 1)
 
@@ -77,8 +93,27 @@ class QAModelLSTM(nn.Module):
         story_output, story_hidden = self.story_rnn(packed_story, story_hidden)
         # remember: because we use the hidden states of the RNN, we don't have to unpack the tensor!
 
-        # Do softmax on the encoded story tensor!
-        fc_output = self.fc(story_hidden[-1].view(batch_size,self.story_hidden_size))
+        return self.classify(story_hidden)
+
+    # continues the story_rnn from story_hidden with further (unpadded) story words, see inference.session
+    # --> running a story in pieces gives the same hidden state as running it at once (only unidirectional LSTMs)
+    def advance_story(self, story, question_code, story_hidden=None):
+        batch_size = story.size(0)
+
+        if story_hidden is None:
+            story_hidden = self._init_hidden(batch_size, self.story_hidden_size)
+
+        question_code = question_code.view(batch_size, 1, self.query_hidden_size)
+        combined = self.story_embedding(story) + question_code
+
+        story_output, story_hidden = self.story_rnn(combined, story_hidden)
+
+        return story_hidden
+
+    # Do softmax on the encoded story tensor!
+    def classify(self, story_hidden):
+        batch_size = story_hidden[-1].size(1)
+        fc_output = self.fc(story_hidden[-1].view(batch_size, self.story_hidden_size))
         sm_output = self.softmax(fc_output)
 
         return sm_output
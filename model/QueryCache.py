@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+## Inference-time cache of Question-Codes
+# bAbI questions come from a handful of templates ("Where is Mary ?"), so most queries of a batch have been encoded
+# before. The cache maps the (padded) query ids to the question_code of encode_query and only runs the query_rnn for
+# unseen queries. Least recently used codes are evicted once capacity is reached.
+# Only for evaluation: the cached codes carry no gradients.
+class QueryCache:
+    def __init__(self, model, capacity=4096):
+        self.model = model
+        self.capacity = capacity
+        self.codes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, story, query, story_lengths, query_lengths):
+        # Same interface as the forward of the model
+        return self.model.encode_story(story, story_lengths, self.encode_query(query))
+
+    def encode_query(self, query):
+        # query: BATCH_SIZE x QUERY_MAX_LEN, the padding is part of the key, the query_rnn runs over it
+        # The batch is reduced to its distinct queries first, so the lookups scale with the number of templates
+        unique_rows, inverse = np.unique(query.cpu().numpy(), axis=0, return_inverse=True)
+        keys = [row.tobytes() for row in unique_rows]
+
+        missing = [i for i, key in enumerate(keys) if key not in self.codes]
+
+        self.misses += len(missing)
+        self.hits += query.size(0) - len(missing)
+
+        codes = [None] * len(keys)
+        if len(missing) > 0:
+            encoded = self.model.encode_query(query.new_tensor(unique_rows[missing]))
+
+            for i, code in zip(missing, encoded):
+                codes[i] = code
+                self.codes[keys[i]] = code
+
+        for i, key in enumerate(keys):
+            if codes[i] is None:
+                codes[i] = self.codes[key]
+            self.codes.move_to_end(key)
+
+        while len(self.codes) > self.capacity:
+            self.codes.popitem(last=False)
+
+        return torch.stack(codes)[query.new_tensor(inverse.reshape(-1))]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else 0.
+
+    def stats(self):
+        return {"size": len(self.codes), "capacity": self.capacity, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hit_rate()}
+
+    def clear(self):
+        self.codes.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,186 +1,362 @@
+import glob
 import os
 import pickle
-import re
-from random import randint
-from typing import List
+import time
 
-import matplotlib.pyplot as plt
+import numpy as np
 import torch
-import torch.autograd as autograd
 import torch.nn as nn
 import torch.nn.functional as functional
 import torch.optim as optim
-import torch.optim.lr_scheduler
 
+from model.EmbeddingIndex import EmbeddingIndex
 from preprocessing import bAbIData as bd
 
 
-class W2VInstance:
-    def __init__(self, word, context):
-        self.word = word
-        self.context = context
+class SkipGramPairs:
+    """
+    Skip gram training pairs of a corpus: the corpus is held as one id array with sentence offsets and iterating over
+    it yields the (center, context) id pairs of consecutive chunks of sentences as contiguous arrays. The pairs
+    of a chunk only exist while it is trained on, so the memory does not grow with one object per token.
 
-    def get_random_context(self):
-        return self.context[randint(0, len(self.context) - 1)]
+    Every pass draws new pairs like word2vec does:
+    - dynamic window: every center word gets a window of 1 to window words on each side, so close words are more
+      often context than distant ones
+    - subsampling: a word with the corpus frequency f is kept with probability sqrt(t / f) + t / f (t = subsample),
+      which drops most occurrences of very frequent words ("the", ".")
+    """
+
+    def __init__(self, tokens, offsets, voc_size, window=5, dynamic_window=True, subsample=1e-3, chunk_tokens=100000,
+                 seed=0):
+        """
+        :param tokens: Flat id array of all sentences
+        :param offsets: Sentence offsets, sentence s is tokens[offsets[s]:offsets[s + 1]]
+        :param voc_size: Number of ids (len(voc)), the padding and ids from voc_size on (unknown words) are left out
+        :param subsample: Subsampling threshold t, None keeps every word
+        :param chunk_tokens: Approximate number of tokens of the sentences whose pairs are yielded together
+        """
+        self.tokens = np.asarray(tokens, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.voc_size = voc_size
+        self.window = window
+        self.dynamic_window = dynamic_window
+        self.chunk_tokens = chunk_tokens
+        self.rng = np.random.RandomState(seed)
+
+        known = (self.tokens > 0) & (self.tokens < voc_size)
+        self.counts = np.bincount(self.tokens[known], minlength=voc_size)
+
+        # Probability to keep an id, the extra last entry (0) stands for all unknown ids
+        frequencies = self.counts / float(max(self.counts.sum(), 1))
+        self.keep_probabilities = np.append((self.counts > 0).astype(np.float64), 0.)
+        if subsample is not None:
+            seen = frequencies > 0
+            ratios = subsample / frequencies[seen]
+            self.keep_probabilities[:-1][seen] = np.minimum(np.sqrt(ratios) + ratios, 1.)
 
     @staticmethod
-    def instances_from_file(path, context_l=1, context_r=1):
-        instances = []
+    def from_files(paths, voc, **kwargs):
+        """
+        Tokenises the facts and questions of bAbI files, new words are added to the vocabulary.
+        """
+        tokens, offsets = sentences_from_files(paths, voc)
+        return SkipGramPairs(tokens, offsets, len(voc), **kwargs)
 
-        with open(path, 'r') as f:
-            for line in f.readlines():
-                instances += W2VInstance.instances_from_line(line, context_l, context_r)
+    @staticmethod
+    def from_corpus(corpus, voc_size, **kwargs):
+        """
+        The facts and questions of a vectorized BAbICorpus (or BAbIMemmapCorpus), with the ids of its vocabulary.
+        """
+        fact_offsets = np.asarray(corpus.fact_offsets, dtype=np.int64)
+        question_offsets = np.asarray(corpus.question_offsets, dtype=np.int64)
 
-        return instances
+        tokens = np.concatenate([np.asarray(corpus.tokens, dtype=np.int64),
+                                 np.asarray(corpus.question_tokens, dtype=np.int64)])
+        offsets = np.concatenate([fact_offsets, fact_offsets[-1] + question_offsets[1:]])
 
-    @staticmethod
-    def instances_from_line(line, context_l=1, context_r=1):
-        instances = []
-        words = re.split('(\W)', line)
+        return SkipGramPairs(tokens, offsets, voc_size, **kwargs)
 
-        words = [word for word in words if word not in ["", " ", "\n", "\r"] and not word.isnumeric()]
+    def chunks(self):
+        # Ranges of whole sentences with about chunk_tokens tokens
+        start = 0
+        n_sentences = len(self.offsets) - 1
 
-        for i in range(len(words)):
-            word = words[i]
-            context = []
+        while start < n_sentences:
+            end = np.searchsorted(self.offsets, self.offsets[start] + self.chunk_tokens, side='right') - 1
+            end = min(max(end, start + 1), n_sentences)
+            yield start, end
+            start = end
 
-            for j in range(max(0, i - context_l), min(len(words), i + context_r)):
-                if j is not i:
-                    context += words[j]
+    def __iter__(self):
+        for start, end in self.chunks():
+            tokens = self.tokens[self.offsets[start]:self.offsets[end]]
+            sentences = np.repeat(np.arange(start, end), np.diff(self.offsets[start:end + 1]))
 
-            if len(context) is 0:
-                continue
+            keep = self.rng.random_sample(len(tokens)) < self.keep_probabilities[np.minimum(tokens, self.voc_size)]
+            tokens = tokens[keep]
+            sentences = sentences[keep]
 
-            instances.append(W2VInstance(word, context))
+            center_windows = None
+            if self.dynamic_window:
+                center_windows = self.rng.randint(1, self.window + 1, len(tokens))
 
-        return instances
+            yield window_pairs(tokens, sentences, self.window, center_windows)
 
 
-class W2VSkipGramEmbedding(nn.Module):
-    """This Module is used for training a PyTorch nn.embedding with a word2vec skip gram approach."""
+class W2VNegativeSamplingEmbedding(nn.Module):
+    """
+    Skip gram with negative sampling: instead of a softmax over the whole vocabulary for every pair, the network
+    tells the true context word apart from a few noise words drawn from the unigram distribution (see unigram_table).
+    All pairs of a batch share the same noise words, so their scores are a single matrix multiply.
+    """
 
     def __init__(self, embeddings):
         """
-        Hand over an embedding which will be trained as first half of a word2vec skip gram network.
-        (One-Hot-Input->embedding matrix->hidden layer (feature vector)->softmax vs target label)
-
-        :param embeddings: Embeddings is basically a linear layer from the One-Hot-Input of dimension
-        |Vocabulary|=VxN=|Features of feature vector|. embeddings.weight.data is the underlying matrix corresponding
-        to the linear layer.
+        :param embeddings: The embedding to train (the center word vectors). The context word vectors are a second
+        embedding of the same size that is only used for training.
         """
-        super(W2VSkipGramEmbedding, self).__init__()
+        super(W2VNegativeSamplingEmbedding, self).__init__()
 
-        # Linear Layer VxN
         self.embeddings = embeddings
 
-        # Linear Layer NxV
-        self.fc = nn.Linear(self.embeddings.embedding_dim, self.embeddings.num_embeddings)
+        # Context vectors start at zero like in word2vec
+        self.context_embeddings = nn.Embedding(self.embeddings.num_embeddings, self.embeddings.embedding_dim)
+        self.context_embeddings.weight.data.zero_()
 
-    def forward(self, input) -> torch.FloatTensor:
+    def forward(self, centers, contexts, negatives):
         """
-        Make forward pass through the network and calculate result.
-
-        :param input: A one hot Tensor representing the input word.
-        :return: An output Tensor representing the probabilites of each word to be in context (One hot representation)
+        :param centers: BATCH_SIZE center word ids
+        :param contexts: BATCH_SIZE context word ids
+        :param negatives: Noise word ids, shared by all pairs of the batch
+        :return: Average negative log-likelihood of the pairs
         """
+        center_vectors = self.embeddings(centers)
+
+        positive = functional.logsigmoid((self.context_embeddings(contexts) * center_vectors).sum(1))
+        negative = functional.logsigmoid(-center_vectors.mm(self.context_embeddings(negatives).t()))
+
+        return -(positive + negative.sum(1)).mean()
 
-        # Get the feature vector
-        hidden_embedding = self.embeddings(input).view(1, -1)
 
-        # Calculate values for context probabilities from feature vector
-        out = self.fc(hidden_embedding)
+def window_pairs(tokens, sentences, window, center_windows=None):
+    """
+    All (center, context) pairs of words that are at most window words apart within the same sentence.
 
-        # Convert output to probabilities with logarithmic softmax.
-        out = functional.log_softmax(out)
+    :param tokens: Id array
+    :param sentences: Sentence index of every token
+    :param center_windows: Window of every center word (at most window), default: window for all words
+    :return: Arrays of the center ids and of the context ids
+    """
+    centers = []
+    contexts = []
 
-        return out
+    for distance in range(1, window + 1):
+        same = sentences[distance:] == sentences[:len(sentences) - distance]
+        left = np.flatnonzero(same)
+        right = left + distance
 
+        # Both directions: the left word is the context of the right one and vice versa
+        if center_windows is None:
+            centers += [tokens[left], tokens[right]]
+            contexts += [tokens[right], tokens[left]]
+        else:
+            left_center = left[center_windows[left] >= distance]
+            right_center = right[center_windows[right] >= distance]
+
+            centers += [tokens[left_center], tokens[right_center]]
+            contexts += [tokens[left_center + distance], tokens[right_center - distance]]
+
+    return np.concatenate(centers), np.concatenate(contexts)
+
+
+def unigram_table(counts, power=0.75, table_size=1000000):
+    """
+    Noise distribution of word2vec: every id occurs in the table in proportion to count^power, so drawing random
+    positions of the table samples the noise words.
+
+    :param counts: Number of occurrences of every id
+    """
+    probabilities = np.asarray(counts, dtype=np.float64) ** power
+    probabilities /= probabilities.sum()
+
+    return np.repeat(np.arange(len(probabilities)), np.round(probabilities * table_size).astype(np.int64))
 
-def train(network, instances, voc, number_epochs=1,
-          plot_loss=False):
-    loss_calc = nn.NLLLoss()
 
-    optimizer = optim.SGD(network.parameters(), lr=0.001)
+def train_negative_sampling(network, pairs, noise_table, number_epochs=5, batch_size=4096, negatives=5,
+                            learning_rate=0.01, min_steps=1000, print_loss=False):
+    """
+    Trains a W2VNegativeSamplingEmbedding in minibatches, the pairs of every chunk are shuffled.
 
-    plt.ion()
+    :param pairs: Chunks of (center ids, context ids) arrays, iterated once per epoch (e.g. SkipGramPairs)
+    :param noise_table: See unigram_table
+    :param negatives: Number of noise words per batch
+    :param min_steps: Minimum number of optimizer steps. A small corpus (e.g. a single bAbI task keeps only about 1.5k
+                      pairs per epoch after subsampling) is trained for more epochs until it has made that many steps,
+                      with only number_epochs steps the embedding barely moves from its initialisation.
+    :return: Average loss of every epoch
+    """
+    noise_table = torch.from_numpy(np.asarray(noise_table, dtype=np.int64))
 
+    optimizer = optim.Adam(network.parameters(), lr=learning_rate)
     loss_history = []
+    print_every = 1
+
+    epoch = 0
+    while epoch < number_epochs:
+        epoch_loss = 0.0
+        epoch_pairs = 0
+        epoch_steps = 0
+
+        for centers, contexts in pairs:
+            centers = torch.from_numpy(centers)
+            contexts = torch.from_numpy(contexts)
+            order = torch.randperm(len(centers))
+
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                noise = noise_table[torch.randint(len(noise_table), (negatives,))]
+
+                loss = network(centers[batch], contexts[batch], noise)
+
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+                epoch_loss += loss.item() * len(batch)
+                epoch_steps += 1
 
-    for epoch in range(number_epochs):
-        epoch_loss = 0
+            epoch_pairs += len(order)
 
-        for instance in instances:
-            # Using a random context word for training
-            input_id = voc.word_to_id(instance.word)
-            target_id = voc.word_to_id(instance.get_random_context())
+        loss_history.append(epoch_loss / max(epoch_pairs, 1))
 
-            network_input = autograd.Variable(torch.LongTensor([input_id]))
-            network_target = autograd.Variable(torch.LongTensor([target_id]))
+        # The first epoch tells how many steps an epoch makes
+        if epoch == 0 and 0 < epoch_steps * number_epochs < min_steps:
+            if epoch_pairs < batch_size:
+                print("Only " + str(epoch_pairs) + " pairs per epoch, less than one batch of " + str(batch_size) +
+                      ". The subsampling threshold may be too low for this corpus.")
 
-            context_probabilities = network.forward(network_input)
+            number_epochs = -(-min_steps // epoch_steps)
+            print_every = max(number_epochs // 10, 1)
+            print("Training for " + str(number_epochs) + " epochs to make at least " + str(min_steps) + " steps.")
 
-            loss = loss_calc.forward(context_probabilities, network_target)
+        if print_loss and (epoch % print_every == 0 or epoch == number_epochs - 1):
+            print("Loss per pair of Epoch " + str(epoch) + ": " + str(loss_history[-1]) + " (" + str(epoch_pairs) +
+                  " pairs)")
 
-            optimizer.zero_grad()
+        epoch += 1
 
-            loss.backward()
+    return loss_history
 
-            optimizer.step()
 
-            epoch_loss += loss.data[0]
+def train_embedding(pairs, embedding_size, number_epochs=5, batch_size=4096, negatives=5, learning_rate=0.01,
+                    min_steps=1000, print_loss=False):
+    """
+    Trains a word2vec embedding on the pairs of a corpus, e.g. the facts and questions of the bAbI tasks.
 
-        loss_instance = epoch_loss / len(instances)
-        loss_history.append(loss_instance)
+    :param pairs: SkipGramPairs of the corpus
+    :return: nn.Embedding(pairs.voc_size, embedding_size) indexed by the ids of the pairs. It can be handed to QAModel
+             as custom_embedding if those are the ids of the model's vocabulary (otherwise see remap_embedding).
+    """
+    embedding = nn.Embedding(pairs.voc_size, embedding_size)
+    embedding.weight.data.uniform_(-0.5 / embedding_size, 0.5 / embedding_size)
 
-        print("Loss per instance of Epoch " + str(epoch) + ": " + str(loss_instance))
-        plt.plot(loss_history)
-        plt.pause(0.001)
+    train_negative_sampling(W2VNegativeSamplingEmbedding(embedding), pairs, unigram_table(pairs.counts),
+                            number_epochs, batch_size, negatives, learning_rate, min_steps, print_loss)
+
+    return embedding
+
+
+def remap_embedding(weights, source_voc, target_voc):
+    """
+    Rearranges the rows of an embedding for another vocabulary, e.g. the embedding of main() (trained over all tasks)
+    for the sorted vocabulary of a single task in main.py.
+
+    :param weights: Embedding weight matrix indexed by the ids of source_voc
+    :return: Weight matrix with len(target_voc) rows indexed by the ids of target_voc. Words that source_voc does not
+             know get small random vectors like the ones train_embedding starts from.
+    """
+    embedding_size = weights.size(1)
+    remapped = torch.empty(len(target_voc), embedding_size).uniform_(-0.5 / embedding_size, 0.5 / embedding_size)
+
+    target_ids = []
+    source_ids = []
+    for word, target_id in target_voc.voc_dict.items():
+        if word in source_voc.voc_dict and target_id < len(target_voc):
+            target_ids.append(target_id)
+            source_ids.append(source_voc.voc_dict[word])
+
+    remapped[torch.LongTensor(target_ids)] = weights.detach().float()[torch.LongTensor(source_ids)]
+
+    return remapped
+
+
+def load_embedding(directory, voc):
+    """
+    Loads the embedding.tensor and vocabulary.pickle written by main() from directory.
+
+    :return: The weights remapped to voc, see remap_embedding
+    """
+    with open(os.path.join(directory, "vocabulary.pickle"), "rb") as f:
+        source_voc = bd.Vocabulary(vocabulary_dict=pickle.load(f))
+
+    return remap_embedding(torch.load(os.path.join(directory, "embedding.tensor")), source_voc, voc)
+
+
+def sentences_from_files(paths, voc):
+    """
+    Tokenises the facts and questions of bAbI files (every file once), new words are added to the vocabulary.
+
+    :return: Flat id array of all sentences and the sentence offsets
+    """
+    tokens = []
+    lengths = []
+
+    for path in paths:
+        sentences = [ids for _, ids, _, _ in bd.iter_babi_file(path, voc, extend_vocabulary=True)]
+
+        tokens.append(np.concatenate(sentences) if len(sentences) > 0 else np.zeros(0, dtype=np.int64))
+        lengths.append(np.array([len(ids) for ids in sentences], dtype=np.int64))
+
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate(lengths))]).astype(np.int64)
+
+    return np.concatenate(tokens), offsets
 
 
 def main():
     load_predefined = False
-    learning_file = "data/tasks_1-20_v1-2/en/qa1_single-supporting-fact_test.txt"
+    learning_files = sorted(glob.glob("data/tasks_1-20_v1-2/en/qa*_train.txt"))
+    # Same as EMBED_HIDDEN_SIZES in main.py, WORD2VEC_EMBEDDING in main.py loads the embedding into QAModel
+    embedding_size = 50
 
     if load_predefined:
-        voc = bd.Vocabulary()
-
         if os.path.isfile("embedding.tensor") and os.path.isfile("vocabulary.pickle"):
-            voc.embedding.weight.data = torch.load("embedding.tensor")
-            voc.voc_dict = pickle.load(open("vocabulary.pickle", "r"))
+            voc = bd.Vocabulary(vocabulary_dict=pickle.load(open("vocabulary.pickle", "rb")))
+            voc.embedding = nn.Embedding.from_pretrained(torch.load("embedding.tensor"))
             print("Loaded previously defined vocabulary and embedding.")
         else:
             print("could not find  files to load.")
             exit(1)
     else:
-        voc = bd.Vocabulary(learning_file)
-        voc.initialize_embedding()
-
-    w2v_instances = W2VInstance.instances_from_file(learning_file)
-
-    print("Number of training instances: " + str(len(w2v_instances)))
+        start = time.time()
+        voc = bd.Vocabulary()
+        pairs = SkipGramPairs.from_files(learning_files, voc)
 
-    w2v_net = W2VSkipGramEmbedding(voc.embedding)
+        print("Number of training tokens: " + str(len(pairs.tokens)))
 
-    train(w2v_net, w2v_instances, voc, number_epochs=50, plot_loss=True)
+        voc.embedding = train_embedding(pairs, embedding_size, print_loss=True)
 
-    torch.save(voc.embedding.weight.data, "embedding.tensor")
+        print("Training took %.1fs" % (time.time() - start))
 
-    pickle.dump(voc.voc_dict, open("vocabulary.pickle", "wb"))
+        torch.save(voc.embedding.weight.data, "embedding.tensor")
 
-    voc.embedding = w2v_net.embeddings
+        pickle.dump(voc.voc_dict, open("vocabulary.pickle", "wb"))
 
-    cos = nn.CosineSimilarity(dim=1, eps=1e-6)
+    index = EmbeddingIndex.from_embedding(voc.embedding, voc)
+    index.save("embedding_index.pth")
 
     vocs = list(voc.voc_dict.keys())
-    for word in vocs[:50]:
-        word_em = voc.word_to_tensor(word)
-        distances = [(other, cos(voc.word_to_tensor(word), voc.word_to_tensor(other)).data[0]) for other in
-                     voc.voc_dict.keys()]
-
-        distances = [(tup[0], round(tup[1], 2)) for tup in distances]
-        distances = sorted(distances, key=lambda tup: tup[1], reverse=True)
-
-        print(word + " : " + str(distances))
+    for word, neighbours in index.neighbours(vocs[:50], k=len(voc)).items():
+        print(word + " : " + str([(other, round(similarity, 2)) for other, similarity in neighbours]))
 
 
 if __name__ == '__main__':
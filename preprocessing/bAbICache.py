@@ -0,0 +1,71 @@
+"""
+Binary cache of parsed and vectorized bAbI corpora.
+
+A cache file holds the vocabulary and the arrays of the vectorized corpora (see BAbICorpus.to_arrays) in one
+uncompressed .npz file. It is keyed by path, size and modification time of every source file and by the parser
+version, so editing a data file or changing the parser just leads to a new cache file.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from preprocessing import bAbIData as bd
+
+
+def cache_key(paths):
+    """
+    :param paths: The source files the cached data is built from, in a fixed order
+    :return: Hex digest identifying the current state of the files and the parser version
+    """
+    description = [bd.PARSER_VERSION]
+
+    for path in paths:
+        stat = os.stat(path)
+        description.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+
+    return hashlib.sha1(json.dumps(description).encode("utf-8")).hexdigest()
+
+
+def cache_file(cache_dir, paths):
+    return os.path.join(cache_dir, "babi_" + cache_key(paths) + ".npz")
+
+
+def save_corpora(path, voc, corpora):
+    """
+    :param path: The cache file to write
+    :param voc: The vocabulary the corpora were vectorized with
+    :param corpora: Dict of name -> vectorized BAbICorpus
+    """
+    arrays = {"vocabulary": np.array([voc.id_to_word(i) for i in range(len(voc))])}
+
+    for name, corpus in corpora.items():
+        for field, array in corpus.to_arrays().items():
+            arrays[name + "/" + field] = array
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Write to a temporary file first, so an interrupted run never leaves a broken cache file behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_corpora(path):
+    """
+    :return: The vocabulary and a dict of name -> BAbICorpus as stored by save_corpora
+    """
+    with np.load(path, allow_pickle=False) as data:
+        voc = bd.Vocabulary(vocabulary_dict=dict((str(word), i) for i, word in enumerate(data["vocabulary"])))
+
+        fields = {}
+        for key in data.files:
+            if "/" in key:
+                name, field = key.split("/", 1)
+                fields.setdefault(name, {})[field] = data[key]
+
+    return voc, dict((name, bd.BAbICorpus.from_arrays(arrays)) for name, arrays in fields.items())
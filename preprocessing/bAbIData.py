@@ -1,16 +1,22 @@
 # Removed for py2 compability
 # from typing import List
 import re
+import time
 import torch
 import torch.autograd as autograd
 import torch.nn as nn
 import math
-import copy
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import numpy as np
 
+# Bump this whenever tokenisation or vectorization change, it invalidates cached corpora (see bAbICache)
+PARSER_VERSION = 2
+
 
 class Vocabulary:
+    # Shown by ids_to_text for ids that are not in the vocabulary (word_to_id maps unknown words to len(voc))
+    UNKNOWN_WORD = "<unk>"
+
     def __init__(self, file=None, vocabulary_dict=None, embedding=None):
         self.voc_dict = vocabulary_dict if vocabulary_dict is not None else dict()
         self.embedding = embedding
@@ -31,9 +37,54 @@ class Vocabulary:
 
         return rep
 
+    @property
+    def voc_dict(self):
+        return self._voc_dict
+
+    @voc_dict.setter
+    def voc_dict(self, voc_dict):
+        self._voc_dict = voc_dict
+        self._id_words = None
+
+    def _reverse_index(self):
+        """
+        Array mapping ids to words. It is built lazily and dropped whenever the ids change (extend_with_word, sort_ids
+        or assigning voc_dict).
+        """
+        if self._id_words is None:
+            id_words = np.empty(max(self._voc_dict.values()) + 1, dtype=object)
+
+            for word, word_id in self._voc_dict.items():
+                id_words[word_id] = word
+
+            self._id_words = id_words
+
+        return self._id_words
+
     def id_to_word(self, word):
-        rev_subs = {v: k for k, v in self.voc_dict.items()}
-        return rev_subs.get(word)
+        id_words = self._reverse_index()
+
+        if 0 <= word < len(id_words):
+            return id_words[word]
+
+        return None
+
+    def ids_to_text(self, ids):
+        """
+        Decodes a whole matrix of ids at once.
+
+        :param ids: 2-D array (or tensor) of word ids, one sequence per row
+        :return: List with one string per row, the words joined by spaces. Unknown ids are shown as UNKNOWN_WORD.
+        """
+        id_words = self._reverse_index()
+        # One extra slot that all out of range ids are clipped to
+        lookup = np.append(id_words, self.UNKNOWN_WORD)
+        lookup[lookup == None] = self.UNKNOWN_WORD
+
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = np.where((ids >= 0) & (ids < len(id_words)), ids, len(id_words))
+
+        return [' '.join(row) for row in lookup.take(ids).tolist()]
 
     def word_to_id(self, word):
         # This is a trick entry for words that are non existent.
@@ -54,6 +105,7 @@ class Vocabulary:
     def extend_with_word(self, word):
         if word not in self.voc_dict:
             self.voc_dict[word] = len(self.voc_dict)
+            self._id_words = None
 
     def extend_with_text(self, text):
         word_set = set()
@@ -74,13 +126,23 @@ class Vocabulary:
             self.extend_with_word(word)
 
     def sort_ids(self):
+        """
+        Renumbers the words in alphabetical order (<pad> keeps id 0).
+
+        :return: Array mapping every old id (including the unknown id len(voc)) to its new id
+        """
+        self._id_words = None
+        remap = np.arange(len(self.voc_dict) + 1, dtype=np.int64)
         i = 1
 
         for key in sorted(self.voc_dict.keys()):
             if self.voc_dict[key] is not 0:
+                remap[self.voc_dict[key]] = i
                 self.voc_dict[key] = i
                 i += 1
 
+        return remap
+
     def extend_with_lines(self, lines):
         """
         Extends this vocabulary by using the text in the list of text lines given.
@@ -92,7 +154,7 @@ class Vocabulary:
 
     def extend_with_file(self, path="data/qa2_two-supporting-facts_train.txt"):
         with open(path, 'r') as f:
-            self.extend_with_lines(f.readlines())
+            self.extend_with_lines(f)
 
     def initialize_embedding(self, em_dim=-1):
         if em_dim is -1:
@@ -101,6 +163,44 @@ class Vocabulary:
         self.embedding = nn.Embedding(num_embeddings=len(self.voc_dict) + 1, embedding_dim=em_dim)
 
 
+class AnswerIndex:
+    """
+    Closed set of answer candidates: answer index i stands for the vocabulary id answer_ids[i]. The answers of the
+    bAbI tasks are a few locations, objects or yes/no, so an output layer over the answer indices is much smaller than
+    one over the whole vocabulary.
+
+    Answers that are not in the index are mapped to UNKNOWN, which nn.NLLLoss ignores by default.
+    """
+    UNKNOWN = -100
+
+    def __init__(self, answer_ids, voc_size):
+        self.answer_ids = np.asarray(answer_ids, dtype=np.int64)
+
+        self.lookup = np.full(voc_size, AnswerIndex.UNKNOWN, dtype=np.int64)
+        self.lookup[self.answer_ids] = np.arange(len(self.answer_ids))
+
+    def __len__(self):
+        return len(self.answer_ids)
+
+    @staticmethod
+    def from_answers(answers, voc_size):
+        # The distinct answers in ascending id order
+        return AnswerIndex(np.unique(np.asarray(answers, dtype=np.int64)), voc_size)
+
+    def to_index(self, ids):
+        # Ids outside the vocabulary (len(voc) for unknown words) are UNKNOWN as well
+        ids = np.asarray(ids, dtype=np.int64)
+        indices = np.full(ids.shape, AnswerIndex.UNKNOWN, dtype=np.int64)
+
+        known = (ids >= 0) & (ids < len(self.lookup))
+        indices[known] = self.lookup[ids[known]]
+
+        return indices
+
+    def to_ids(self, indices):
+        return self.answer_ids[np.asarray(indices, dtype=np.int64)]
+
+
 class BAbIInstance:
     def __init__(self):
         self.indexed_story = []
@@ -166,35 +266,8 @@ class BAbIInstance:
 
     @staticmethod
     def instances_from_lines(lines):
-        training_instances = []
-
-        ind_lines = BAbIInstance._indexed_lines(lines)
-
-        # Either there is no story or the story begins with a question
-        if len(ind_lines) is 0 or len(ind_lines[0]) > 2:
-            return []
-
-        instance = BAbIInstance()
-
-        current_story = []
-
-        for line in ind_lines:
-            if line[0] is 1:
-                current_story = []
-
-            if len(line) < 3:
-                current_story.append([line[0], line[1]])
-            else:
-                instance.indexed_story = copy.deepcopy(current_story)
-                instance.question = copy.deepcopy(line[1])
-                instance.answer = [line[2]]
-                instance.hints = copy.deepcopy(line[3])
-
-                training_instances.append(instance)
-
-                instance = BAbIInstance()
-
-        return training_instances
+        # Every instance gets its own copy of its story prefix, use BAbICorpus directly to share the facts
+        return BAbICorpus.from_lines(lines).instances()
 
     @staticmethod
     def _indexed_lines(lines):
@@ -234,30 +307,630 @@ class BAbIInstance:
         return indexed_lines
 
 
+# Same tokens as splitting at every non-word character (see BAbIInstance._indexed_lines), in a single pass
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w \n]")
+
+
+class ParseStats:
+    """
+    Throughput of iter_babi_file. The time includes the work of the consumer of the generator.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.seconds = 0.0
+
+    def lines_per_second(self):
+        return self.lines / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        return "%d lines in %.3fs (%.0f lines/s)" % (self.lines, self.seconds, self.lines_per_second())
+
+
+def tokenize(sentence):
+    # Words and punctuation marks (e.g. "?") become separate tokens
+    return _TOKEN_PATTERN.findall(sentence)
+
+
+def parse_line(text):
+    """
+    Tokenises one line of a bAbI file.
+
+    :return: The line number, the words of the sentence and, for questions, the answer and the supporting fact numbers
+             (None otherwise)
+    """
+    number, sentence = text.split(None, 1)
+    answer = None
+    hints = None
+
+    if '?' in sentence:
+        sentence, _, info = sentence.partition('?')
+        sentence += '?'
+
+        info = info.split("\t")
+        answer = info[1]
+        hints = [int(hint) for hint in info[2].split()]
+
+    return int(number), tokenize(sentence), answer, hints
+
+
+def iter_babi_file(path, voc, extend_vocabulary=False, stats=None):
+    """
+    Streaming single-pass parser and vectorizer. The file is read line by line, every line is tokenised once and
+    mapped to ids right away.
+
+    :param path: The bAbI file
+    :param voc: Vocabulary used for the ids
+    :param extend_vocabulary: Assign ids to new words on the fly. Otherwise the vocabulary is frozen and unknown words
+                              get the id len(voc).
+    :param stats: Optional ParseStats that is filled with the number of lines and the time taken
+    :return: Generator of (line number, int64 id array, answer id or None, supporting fact numbers or None)
+    """
+    voc_dict = voc.voc_dict
+    start = time.time()
+    lines = 0
+
+    def to_id(word):
+        word_id = voc_dict.get(word)
+
+        if word_id is None:
+            if not extend_vocabulary:
+                return len(voc_dict)
+            voc.extend_with_word(word)
+            word_id = voc_dict[word]
+
+        return word_id
+
+    with open(path, 'r') as f:
+        for text in f:
+            if not text.strip():
+                continue
+
+            number, words, answer, hints = parse_line(text)
+            ids = np.fromiter((to_id(word) for word in words), dtype=np.int64, count=len(words))
+            lines += 1
+
+            yield number, ids, (to_id(answer) if answer is not None else None), hints
+
+    if stats is not None:
+        stats.lines += lines
+        stats.seconds += time.time() - start
+
+
+class BAbICorpus:
+    """
+    Compact representation of the instances of a bAbI file.
+
+    The facts of every story are stored only once, in one flat token array with sentence offsets. A question just
+    refers to its story and to the end of the story prefix it sees, so a story with k questions does not hold k copies
+    of its facts.
+
+    Per fact:     fact_offsets (the tokens of fact f are tokens[fact_offsets[f]:fact_offsets[f + 1]]), fact_numbers
+    Per story:    story_starts (index of the first fact of the story)
+    Per question: question_story, question_prefix_end (index one past the last fact the question sees),
+                  question_offsets (into question_tokens), answers and hints (the supporting fact numbers)
+
+    The token and answer arrays hold words after parsing and int64 ids after vectorize().
+    """
+
+    def __init__(self):
+        self.tokens = []
+        self.fact_offsets = [0]
+        self.fact_numbers = []
+        self.story_starts = []
+
+        self.question_story = []
+        self.question_prefix_end = []
+        self.question_tokens = []
+        self.question_offsets = [0]
+        self.answers = []
+        self.hints = []
+
+    def __len__(self):
+        return len(self.question_story)
+
+    def add_fact(self, number, words):
+        if number == 1 or len(self.story_starts) == 0:
+            self.story_starts.append(len(self.fact_numbers))
+
+        self.tokens.extend(words)
+        self.fact_offsets.append(len(self.tokens))
+        self.fact_numbers.append(number)
+
+    def add_question(self, number, words, answer, hints):
+        if number == 1 or len(self.story_starts) == 0:
+            self.story_starts.append(len(self.fact_numbers))
+
+        self.question_story.append(len(self.story_starts) - 1)
+        self.question_prefix_end.append(len(self.fact_numbers))
+        self.question_tokens.extend(words)
+        self.question_offsets.append(len(self.question_tokens))
+        self.answers.append(answer)
+        self.hints.append(hints)
+
+    def freeze(self, vectorized=False):
+        """
+        Converts the offset lists (and the tokens and answers of a corpus that was built from ids) into int64 arrays
+        once the corpus is complete.
+        """
+        names = ["fact_offsets", "fact_numbers", "story_starts", "question_story", "question_prefix_end",
+                 "question_offsets"]
+        if vectorized:
+            names += ["tokens", "question_tokens", "answers"]
+
+        for name in names:
+            setattr(self, name, np.asarray(getattr(self, name), dtype=np.int64))
+
+        return self
+
+    def remap_ids(self, remap):
+        """
+        Applies an id mapping (e.g. the one returned by Vocabulary.sort_ids) to a vectorized corpus.
+        """
+        self.tokens = remap[self.tokens]
+        self.question_tokens = remap[self.question_tokens]
+        self.answers = remap[self.answers]
+
+    # Array attributes that fully describe a (frozen) corpus, hints are stored flat with hint_offsets
+    ARRAY_FIELDS = ["tokens", "fact_offsets", "fact_numbers", "story_starts", "question_story", "question_prefix_end",
+                    "question_tokens", "question_offsets", "answers"]
+
+    def to_arrays(self):
+        arrays = dict((name, np.asarray(getattr(self, name))) for name in BAbICorpus.ARRAY_FIELDS)
+        arrays["hint_values"] = np.array([h for hints in self.hints for h in hints], dtype=np.int64)
+        arrays["hint_offsets"] = np.cumsum([0] + [len(hints) for hints in self.hints]).astype(np.int64)
+
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        corpus = BAbICorpus()
+
+        for name in BAbICorpus.ARRAY_FIELDS:
+            setattr(corpus, name, arrays[name])
+
+        hint_values = arrays["hint_values"].tolist()
+        hint_offsets = arrays["hint_offsets"].tolist()
+        corpus.hints = [hint_values[hint_offsets[i]:hint_offsets[i + 1]] for i in range(len(hint_offsets) - 1)]
+
+        return corpus
+
+    def story_bounds(self):
+        """
+        :return: Token offsets (start, end) of the story prefix of every question
+        """
+        return self.fact_offsets[self.story_starts[self.question_story]], self.fact_offsets[self.question_prefix_end]
+
+    def story_lengths(self):
+        starts, ends = self.story_bounds()
+        return ends - starts
+
+    def question_lengths(self):
+        return np.diff(self.question_offsets)
+
+    def flat_story(self, index):
+        start = self.fact_offsets[self.story_starts[self.question_story[index]]]
+        return self.tokens[start:self.fact_offsets[self.question_prefix_end[index]]]
+
+    def question(self, index):
+        return self.question_tokens[self.question_offsets[index]:self.question_offsets[index + 1]]
+
+    def instance(self, index):
+        """
+        Builds a standalone BAbIInstance (with its own copy of the story prefix) for the question with the given index.
+        """
+        instance = BAbIInstance()
+
+        for fact in range(self.story_starts[self.question_story[index]], self.question_prefix_end[index]):
+            instance.indexed_story.append([int(self.fact_numbers[fact]),
+                                           list(self.tokens[self.fact_offsets[fact]:self.fact_offsets[fact + 1]])])
+
+        instance.question = list(self.question(index))
+        instance.answer = [self.answers[index]]
+        instance.hints = list(self.hints[index])
+
+        return instance
+
+    def instances(self):
+        return [self.instance(i) for i in range(len(self))]
+
+    def vectorize(self, voc):
+        self.tokens = np.array(voc.words_to_ids(self.tokens), dtype=np.int64)
+        self.question_tokens = np.array(voc.words_to_ids(self.question_tokens), dtype=np.int64)
+        self.answers = np.array(voc.words_to_ids(self.answers), dtype=np.int64)
+
+    def padded_stories(self, width=None):
+        """
+        :return: Matrix with the zero padded story of every question (vectorized corpus only)
+        """
+        starts, ends = self.story_bounds()
+        return BAbICorpus._padded_rows(self.tokens, starts, ends - starts, width)
+
+    def padded_questions(self, width=None):
+        return BAbICorpus._padded_rows(self.question_tokens, self.question_offsets[:-1], self.question_lengths(),
+                                       width)
+
+    @staticmethod
+    def _padded_rows(tokens, starts, lengths, width=None):
+        if width is None:
+            width = int(lengths.max()) if len(lengths) > 0 else 0
+
+        columns = np.arange(width, dtype=np.int64)
+        positions = np.minimum(starts[:, None] + columns[None, :], max(len(tokens) - 1, 0))
+        tokens = tokens if len(tokens) > 0 else np.zeros(1, dtype=np.int64)
+
+        return np.where(columns[None, :] < lengths[:, None], tokens[positions], 0)
+
+    @staticmethod
+    def from_file(path, voc=None, extend_vocabulary=False, stats=None):
+        """
+        :param voc: If given, the file is parsed and vectorized in a single streaming pass (see iter_babi_file) and
+                    the corpus holds ids. Otherwise it holds words and has to be vectorized later.
+        """
+        if voc is None:
+            with open(path, 'r') as f:
+                return BAbICorpus.from_lines(f.readlines())
+
+        corpus = BAbICorpus()
+
+        for number, ids, answer, hints in iter_babi_file(path, voc, extend_vocabulary, stats):
+            # Either there is no story or the story begins with a question
+            if answer is not None and len(corpus.fact_numbers) == 0 and len(corpus.answers) == 0:
+                return BAbICorpus().freeze(vectorized=True)
+
+            if answer is None:
+                corpus.add_fact(number, ids)
+            else:
+                corpus.add_question(number, ids, answer, hints)
+
+        return corpus.freeze(vectorized=True)
+
+    @staticmethod
+    def from_lines(lines):
+        corpus = BAbICorpus()
+
+        ind_lines = BAbIInstance._indexed_lines(lines)
+
+        # Either there is no story or the story begins with a question
+        if len(ind_lines) == 0 or len(ind_lines[0]) > 2:
+            return corpus.freeze()
+
+        for line in ind_lines:
+            if len(line) < 3:
+                corpus.add_fact(line[0], line[1])
+            else:
+                corpus.add_question(line[0], line[1], line[2], line[3])
+
+        return corpus.freeze()
+
+
 class BAbiDataset(Dataset):
-    def __init__(self, instances, pad_sequences=True):
-        self.instances = instances
+    def __init__(self, corpus, pad_sequences=True):
+        self.corpus = corpus
         self.pad_sequences = pad_sequences
-        self.maxlen_story = max([len(inst.flat_story()) for inst in instances])
-        self.maxlen_question = max([len(inst.question) for inst in instances])
+        self.story_lengths = corpus.story_lengths()
+        self.maxlen_story = int(self.story_lengths.max())
+        self.maxlen_question = int(corpus.question_lengths().max())
+        self.answers = np.asarray(corpus.answers, dtype=np.int64)
 
     def __getitem__(self, index):
-        out_question = np.array(self.instances[index].question)
+        out_question = np.array(self.corpus.question(index))
 
-        out_answer = self.instances[index].answer[0]
-        out_story_len = len(self.instances[index].flat_story())
-        out_question_len = len(self.instances[index].question)
+        out_answer = self.corpus.answers[index]
+        out_story = np.asarray(self.corpus.flat_story(index))
+        out_story_len = len(out_story)
+        out_question_len = len(out_question)
 
         if self.pad_sequences:
-            out_story = np.pad(self.instances[index].flat_story(), pad_width=(0, self.maxlen_story - out_story_len),
-                               mode='constant', constant_values=0)
-        else:
-            out_story = np.array(self.instances[index].flat_story())
+            out_story = np.pad(out_story, pad_width=(0, self.maxlen_story - out_story_len), mode='constant',
+                               constant_values=0)
 
         return out_story, out_question, out_answer, out_story_len, out_question_len
 
     def __len__(self):
-        return len(self.instances)
+        return len(self.corpus)
+
+
+class BAbiTensorDataset(Dataset):
+    """
+    Tensor-resident variant of BAbiDataset.
+
+    The whole vectorized corpus is materialised once into contiguous int64 tensors (padded stories, padded queries,
+    answers and the unpadded lengths). Batches are served by index slicing (see TensorBatchLoader), so there is no
+    per-item Python work during training.
+    """
+
+    def __init__(self, corpus):
+        story_lengths = corpus.story_lengths()
+        query_lengths = corpus.question_lengths()
+
+        self.maxlen_story = int(story_lengths.max())
+        self.maxlen_question = int(query_lengths.max())
+
+        self.stories = torch.from_numpy(corpus.padded_stories(self.maxlen_story))
+        self.queries = torch.from_numpy(corpus.padded_questions(self.maxlen_question))
+        self.answers = torch.from_numpy(np.asarray(corpus.answers, dtype=np.int64))
+        self.story_lengths = torch.from_numpy(story_lengths)
+        self.query_lengths = torch.from_numpy(query_lengths)
+
+    def share_memory_(self):
+        """
+        Moves the tensors into shared memory, so worker processes use them without copying.
+        """
+        for tensor in [self.stories, self.queries, self.answers, self.story_lengths, self.query_lengths]:
+            tensor.share_memory_()
+
+        return self
+
+    def __getitem__(self, index):
+        # index may be an int, a slice or a LongTensor of indices
+        return self.stories[index], self.queries[index], self.answers[index], self.story_lengths[index], \
+               self.query_lengths[index]
+
+    def __len__(self):
+        return self.stories.size(0)
+
+
+class BAbiStoryDataset(Dataset):
+    """
+    Story level variant of BAbiTensorDataset for question independent story encoders (QAModel with
+    question_independent=True): every item is a whole story, up to its last question, together with all of its
+    questions. The story RNN then reads every story once, instead of once per question (see StoryBatchLoader and
+    QAModel.multi_question_forward).
+
+    The questions are stored in story order, the questions of story i are question_offsets[i]:question_offsets[i + 1].
+    question_positions holds the number of story words before every question.
+    """
+
+    def __init__(self, corpus):
+        question_story = np.asarray(corpus.question_story, dtype=np.int64)
+        story_token_starts = np.asarray(corpus.fact_offsets)[np.asarray(corpus.story_starts, dtype=np.int64)]
+        prefix_ends = np.asarray(corpus.fact_offsets)[np.asarray(corpus.question_prefix_end, dtype=np.int64)]
+
+        # Stories without questions are left out, the others are numbered anew
+        questions_per_story = np.bincount(question_story, minlength=len(story_token_starts))
+        has_questions = questions_per_story > 0
+        new_index = np.cumsum(has_questions) - 1
+        question_story = new_index[question_story]
+
+        starts = story_token_starts[has_questions]
+        positions = prefix_ends - story_token_starts[np.asarray(corpus.question_story, dtype=np.int64)]
+        story_lengths = np.zeros(len(starts), dtype=np.int64)
+        np.maximum.at(story_lengths, question_story, positions)
+
+        query_lengths = corpus.question_lengths()
+
+        self.maxlen_story = int(story_lengths.max())
+        self.maxlen_question = int(query_lengths.max())
+
+        self.stories = torch.from_numpy(BAbICorpus._padded_rows(corpus.tokens, starts, story_lengths))
+        self.story_lengths = torch.from_numpy(story_lengths)
+        self.question_offsets = torch.from_numpy(np.concatenate([[0], np.cumsum(questions_per_story[has_questions])]))
+
+        self.queries = torch.from_numpy(corpus.padded_questions(self.maxlen_question))
+        self.query_lengths = torch.from_numpy(query_lengths)
+        self.answers = torch.from_numpy(np.asarray(corpus.answers, dtype=np.int64))
+        self.question_positions = torch.from_numpy(positions)
+
+    def share_memory_(self):
+        for tensor in [self.stories, self.story_lengths, self.question_offsets, self.queries, self.query_lengths,
+                       self.answers, self.question_positions]:
+            tensor.share_memory_()
+
+        return self
+
+    def number_of_questions(self):
+        return self.answers.size(0)
+
+    def __len__(self):
+        return self.stories.size(0)
+
+
+class StoryBatchLoader:
+    """
+    Batches of whole stories of a BAbiStoryDataset, sorted by descending story length (see LengthBucketBatchSampler).
+    batch_size is the number of stories per batch, a batch holds all of their questions.
+
+    Yields stories, story lengths, queries, query lengths, answers, the story (row of the batch) of every question and
+    the number of story words before every question.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, indices=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.batch_sampler = LengthBucketBatchSampler(dataset.story_lengths, batch_size, shuffle, indices)
+
+    def __iter__(self):
+        dataset = self.dataset
+
+        for indices in self.batch_sampler:
+            indices = torch.LongTensor(indices)
+            maxlen = int(dataset.story_lengths[indices[0]])
+
+            # Indices of the questions of the batch stories and the row of their story
+            starts = dataset.question_offsets[indices]
+            counts = dataset.question_offsets[indices + 1] - starts
+            question_story = torch.repeat_interleave(torch.arange(len(indices)), counts)
+            first_of_story = torch.cumsum(counts, 0) - counts
+            questions = starts[question_story] + torch.arange(int(counts.sum())) - first_of_story[question_story]
+
+            yield dataset.stories[indices, :maxlen], dataset.story_lengths[indices], dataset.queries[questions], \
+                  dataset.query_lengths[questions], dataset.answers[questions], question_story, \
+                  dataset.question_positions[questions]
+
+    def number_of_questions(self):
+        if self.batch_sampler.indices is None:
+            return self.dataset.number_of_questions()
+
+        offsets = self.dataset.question_offsets
+        indices = self.batch_sampler.indices
+        return int((offsets[indices + 1] - offsets[indices]).sum())
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def padding_ratio(self):
+        return self.batch_sampler.padding_ratio()
+
+
+def stratified_sample(labels, size, seed=0):
+    """
+    Indices of a sample of size instances in which every label (answer) has the same share as in labels.
+
+    The instances are shuffled, grouped by label and every (len(labels) / size)-th of them is taken, so each label is
+    represented in proportion to its frequency. A fixed seed gives the same sample in every run and epoch, the global
+    random number generators are not touched.
+
+    :return: Sorted int64 array of indices, all indices if size >= len(labels)
+    """
+    labels = np.asarray(labels)
+    n = len(labels)
+
+    if size >= n:
+        return np.arange(n, dtype=np.int64)
+
+    order = np.random.RandomState(seed).permutation(n)
+    by_label = order[np.argsort(labels[order], kind='stable')]
+    picks = np.floor((np.arange(size) + 0.5) * n / size).astype(np.int64)
+
+    return np.sort(by_label[picks])
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups instances of similar story length.
+
+    The instances are sorted by story length in descending order (ties are broken randomly if shuffle is set) and cut
+    into batches of batch_size, so every batch is already in the descending order pack_padded_sequence needs and only
+    has to be padded to the length of its first story. The order of the batches is shuffled every epoch.
+    """
+
+    def __init__(self, lengths, batch_size=1, shuffle=True, indices=None):
+        """
+        :param lengths: Unpadded story length of every instance (sequence or tensor)
+        :param batch_size: Number of instances per batch
+        :param shuffle: Shuffle ties within a length and the order of the batches
+        :param indices: Only sample these instances (e.g. a subsample of the test set)
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.indices = None
+
+        if indices is not None:
+            self.indices = torch.as_tensor(np.asarray(indices, dtype=np.int64))
+            lengths = lengths[self.indices.numpy()]
+
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        n = len(self.lengths)
+
+        if self.shuffle:
+            order = torch.randperm(n)
+        else:
+            order = torch.arange(0, n).long()
+
+        # Stable sort keeps the random order among equal lengths
+        _, by_length = torch.sort(-self.lengths[order], stable=True)
+        order = order[by_length]
+
+        if self.indices is not None:
+            order = self.indices[order]
+
+        batches = list(torch.split(order, self.batch_size))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def padding_ratio(self, pad_to=None):
+        """
+        Share of story positions in an epoch that are padding.
+
+        :param pad_to: If given, the ratio for padding every story to this length (e.g. the corpus maximum) is
+        returned instead of the ratio for per-batch padding.
+        """
+        total = int(self.lengths.sum())
+
+        if pad_to is not None:
+            padded = pad_to * len(self.lengths)
+        else:
+            # The batch maxima only depend on the sorted lengths, not on the tie breaking
+            sorted_lengths, _ = torch.sort(self.lengths, descending=True)
+            padded = sum(int(batch[0]) * len(batch) for batch in torch.split(sorted_lengths, self.batch_size))
+
+        return 1.0 - float(total) / padded if padded > 0 else 0.0
+
+
+class TensorBatchLoader:
+    """
+    Drop-in replacement for a DataLoader over a BAbiTensorDataset. Every epoch draws one randperm (if shuffle is set)
+    and yields batches by slicing the dataset tensors with it.
+
+    With bucket_by_length the batches come from a LengthBucketBatchSampler: they are sorted by descending story length
+    and the stories are only padded to the longest story of the batch. Queries keep the corpus wide padding, because
+    the query RNN runs over the padded question and its code would otherwise depend on the batch.
+
+    If indices are given, only these instances are served (e.g. a subsample of the test set).
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, bucket_by_length=False, indices=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.indices = None if indices is None else torch.as_tensor(np.asarray(indices, dtype=np.int64))
+        self.batch_sampler = LengthBucketBatchSampler(dataset.story_lengths, batch_size, shuffle,
+                                                      self.indices) if bucket_by_length else None
+
+    def __iter__(self):
+        if self.batch_sampler is not None:
+            for indices in self.batch_sampler:
+                indices = torch.LongTensor(indices)
+                maxlen = int(self.dataset.story_lengths[indices[0]])
+
+                yield self.dataset.stories[indices, :maxlen], self.dataset.queries[indices], \
+                      self.dataset.answers[indices], self.dataset.story_lengths[indices], \
+                      self.dataset.query_lengths[indices]
+
+            return
+
+        n = self.size()
+
+        if self.shuffle:
+            order = torch.randperm(n)
+        else:
+            order = torch.arange(0, n).long()
+
+        if self.indices is not None:
+            order = self.indices[order]
+
+        for start in range(0, n, self.batch_size):
+            yield self.dataset[order[start:start + self.batch_size]]
+
+    def size(self):
+        # Number of instances served per epoch
+        return len(self.dataset) if self.indices is None else len(self.indices)
+
+    def __len__(self):
+        return (self.size() + self.batch_size - 1) // self.batch_size
+
+    def padding_ratio(self):
+        """
+        Share of story positions that are padding, for per-batch padding if bucketing is used and for padding to
+        maxlen_story otherwise.
+        """
+        sampler = self.batch_sampler
+        if sampler is None:
+            sampler = LengthBucketBatchSampler(self.dataset.story_lengths, self.batch_size, False, self.indices)
+            return sampler.padding_ratio(pad_to=self.dataset.maxlen_story)
+
+        return sampler.padding_ratio()
 
 
 def main():
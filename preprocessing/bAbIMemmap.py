@@ -0,0 +1,286 @@
+"""
+Memory-mapped columnar format for bAbI corpora that do not fit into RAM.
+
+A corpus directory holds one raw int64 file per column (the BAbICorpus arrays plus per-question story starts and
+lengths) and a meta.json with the column lengths. BAbIMemmapWriter fills such a directory while the source file is
+read line by line, and BAbiMemmapDataset opens it with np.memmap, so batches are gathered straight from the mapped
+pages and DataLoader workers share the same page cache instead of holding copies of the corpus.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from preprocessing import bAbIData as bd
+from preprocessing.bAbICache import cache_key
+
+COLUMNS = bd.BAbICorpus.ARRAY_FIELDS + ["hint_values", "hint_offsets", "question_story_start", "story_lengths",
+                                        "question_lengths"]
+
+
+class _Column:
+    """
+    Append-only int64 column that is flushed to its file whenever the buffer gets large.
+    """
+
+    def __init__(self, path, initial=None, buffer_size=1 << 16):
+        self.file = open(path, "wb")
+        self.buffer = [] if initial is None else list(initial)
+        self.buffer_size = buffer_size
+        self.length = 0
+
+    def append(self, value):
+        self.buffer.append(value)
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def extend(self, values):
+        self.buffer.extend(values)
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        np.asarray(self.buffer, dtype=np.int64).tofile(self.file)
+        self.length += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class BAbIMemmapWriter:
+    """
+    Writes a corpus directory incrementally. It has the same add_fact/add_question interface as a vectorized
+    BAbICorpus (ids, e.g. from iter_babi_file), but keeps only small buffers in memory.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+
+        offsets = ["fact_offsets", "question_offsets", "hint_offsets"]
+        self.columns = dict((name, _Column(os.path.join(directory, name + ".bin"), [0] if name in offsets else None))
+                            for name in COLUMNS)
+
+        self.n_tokens = 0
+        self.n_facts = 0
+        self.n_stories = 0
+        self.n_question_tokens = 0
+        self.n_hints = 0
+        self.story_token_start = 0
+        self.maxlen_story = 0
+        self.maxlen_question = 0
+
+    def _start_story_if_needed(self, number):
+        if number == 1 or self.n_stories == 0:
+            self.columns["story_starts"].append(self.n_facts)
+            self.n_stories += 1
+            self.story_token_start = self.n_tokens
+
+    def add_fact(self, number, ids):
+        self._start_story_if_needed(number)
+
+        self.columns["tokens"].extend(ids)
+        self.n_tokens += len(ids)
+        self.n_facts += 1
+        self.columns["fact_offsets"].append(self.n_tokens)
+        self.columns["fact_numbers"].append(number)
+
+    def add_question(self, number, ids, answer, hints):
+        self._start_story_if_needed(number)
+
+        story_length = self.n_tokens - self.story_token_start
+        self.maxlen_story = max(self.maxlen_story, story_length)
+        self.maxlen_question = max(self.maxlen_question, len(ids))
+
+        self.columns["question_story"].append(self.n_stories - 1)
+        self.columns["question_prefix_end"].append(self.n_facts)
+        self.columns["question_story_start"].append(self.story_token_start)
+        self.columns["story_lengths"].append(story_length)
+
+        self.columns["question_tokens"].extend(ids)
+        self.n_question_tokens += len(ids)
+        self.columns["question_offsets"].append(self.n_question_tokens)
+        self.columns["question_lengths"].append(len(ids))
+
+        self.columns["answers"].append(answer)
+        self.columns["hint_values"].extend(hints)
+        self.n_hints += len(hints)
+        self.columns["hint_offsets"].append(self.n_hints)
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+
+        meta = {
+            "parser_version": bd.PARSER_VERSION,
+            "maxlen_story": self.maxlen_story,
+            "maxlen_question": self.maxlen_question,
+            "columns": dict((name, column.length) for name, column in self.columns.items())
+        }
+
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+
+def convert_file(path, directory, voc, stats=None):
+    """
+    Converts a bAbI file into a corpus directory, reading it line by line.
+
+    :param path: The bAbI text file
+    :param directory: The corpus directory to write
+    :param voc: The vocabulary used for vectorizing, it is not extended. Unknown words get the id len(voc).
+    :param stats: Optional ParseStats
+    """
+    writer = BAbIMemmapWriter(directory)
+
+    for number, ids, answer, hints in bd.iter_babi_file(path, voc, stats=stats):
+        if answer is None:
+            writer.add_fact(number, ids)
+        else:
+            writer.add_question(number, ids, answer, hints)
+
+    writer.close()
+
+
+class BAbIMemmapCorpus:
+    """
+    Read-only view of a corpus directory. All columns are np.memmap arrays, so opening does not depend on the corpus
+    size and only the pages touched by a batch are read.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        self.maxlen_story = self.meta["maxlen_story"]
+        self.maxlen_question = self.meta["maxlen_question"]
+
+        for name, length in self.meta["columns"].items():
+            if length > 0:
+                column = np.memmap(os.path.join(directory, name + ".bin"), dtype=np.int64, mode='r', shape=(length,))
+            else:
+                column = np.zeros(0, dtype=np.int64)
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.answers)
+
+    def batch(self, indices, answer_index=None):
+        """
+        Gathers a batch from the mapped columns. Like the LengthBucketBatchSampler batches it is sorted by descending
+        story length and the stories are padded to the longest story of the batch, queries to the corpus maximum.
+
+        :param answer_index: bAbIData.AnswerIndex the answers are mapped to, None keeps the vocabulary ids
+        :return: stories, queries, answers, story lengths and query lengths as int64 tensors
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        story_lengths = np.asarray(self.story_lengths[indices])
+
+        order = np.argsort(-story_lengths, kind='stable')
+        indices = indices[order]
+        story_lengths = story_lengths[order]
+        query_lengths = np.asarray(self.question_lengths[indices])
+
+        stories = bd.BAbICorpus._padded_rows(self.tokens, np.asarray(self.question_story_start[indices]),
+                                             story_lengths)
+        queries = bd.BAbICorpus._padded_rows(self.question_tokens, np.asarray(self.question_offsets[indices]),
+                                             query_lengths, self.maxlen_question)
+
+        answers = np.asarray(self.answers[indices])
+        if answer_index is not None:
+            answers = answer_index.to_index(answers)
+
+        return torch.from_numpy(stories), torch.from_numpy(queries), torch.from_numpy(answers), \
+               torch.from_numpy(story_lengths), torch.from_numpy(query_lengths)
+
+
+class BAbiMemmapDataset(Dataset):
+    """
+    Dataset over a corpus directory. Items are whole batches: use it with batch_size=None and a batch sampler, e.g.
+    DataLoader(dataset, batch_size=None, sampler=LengthBucketBatchSampler(dataset.story_lengths, ...)).
+
+    The memory maps are opened lazily, so every DataLoader worker maps the files itself instead of receiving a pickled
+    copy of the data.
+
+    With an answer_index (a bAbIData.AnswerIndex) the answers are served as answer indices instead of vocabulary ids,
+    the answer column on disk stays as it is.
+    """
+
+    def __init__(self, directory, answer_index=None):
+        self.directory = directory
+        self.answer_index = answer_index
+        self._corpus = None
+
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.length = meta["columns"]["answers"]
+        self.maxlen_story = meta["maxlen_story"]
+        self.maxlen_question = meta["maxlen_question"]
+
+    @property
+    def corpus(self):
+        if self._corpus is None:
+            self._corpus = BAbIMemmapCorpus(self.directory)
+
+        return self._corpus
+
+    @property
+    def story_lengths(self):
+        return self.corpus.story_lengths
+
+    @property
+    def answers(self):
+        if self.answer_index is not None:
+            return self.answer_index.to_index(self.corpus.answers)
+
+        return self.corpus.answers
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_corpus"] = None
+        return state
+
+    def __getitem__(self, indices):
+        return self.corpus.batch(indices, self.answer_index)
+
+    def __len__(self):
+        return self.length
+
+
+def load_or_convert(voc_path, train_path, test_path, directory="data/memmap"):
+    """
+    Returns the vocabulary and the train and test corpus directories, converting the text files first if there is no
+    up to date conversion in directory yet.
+    """
+    root = os.path.join(directory, cache_key([voc_path, train_path, test_path]))
+    voc_file = os.path.join(root, "vocabulary.json")
+
+    if not os.path.isfile(voc_file):
+        voc = bd.Vocabulary()
+        voc.extend_with_file(voc_path)
+        voc.sort_ids()
+
+        stats = bd.ParseStats()
+        convert_file(train_path, os.path.join(root, "train"), voc, stats)
+        convert_file(test_path, os.path.join(root, "test"), voc, stats)
+        print('Converted %s' % stats)
+
+        # Written last, it marks the conversion as complete
+        with open(voc_file, "w") as f:
+            json.dump([voc.id_to_word(i) for i in range(len(voc))], f)
+
+    with open(voc_file) as f:
+        voc = bd.Vocabulary(vocabulary_dict=dict((word, i) for i, word in enumerate(json.load(f))))
+
+    return voc, os.path.join(root, "train"), os.path.join(root, "test")
@@ -0,0 +1,311 @@
+"""
+Supporting fact retrieval: shortens every story to the k facts that are most relevant to its question.
+
+The story RNN reads every word of a story, the stories of tasks 2 and 3 run to hundreds of words while a question only
+needs two or three facts of it. A FactRetriever indexes the facts of a story by their entities (the words that link
+facts and questions, e.g. names, objects and places) and scores every fact with a few features:
+
+    0  number of question entities in the fact
+    1  the fact is the latest one that mentions a question entity
+    2  recency, 1 / (1 + number of later facts)
+    3  number of entities the fact shares with the latest facts of the question entities (second hop, e.g. the person
+       who picked up the football the question asks about)
+    4  the fact is the latest one that mentions such a second hop entity
+
+plus the words of the fact. The hand set DEFAULT_WEIGHTS only use the first five, fit() learns all weights from the
+supporting facts (hints) of a training corpus with a logistic regression. The k best facts are kept in story order.
+
+retrieve_corpus builds the derived corpus, in which every question has its own story of at most k facts. Fact
+numbers and hints are kept, so hint_recall tells how many questions still see all of their supporting facts.
+"""
+from __future__ import print_function
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from preprocessing.bAbIData import BAbICorpus
+
+N_FEATURES = 5
+DEFAULT_WEIGHTS = np.array([1., 2., 0.5, 0.5, 1.])
+
+
+def entity_words(corpus, voc_size, max_fact_share=0.5):
+    """
+    Words that link facts and questions: all words of the facts except those that occur in more than max_fact_share
+    of the facts ("the", "to", "."). The padding id is never an entity.
+
+    :return: Boolean array over the vocabulary ids
+    """
+    fact_ids = np.repeat(np.arange(len(corpus.fact_numbers)), np.diff(corpus.fact_offsets))
+    # Every word counts once per fact
+    pairs = np.unique(np.stack([fact_ids, np.asarray(corpus.tokens, dtype=np.int64)]), axis=1)
+    fact_counts = np.bincount(pairs[1], minlength=voc_size)
+
+    entities = (fact_counts > 0) & (fact_counts <= max_fact_share * max(len(corpus.fact_numbers), 1))
+    entities[0] = False
+
+    return entities
+
+
+class StoryIndex:
+    """
+    The facts of one story with an inverted index from every entity to the (ascending) positions of the facts that
+    mention it. Facts are added in story order, the index always covers the story so far.
+    """
+
+    def __init__(self, entity_mask):
+        self.entity_mask = entity_mask
+        self.facts = []
+        self.entities = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.facts)
+
+    def add(self, fact):
+        position = len(self.facts)
+        entities = set(fact[self.entity_mask[fact]].tolist())
+
+        self.facts.append(fact)
+        self.entities.append(entities)
+
+        for entity in entities:
+            self.index.setdefault(entity, []).append(position)
+
+    def features(self, query):
+        """
+        :param query: Question ids
+        :return: Matrix with the features of every fact of the story so far
+        """
+        n = len(self.facts)
+        features = np.zeros((n, N_FEATURES))
+        features[:, 2] = 1. / (n - np.arange(n))
+
+        question = set(query[self.entity_mask[query]].tolist())
+        latest = set()
+
+        for entity in question:
+            positions = self.index.get(entity)
+            if positions:
+                features[positions, 0] += 1
+                latest.add(positions[-1])
+
+        features[list(latest), 1] = 1
+
+        second_hop = set()
+        for position in latest:
+            second_hop |= self.entities[position]
+        second_hop -= question
+
+        for entity in second_hop:
+            positions = self.index[entity]
+            features[positions, 3] += 1
+
+            # The latest fact of the entity apart from the first hop facts it was found in
+            for position in reversed(positions):
+                if position not in latest:
+                    features[position, 4] = 1
+                    break
+
+        return features
+
+
+class FactRetriever:
+    """
+    Selects the k facts of a story with the highest relevance scores for a question, ties go to the later fact.
+
+    :param k: Number of facts kept per question
+    :param entity_mask: Boolean array over the vocabulary ids, see entity_words
+    :param weights: Weights of the N_FEATURES features (default: DEFAULT_WEIGHTS)
+    :param word_weights: Weight of every vocabulary id, added to the score of the facts that contain it
+                         (default: zeros)
+    """
+
+    def __init__(self, k, entity_mask, weights=None, word_weights=None):
+        self.k = k
+        self.entity_mask = np.asarray(entity_mask, dtype=bool)
+        self.weights = DEFAULT_WEIGHTS.copy() if weights is None else np.asarray(weights, dtype=np.float64)
+        self.word_weights = np.zeros(len(self.entity_mask)) if word_weights is None else \
+            np.asarray(word_weights, dtype=np.float64)
+
+    @staticmethod
+    def fact_words(facts):
+        # The distinct words of every fact as flat ids and the number of words per fact, only built by fit
+        words = [np.unique(fact) for fact in facts]
+        return np.concatenate(words) if len(words) > 0 else np.zeros(0, dtype=np.int64), [len(w) for w in words]
+
+    def word_scores(self, facts):
+        # Sum of the word weights of every fact, every word counts once per fact
+        return np.array([self.word_weights[np.unique(fact)].sum() for fact in facts])
+
+    def scores(self, story_index, query):
+        scores = story_index.features(query).dot(self.weights)
+
+        if self.word_weights.any():
+            scores += self.word_scores(story_index.facts)
+
+        return scores
+
+    def select_positions(self, story_index, query):
+        """
+        :return: Ascending positions of the selected facts of the story so far
+        """
+        n = len(story_index)
+        if n <= self.k:
+            return np.arange(n)
+
+        positions = np.arange(n)
+        # lexsort sorts by the last key first
+        best = np.lexsort((-positions, -self.scores(story_index, query)))[:self.k]
+
+        return np.sort(best)
+
+    def select(self, facts, query):
+        """
+        :param facts: List of the fact id arrays of a story
+        :param query: Question ids
+        :return: List of the selected facts, in story order
+        """
+        story_index = StoryIndex(self.entity_mask)
+        for fact in facts:
+            story_index.add(fact)
+
+        return [facts[i] for i in self.select_positions(story_index, query)]
+
+    def fit(self, corpus, max_questions=5000, epochs=300, learning_rate=0.05, weight_decay=1e-4, seed=0):
+        """
+        Learns the weights with a logistic regression that predicts for every fact of a story prefix whether it is a
+        supporting fact of the question.
+
+        :param corpus: Vectorized BAbICorpus with hints
+        :param max_questions: Number of randomly chosen training questions
+        """
+        rng = np.random.RandomState(seed)
+        chosen = set(rng.choice(len(corpus), min(max_questions, len(corpus)), replace=False).tolist())
+
+        features = []
+        words = []
+        fact_lengths = []
+        labels = []
+
+        for index, question, story_index in _iter_questions(corpus, self.entity_mask):
+            if question not in chosen:
+                continue
+
+            facts = range(index, index + len(story_index))
+            features.append(story_index.features(corpus.question(question)))
+            labels.append(np.isin(np.asarray(corpus.fact_numbers)[list(facts)], corpus.hints[question]))
+
+            fact_words, lengths = self.fact_words(story_index.facts)
+            words.append(fact_words)
+            fact_lengths += lengths
+
+        features = torch.from_numpy(np.vstack(features)).float()
+        labels = torch.from_numpy(np.concatenate(labels).astype(np.float32))
+
+        # The word features are sparse: the (fact, word) pairs instead of a dense facts x vocabulary matrix, the word
+        # score of a fact is the sum of the weights of its pairs
+        words = torch.from_numpy(np.concatenate(words).astype(np.int64))
+        rows = torch.from_numpy(np.repeat(np.arange(len(fact_lengths)), fact_lengths))
+
+        model = nn.Linear(N_FEATURES, 1)
+        word_weights = nn.Parameter(torch.zeros(len(self.word_weights), 1))
+
+        optimizer = torch.optim.Adam(list(model.parameters()) + [word_weights], lr=learning_rate,
+                                     weight_decay=weight_decay)
+        criterion = nn.BCEWithLogitsLoss()
+
+        for epoch in range(epochs):
+            optimizer.zero_grad()
+            word_scores = torch.zeros(len(labels), 1).index_add(0, rows, word_weights[words])
+            loss = criterion((model(features) + word_scores).view(-1), labels)
+            loss.backward()
+            optimizer.step()
+
+        self.weights = model.weight.data.view(-1).double().numpy().copy()
+        self.word_weights = word_weights.data.view(-1).double().numpy().copy()
+
+        return loss.item()
+
+    def save(self, path):
+        np.savez(path, k=self.k, entity_mask=self.entity_mask, weights=self.weights, word_weights=self.word_weights)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            return FactRetriever(int(data["k"]), data["entity_mask"], data["weights"], data["word_weights"])
+
+
+def _iter_questions(corpus, entity_mask):
+    # Yields (index of the first fact of the story, question, StoryIndex of the story prefix of the question). The
+    # StoryIndex of a story grows from question to question.
+    fact_offsets = np.asarray(corpus.fact_offsets)
+    tokens = np.asarray(corpus.tokens)
+    story_starts = np.asarray(corpus.story_starts)
+
+    story = -1
+    story_index = None
+
+    for question in range(len(corpus)):
+        if corpus.question_story[question] != story:
+            story = corpus.question_story[question]
+            story_index = StoryIndex(entity_mask)
+
+        start = story_starts[story]
+        for fact in range(start + len(story_index), corpus.question_prefix_end[question]):
+            story_index.add(tokens[fact_offsets[fact]:fact_offsets[fact + 1]])
+
+        yield start, question, story_index
+
+
+def retrieve_corpus(corpus, retriever):
+    """
+    :param corpus: Vectorized BAbICorpus
+    :return: Derived corpus in which every question has its own story with the facts selected by the retriever
+    """
+    fact_numbers = np.asarray(corpus.fact_numbers)
+
+    tokens = []
+    fact_offsets = [0]
+    numbers = []
+    story_starts = []
+    prefix_ends = []
+
+    for start, question, story_index in _iter_questions(corpus, retriever.entity_mask):
+        story_starts.append(len(numbers))
+
+        for position in retriever.select_positions(story_index, corpus.question(question)):
+            tokens.append(story_index.facts[position])
+            fact_offsets.append(fact_offsets[-1] + len(story_index.facts[position]))
+            numbers.append(fact_numbers[start + position])
+
+        prefix_ends.append(len(numbers))
+
+    derived = BAbICorpus()
+    derived.tokens = np.concatenate(tokens) if len(tokens) > 0 else np.zeros(0, dtype=np.int64)
+    derived.fact_offsets = np.array(fact_offsets, dtype=np.int64)
+    derived.fact_numbers = np.array(numbers, dtype=np.int64)
+    derived.story_starts = np.array(story_starts, dtype=np.int64)
+    derived.question_story = np.arange(len(corpus), dtype=np.int64)
+    derived.question_prefix_end = np.array(prefix_ends, dtype=np.int64)
+    derived.question_tokens = corpus.question_tokens
+    derived.question_offsets = corpus.question_offsets
+    derived.answers = corpus.answers
+    derived.hints = corpus.hints
+
+    return derived
+
+
+def hint_recall(corpus):
+    """
+    :return: Share of the questions whose story prefix contains all of their supporting facts
+    """
+    complete = 0
+
+    for question in range(len(corpus)):
+        start = corpus.story_starts[corpus.question_story[question]]
+        numbers = corpus.fact_numbers[start:corpus.question_prefix_end[question]]
+        complete += int(np.isin(corpus.hints[question], numbers).all())
+
+    return float(complete) / max(len(corpus), 1)
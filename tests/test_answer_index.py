@@ -0,0 +1,70 @@
+"""
+Answers of the test set that never occur in training, with RESTRICT_ANSWERS (main.prepare_answer_index) on in-memory
+and on memory mapped corpora.
+"""
+import numpy as np
+import pytest
+import torch
+
+import main
+import preprocessing.bAbIMemmap as bm
+from preprocessing import bAbIData as bd
+
+TRAIN = """1 Mary went to the hallway.
+2 John went to the bathroom.
+3 Where is Mary?\thallway\t1
+4 Where is John?\tbathroom\t2
+"""
+
+TEST = """1 Mary went to the cellar.
+2 John went to the hallway.
+3 Where is Mary?\tcellar\t1
+4 Where is John?\thallway\t2
+"""
+
+
+@pytest.fixture
+def babi_files(tmp_path):
+    train_path = tmp_path / "train.txt"
+    test_path = tmp_path / "test.txt"
+    train_path.write_text(TRAIN)
+    test_path.write_text(TEST)
+
+    return str(train_path), str(test_path)
+
+
+def load_corpora(babi_files, directory, memmap):
+    train_path, test_path = babi_files
+
+    if memmap:
+        voc, train_dir, test_dir = bm.load_or_convert(train_path, train_path, test_path, directory)
+        return voc, bm.BAbiMemmapDataset(train_dir), bm.BAbiMemmapDataset(test_dir)
+
+    return main.load_vectorized_data(train_path, train_path, test_path)
+
+
+def test_to_index_maps_ids_outside_the_vocabulary_to_unknown():
+    answer_index = bd.AnswerIndex.from_answers([3, 5], voc_size=6)
+
+    assert answer_index.to_index([5, 3, 6, 100]).tolist() == [1, 0, bd.AnswerIndex.UNKNOWN, bd.AnswerIndex.UNKNOWN]
+
+
+@pytest.mark.parametrize("memmap", [False, True])
+def test_unseen_test_answer_is_unknown(babi_files, tmp_path, memmap):
+    voc, train_corpus, test_corpus = load_corpora(babi_files, str(tmp_path / "memmap"), memmap)
+
+    answer_index = main.prepare_answer_index(train_corpus, test_corpus, len(voc))
+
+    assert len(answer_index) == 2
+    assert np.asarray(test_corpus.answers).tolist() == [bd.AnswerIndex.UNKNOWN, answer_index.to_index(
+        voc.word_to_id("hallway")).item()]
+
+    # The loss ignores the unseen answer
+    if memmap:
+        answers = test_corpus[np.arange(len(test_corpus))][2]
+        assert sorted(answers.tolist()) == sorted(np.asarray(test_corpus.answers).tolist())
+    else:
+        answers = torch.from_numpy(np.asarray(test_corpus.answers))
+
+    loss = torch.nn.NLLLoss()(torch.log_softmax(torch.zeros(len(answers), len(answer_index)), 1), answers)
+    assert torch.isfinite(loss)
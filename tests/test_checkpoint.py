@@ -0,0 +1,47 @@
+"""
+Resuming an interrupted training from its checkpoint (main.conduct_training with a checkpoint_path).
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+
+import main
+from model.QAModel import QAModel
+from test_memmap import babi_text
+
+
+def train_for(epochs, corpora, checkpoint_path):
+    # Starts from the same initialisation every time, a resumed run overwrites it from the checkpoint
+    voc, train_corpus, test_corpus = corpora
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    model = QAModel(len(voc), 8, 8, len(voc))
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    train_loader, test_loader = main.prepare_dataloaders(train_corpus, test_corpus, 4)
+
+    histories = main.conduct_training(model, train_loader, test_loader, optimizer, nn.NLLLoss(), epochs=epochs,
+                                      checkpoint_path=checkpoint_path)
+
+    return model, histories
+
+
+def test_resumed_training_matches_uninterrupted_training(tmp_path):
+    train_path = tmp_path / "train.txt"
+    test_path = tmp_path / "test.txt"
+    train_path.write_text(babi_text(12, 0))
+    test_path.write_text(babi_text(6, 1))
+    corpora = main.load_vectorized_data(str(train_path), str(train_path), str(test_path))
+
+    model, histories = train_for(4, corpora, str(tmp_path / "uninterrupted.pth"))
+
+    # Interrupted after two epochs, then restarted with the full number of epochs
+    train_for(2, corpora, str(tmp_path / "resumed.pth"))
+    resumed_model, resumed_histories = train_for(4, corpora, str(tmp_path / "resumed.pth"))
+
+    for name, parameter in model.state_dict().items():
+        assert torch.equal(parameter, resumed_model.state_dict()[name]), name
+
+    # Training and test loss and accuracy histories, the evaluation lists are only those of the last epoch
+    for history, resumed_history in zip(histories[:4], resumed_histories[:4]):
+        assert np.allclose(history, resumed_history)
@@ -0,0 +1,70 @@
+"""
+Start-up time regression checks of cli.py, run with python -m pytest from the repository root. Every import is
+measured in a fresh interpreter (see cli.measure_imports).
+"""
+import json
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+import torch
+
+import cli
+
+# An exported model is loaded without the model classes (see inference.export)
+MODEL_CLASSES = ["model.QAModel", "model.QAModelLSTM"]
+
+# Run in a fresh interpreter: loads an exported model, answers a question and reports the model classes it loaded
+_LOAD_EXPORTED_PROBE = """
+import json, sys
+from inference.export import load_exported
+predictor = load_exported(sys.argv[1], query_cache_size=16)
+story, query = predictor.vectorize("Mary went to the kitchen.", "Where is Mary?")
+predictor.answer_words(predictor.predict([story], [query]))
+print(json.dumps([m for m in sys.argv[2:] if m in sys.modules]))
+"""
+
+
+@pytest.mark.parametrize("name", sorted(cli.SUBCOMMAND_IMPORTS))
+def test_subcommand_does_not_load_forbidden_modules(name):
+    modules, forbidden = cli.SUBCOMMAND_IMPORTS[name]
+    _, loaded = cli.measure_imports(modules, repeats=1)
+
+    assert [module for module in loaded if module in forbidden] == []
+
+
+def test_cli_import_within_budget():
+    seconds, _ = cli.measure_imports(["cli"], repeats=3)
+
+    assert seconds <= cli.IMPORT_BUDGET
+
+
+@pytest.mark.parametrize("module", ["inference.export", "inference.predict"])
+def test_inference_modules_do_not_import_model_classes(module):
+    _, loaded = cli.measure_imports([module], repeats=1, watched=MODEL_CLASSES)
+
+    assert loaded == []
+
+
+def test_load_exported_does_not_import_model_classes(tmp_path):
+    from inference.export import export_run
+    from model.QAModel import QAModel
+
+    # A run directory like the ones of save_results, with an untrained model
+    words = ["<pad>", "Mary", "went", "to", "the", "kitchen", ".", "Where", "is", "?"]
+    run_dir = str(tmp_path)
+    with open(os.path.join(run_dir, "params.txt"), "w") as f:
+        f.write("EMBED_HIDDEN_SIZE: 8\nSTORY_HIDDEN_SIZE: 8\nN_LAYERS: 1\nVOC_SIZE: %d\n" % len(words))
+    with open(os.path.join(run_dir, "vocabulary.pkl"), "wb") as f:
+        pickle.dump(dict((word, i) for i, word in enumerate(words)), f)
+    torch.save(QAModel(len(words), 8, 8, len(words)).state_dict(), os.path.join(run_dir, "trained_model.pth"))
+
+    path = os.path.join(run_dir, "model_scripted.pt")
+    export_run(run_dir, path)
+
+    output = subprocess.check_output([sys.executable, "-c", _LOAD_EXPORTED_PROBE, path] + MODEL_CLASSES,
+                                     cwd=cli._ROOT)
+
+    assert json.loads(output.decode("utf-8").strip().splitlines()[-1]) == []
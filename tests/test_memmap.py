@@ -0,0 +1,80 @@
+"""
+Batches of memory mapped corpora (preprocessing.bAbIMemmap) against the in-memory corpus of the same files.
+"""
+import numpy as np
+import pytest
+
+import main
+import preprocessing.bAbIMemmap as bm
+from preprocessing import bAbIData as bd
+
+NAMES = ["Mary", "John", "Sandra"]
+PLACES = ["kitchen", "garden", "hallway", "office"]
+
+
+def babi_text(n_stories, seed):
+    # Stories of different lengths with a question after every other fact
+    rng = np.random.RandomState(seed)
+    lines = []
+
+    for _ in range(n_stories):
+        number = 1
+        where = {}
+        for fact in range(rng.randint(2, 9)):
+            name, place = NAMES[rng.randint(len(NAMES))], PLACES[rng.randint(len(PLACES))]
+            where[name] = (place, number)
+            lines.append("%d %s went to the %s." % (number, name, place))
+            number += 1
+
+            if fact % 2 == 1:
+                lines.append("%d Where is %s?\t%s\t%d" % (number, name, place, where[name][1]))
+                number += 1
+
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def corpora(tmp_path):
+    train_path = tmp_path / "train.txt"
+    test_path = tmp_path / "test.txt"
+    train_path.write_text(babi_text(12, 0))
+    test_path.write_text(babi_text(6, 1))
+
+    voc, train_dir, test_dir = bm.load_or_convert(str(train_path), str(train_path), str(test_path),
+                                                  str(tmp_path / "memmap"))
+    memory_voc, memory_train, _ = main.load_vectorized_data(str(train_path), str(train_path), str(test_path))
+
+    return voc, bm.BAbiMemmapDataset(train_dir), memory_voc, memory_train
+
+
+def test_memmap_batch_matches_the_in_memory_corpus(corpora):
+    voc, dataset, memory_voc, memory_train = corpora
+    assert voc.voc_dict == memory_voc.voc_dict
+
+    expected = bd.BAbiTensorDataset(memory_train)
+    indices = np.array([5, 0, 3, 1, 7])
+    stories, queries, answers, story_lengths, query_lengths = dataset[indices]
+
+    # Sorted by descending story length, ties keep the order of the indices
+    order = indices[np.argsort(-expected.story_lengths.numpy()[indices], kind='stable')]
+    assert story_lengths.tolist() == expected.story_lengths[order].tolist()
+    assert stories.size(1) == int(story_lengths.max())
+
+    for row, index in enumerate(order):
+        length = int(story_lengths[row])
+        assert stories[row, :length].tolist() == expected.stories[index, :length].tolist()
+        assert stories[row, length:].eq(0).all()
+        assert queries[row].tolist() == expected.queries[index, :queries.size(1)].tolist()
+        assert int(answers[row]) == int(expected.answers[index])
+        assert int(query_lengths[row]) == int(expected.query_lengths[index])
+
+
+def test_memmap_dataset_maps_answers_with_an_answer_index(corpora):
+    voc, dataset, _, _ = corpora
+    answer_index = bd.AnswerIndex.from_answers(dataset.answers, len(voc))
+
+    mapped = bm.BAbiMemmapDataset(dataset.directory, answer_index)
+    indices = np.arange(len(dataset))
+
+    assert answer_index.to_ids(mapped[indices][2].numpy()).tolist() == dataset[indices][2].tolist()
+    assert answer_index.to_ids(mapped.answers).tolist() == np.asarray(dataset.answers).tolist()
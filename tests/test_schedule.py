@@ -0,0 +1,27 @@
+"""
+Early stopping of utils.schedule.EvaluationSchedule.
+"""
+from utils.schedule import EvaluationSchedule
+
+
+def test_patience_only_counts_full_evaluations():
+    schedule = EvaluationSchedule(eval_every=2, subsample_size=100, patience=2)
+    state = schedule.initial_state()
+
+    assert not schedule.update(state, 1.0, 50., full=True)
+    # Subsample losses are noisier than the full ones, they neither improve nor worsen the best loss
+    assert not schedule.update(state, 2.0, 40., full=False)
+    assert not schedule.update(state, 0.1, 60., full=False)
+    assert state == {"best_loss": 1.0, "bad_evaluations": 0, "stopped": False}
+
+    assert not schedule.update(state, 1.2, 50., full=True)
+    assert schedule.update(state, 1.1, 50., full=True)
+
+
+def test_target_accuracy_needs_a_full_evaluation():
+    schedule = EvaluationSchedule(eval_every=2, subsample_size=100, target_accuracy=90.)
+    state = schedule.initial_state()
+
+    assert schedule.reached_target(95.)
+    assert not schedule.update(state, 0.5, 95., full=False)
+    assert schedule.update(state, 0.5, 95., full=True)
@@ -0,0 +1,77 @@
+"""
+Story sessions of inference.server, served by an untrained QAModel on a free port.
+"""
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+import torch
+
+from inference.predictor import Predictor
+from inference.server import InferenceHandler, MicroBatcher, SessionStore
+from model.QAModel import QAModel
+from preprocessing import bAbIData as bd
+
+WORDS = ["Mary", "went", "to", "the", "kitchen", "garden", ".", "Where", "is", "?"]
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    torch.manual_seed(0)
+    voc = bd.Vocabulary(vocabulary_dict=dict((word, i + 1) for i, word in enumerate(WORDS)))
+    predictor = Predictor(QAModel(len(voc), 8, 8, len(voc)), voc)
+
+    # Wired up like serve() does for a saved run
+    server = ThreadingHTTPServer(("127.0.0.1", 0), InferenceHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(predictor)
+    server.sessions = SessionStore(predictor)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, content):
+    # Status and JSON answer of a POST request
+    request = urllib.request.Request(url, json.dumps(content).encode("utf-8"), {"Content-Type": "application/json"})
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read().decode("utf-8"))
+
+
+def test_session_answers_questions(server_url):
+    status, content = post(server_url + "/sessions/a/facts", {"facts": ["Mary went to the kitchen."]})
+    assert status == 200 and content["words"] == 6
+
+    status, content = post(server_url + "/sessions/a/questions", {"question": "Where is Mary?"})
+    assert status == 200 and content["answer"] in WORDS + ["<pad>"]
+
+
+@pytest.mark.parametrize("action, content", [
+    ("facts", {"fact": 5}),
+    ("facts", {"facts": "Mary went to the kitchen."}),
+    ("facts", {"facts": ["Mary went to the kitchen.", None]}),
+    ("questions", {"question": None}),
+    ("questions", {"question": ["Where is Mary?"]}),
+])
+def test_session_rejects_payloads_that_are_not_text(server_url, action, content):
+    status, answer = post(server_url + "/sessions/b/" + action, content)
+
+    assert status == 400
+    assert "error" in answer
+
+    # Nothing was added to the session
+    status, answer = post(server_url + "/sessions/b/facts", {"facts": []})
+    assert status == 200 and answer["words"] == 0
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+import torch
+
+
+def _rng_state():
+    # The numpy state is stored as a tensor and plain numbers, so the checkpoint only contains tensors and builtins
+    np_state = np.random.get_state()
+
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": [np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), int(np_state[2]), int(np_state[3]),
+                  float(np_state[4])],
+        "python": random.getstate()
+    }
+
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+
+    return state
+
+
+def _set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+
+    np_state = state["numpy"]
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), np_state[2], np_state[3], np_state[4]))
+
+    python_state = state["python"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_checkpoint(path, model, optimizer, epoch, histories):
+    """
+    Saves the training state of one model, including the random number generator states.
+
+    :param path: The checkpoint file
+    :param epoch: Number of epochs the model has been trained for
+    :param histories: Dict with the loss and accuracy histories so far
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    state = {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "epoch": epoch,
+        "histories": histories,
+        "rng": _rng_state()
+    }
+
+    # Write to a temporary file first, so an interrupted run never leaves a broken checkpoint behind
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path, model, optimizer):
+    """
+    Restores model, optimizer and random number generators from a checkpoint written by save_checkpoint.
+
+    :return: The number of epochs trained and the histories
+    """
+    state = torch.load(path, map_location=lambda storage, location: storage)
+
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+
+    if "rng" in state:
+        _set_rng_state(state["rng"])
+
+    return state["epoch"], state["histories"]
+
+
+def run_directory(base, name, params, options=None):
+    """
+    Directory of a resumable run. The name contains a hash of the params, so restarting the same run finds the same
+    directory and changing the params starts a new one.
+
+    :param options: Further settings of the run that are hashed with the params (e.g. the data files), they have to
+                    be JSON serializable
+    """
+    description = params if options is None else [params, options]
+    digest = hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+    return os.path.join(base, name + "_" + digest)
+
+
+class GridManifest:
+    """
+    Records which param sets of a grid run are finished (and where their results went) in a JSON file, so a
+    restarted run can skip them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(param_dict):
+        return json.dumps(param_dict, sort_keys=True)
+
+    def is_done(self, param_dict):
+        return self.entries.get(GridManifest.key(param_dict), {}).get("status") == "done"
+
+    def mark_done(self, param_dict, result_dir):
+        self.entries[GridManifest.key(param_dict)] = {"status": "done", "results": result_dir}
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
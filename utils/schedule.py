@@ -0,0 +1,57 @@
+class EvaluationSchedule:
+    """
+    Decides when conduct_training evaluates the model and when it stops early.
+
+    The full test set is evaluated every eval_every epochs and after the last epoch. In between, the model is evaluated
+    on a fixed stratified subsample of subsample_size test instances if subsample_size is set, otherwise not at all.
+
+    The training stops early once a full evaluation reaches target_accuracy (a subsample reaching it triggers a full
+    evaluation right away), or once the mean test loss has not improved by more than min_delta for patience full
+    evaluations in a row. The losses of the subsample are not comparable to the full ones and do not count.
+    """
+
+    def __init__(self, eval_every=1, subsample_size=None, target_accuracy=None, patience=None, min_delta=0.):
+        self.eval_every = max(1, eval_every or 1)
+        self.subsample_size = subsample_size
+        self.target_accuracy = target_accuracy
+        self.patience = patience
+        self.min_delta = min_delta
+
+    def is_full_evaluation(self, epoch, epochs):
+        return epoch == epochs or epoch % self.eval_every == 0
+
+    def stops_early(self):
+        return self.target_accuracy is not None or self.patience is not None
+
+    def reached_target(self, accuracy):
+        return self.target_accuracy is not None and accuracy >= self.target_accuracy
+
+    @staticmethod
+    def initial_state():
+        # Progress of the stopping criteria, it is stored in the checkpoints so resumed runs keep counting
+        return {"best_loss": None, "bad_evaluations": 0, "stopped": False}
+
+    def update(self, state, mean_loss, accuracy, full):
+        """
+        Updates the state with the result of an evaluation, subsample evaluations leave it as it is.
+
+        :param full: Whether the evaluation was on the full test set
+        :return: True if the training should stop
+        """
+        if not full:
+            return state["stopped"]
+
+        if state["best_loss"] is None or mean_loss < state["best_loss"] - self.min_delta:
+            state["best_loss"] = mean_loss
+            state["bad_evaluations"] = 0
+        else:
+            state["bad_evaluations"] += 1
+
+        if self.reached_target(accuracy):
+            print("Reached the target accuracy of %.1f%%" % self.target_accuracy)
+            state["stopped"] = True
+        elif self.patience is not None and state["bad_evaluations"] >= self.patience:
+            print("Test loss did not improve for %d evaluations" % self.patience)
+            state["stopped"] = True
+
+        return state["stopped"]